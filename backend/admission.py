@@ -0,0 +1,344 @@
+"""
+Admission control for analysis requests.
+
+Nothing used to bound how much work the API took on: a few concurrent
+uploads of large reports could parse, build columns and aggregate at the
+same time until the process ran out of memory. Every heavy request now
+reserves an estimated cost before it starts:
+
+- memory: the parsed payload (JSON rows are several times their encoded
+  size as Python objects), the columns built from it and the per-chart
+  working arrays (group indexes, masks, point lists),
+- CPU: parsing, column building and per-chart passes over the rows, in
+  seconds of work.
+
+Requests run while fewer than ``max_concurrent`` are running and their
+memory fits in what is left of the budget. Otherwise they wait in a FIFO
+queue (so large requests aren't starved by a stream of small ones) of at
+most ``max_queue`` requests. Requests are rejected with
+
+- 413 when the body is larger than ``max_request_bytes`` or the estimated
+  memory alone exceeds the whole budget (the request can never run),
+- 429 with ``Retry-After`` when the queue is full or the request waited
+  longer than ``queue_timeout`` seconds.
+
+The cost is first estimated from the Content-Length before the body is read
+(so parsing is covered), then refined once row and chart counts are known.
+Retry-After is the queued and running CPU estimate divided by the
+concurrency, scaled by how long admitted requests actually took relative to
+their estimates.
+
+Configuration (environment variables):
+
+- ``ADMISSION_MAX_CONCURRENT``: requests running at once (default: number of CPUs)
+- ``ADMISSION_MEMORY_BYTES``: memory budget of running requests (default 1 GB)
+- ``ADMISSION_MAX_QUEUE``: requests waiting at most (default 32)
+- ``ADMISSION_QUEUE_TIMEOUT_SECONDS``: longest wait before a 429 (default 30)
+- ``ADMISSION_MAX_REQUEST_BYTES``: largest accepted request body (default 256 MB)
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from metrics import ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS
+
+# Memory per payload byte while the payload is alive, by body format (None: JSON)
+PAYLOAD_MEMORY_FACTORS = {None: 8.0, "csv": 8.0, "arrow": 2.0, "arrow_file": 2.0, "parquet": 4.0}
+# Arrays of one column (codes, flags, numbers) plus temporaries while building them
+COLUMN_ROW_BYTES = 48
+# Group indexes, masks and keys of one chart
+CHART_ROW_BYTES = 32
+# xy/scatter/raw line charts build Python point lists before downsampling
+POINT_ROW_BYTES = 160
+
+# CPU seconds per payload byte parsed, per row and column built, per row and chart
+PARSE_BYTE_SECONDS = 1e-8
+COLUMN_ROW_SECONDS = 5e-7
+CHART_ROW_SECONDS = 1e-6
+
+MAX_RETRY_AFTER_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class Cost:
+    """Estimated resources of one request"""
+    memory_bytes: int
+    cpu_seconds: float
+
+    def __add__(self, other: "Cost") -> "Cost":
+        return Cost(self.memory_bytes + other.memory_bytes, self.cpu_seconds + other.cpu_seconds)
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; status_code is 413 or 429"""
+
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+
+
+class Ticket:
+    """An admitted request's reservation; release it when the request is done"""
+
+    def __init__(self, controller: "AdmissionController", cost: Cost):
+        self.controller = controller
+        # The estimate the request was admitted with, and the one reserved now
+        self.admitted_cost = cost
+        self.cost = cost
+        self.started = time.perf_counter()
+        self.released = False
+        self.detached = False
+
+    def detach(self) -> None:
+        """Mark the ticket as released by its response (streams outlive their handler)"""
+        self.detached = True
+
+    def resize(self, cost: Cost) -> None:
+        """Replace the reserved cost with a refined estimate (raises 413 if it can never fit)"""
+        self.controller._resize(self, cost)
+
+    def release(self) -> None:
+        """Give the reservation back (idempotent)"""
+        self.controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, cost: Cost, loop: asyncio.AbstractEventLoop):
+        self.cost = cost
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+        self.ticket: Optional[Ticket] = None
+
+
+class AdmissionController:
+    """Bounded concurrency and memory budget with a FIFO wait queue"""
+
+    def __init__(self, max_concurrent: int, memory_budget: int, max_queue: int = 32,
+                 queue_timeout: float = 30.0, max_request_bytes: int = 256 * 1024 * 1024):
+        self.max_concurrent = max(1, max_concurrent)
+        self.memory_budget = memory_budget
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_request_bytes = max_request_bytes
+        self._lock = threading.Lock()
+        self._queue: Deque[_Waiter] = deque()
+        self._running = 0
+        self._memory = 0
+        self._cpu = 0.0
+        # Observed / estimated CPU time of finished requests (moving average)
+        self._scale = 1.0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected: Dict[str, int] = {"too_large": 0, "over_budget": 0, "queue_full": 0, "queue_timeout": 0}
+        self.max_queue_seen = 0
+        # Futures of wait_idle callers
+        self._idle_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def estimate(self, payload_bytes: int = 0, fmt: Optional[str] = None, rows: int = 0, columns: int = 0,
+                 charts: int = 0, point_charts: int = 0) -> Cost:
+        """
+        Cost of parsing payload_bytes of a body in fmt, building columns
+        columns of rows rows, and computing charts charts (point_charts of
+        which build point lists)
+        """
+        factor = PAYLOAD_MEMORY_FACTORS.get(fmt, PAYLOAD_MEMORY_FACTORS[None])
+        memory = (payload_bytes * factor + rows * columns * COLUMN_ROW_BYTES
+                  + rows * (charts * CHART_ROW_BYTES + point_charts * POINT_ROW_BYTES))
+        cpu = payload_bytes * PARSE_BYTE_SECONDS + rows * (columns * COLUMN_ROW_SECONDS + charts * CHART_ROW_SECONDS)
+        return Cost(int(memory), cpu)
+
+    def check_size(self, payload_bytes: int) -> None:
+        """Reject bodies over max_request_bytes (413)"""
+        if payload_bytes > self.max_request_bytes:
+            self._reject(AdmissionRejected(
+                413, "too_large",
+                f"Request body of {payload_bytes} bytes exceeds the limit of {self.max_request_bytes} bytes",
+            ))
+
+    def _check_budget(self, cost: Cost) -> None:
+        if cost.memory_bytes > self.memory_budget:
+            self._reject(AdmissionRejected(
+                413, "over_budget",
+                f"Request needs an estimated {cost.memory_bytes} bytes, more than the analysis memory budget "
+                f"of {self.memory_budget} bytes; upload the dataset via /api/datasets or request fewer charts",
+            ))
+
+    def _reject(self, error: AdmissionRejected) -> None:
+        with self._lock:
+            self.rejected[error.reason] += 1
+        ADMISSION_REJECTIONS.inc(reason=error.reason)
+        raise error
+
+    def _fits(self, cost: Cost) -> bool:
+        # A request always runs when nothing else does, however large its estimate
+        return self._running == 0 or (self._running < self.max_concurrent
+                                      and self._memory + cost.memory_bytes <= self.memory_budget)
+
+    def _start(self, cost: Cost) -> Ticket:
+        self._running += 1
+        self._memory += cost.memory_bytes
+        self._cpu += cost.cpu_seconds
+        self.admitted += 1
+        return Ticket(self, cost)
+
+    async def admit(self, cost: Cost) -> Ticket:
+        """
+        Reserve cost, waiting in the queue while the budget is used up;
+        raises AdmissionRejected (413 or 429)
+        """
+        self._check_budget(cost)
+        started = time.perf_counter()
+        with self._lock:
+            if not self._queue and self._fits(cost):
+                ticket = self._start(cost)
+                waiter = None
+            elif len(self._queue) >= self.max_queue:
+                waiter = ticket = None
+                retry_after = self._retry_after()
+            else:
+                waiter = _Waiter(cost, asyncio.get_running_loop())
+                self._queue.append(waiter)
+                self.waited += 1
+                self.max_queue_seen = max(self.max_queue_seen, len(self._queue))
+        if waiter is None and ticket is None:
+            self._reject(AdmissionRejected(
+                429, "queue_full", f"Too many analysis requests queued ({self.max_queue}); retry later", retry_after,
+            ))
+        if waiter is not None:
+            try:
+                ticket = await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                with self._lock:
+                    if waiter.ticket is None:
+                        self._queue.remove(waiter)
+                        retry_after = self._retry_after()
+                    ticket = waiter.ticket
+                if isinstance(e, asyncio.CancelledError):
+                    if ticket is not None:
+                        # Admitted just as the client went away: give the slot to the next in line
+                        ticket.release()
+                    raise
+                if ticket is None:
+                    self._reject(AdmissionRejected(
+                        429, "queue_timeout",
+                        f"Analysis capacity is saturated; queued for {self.queue_timeout:g}s without being admitted",
+                        retry_after,
+                    ))
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started)
+        return ticket
+
+    def _resize(self, ticket: Ticket, cost: Cost) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            self._memory += cost.memory_bytes - ticket.cost.memory_bytes
+            self._cpu += cost.cpu_seconds - ticket.cost.cpu_seconds
+            ticket.cost = cost
+        try:
+            self._check_budget(cost)
+        except AdmissionRejected:
+            ticket.release()
+            raise
+        # A smaller estimate may make room for queued requests
+        self._wake()
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._running -= 1
+            self._memory -= ticket.cost.memory_bytes
+            self._cpu -= ticket.cost.cpu_seconds
+            if ticket.cost.cpu_seconds > 0.01:
+                observed = (time.perf_counter() - ticket.started) / ticket.cost.cpu_seconds
+                self._scale = 0.8 * self._scale + 0.2 * min(max(observed, 0.1), 100.0)
+        self._wake()
+
+    def _wake(self) -> None:
+        """Admit queued requests in order while the head of the queue fits"""
+        woken = []
+        idle = []
+        with self._lock:
+            while self._queue and self._fits(self._queue[0].cost):
+                waiter = self._queue.popleft()
+                waiter.ticket = self._start(waiter.cost)
+                woken.append(waiter)
+            if not self.busy:
+                idle, self._idle_waiters = self._idle_waiters, []
+        for waiter in woken:
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future, waiter.ticket)
+        for loop, future in idle:
+            loop.call_soon_threadsafe(_set_idle, future)
+
+    @property
+    def busy(self) -> bool:
+        """True while requests are running or queued"""
+        return self._running > 0 or bool(self._queue)
+
+    async def wait_idle(self) -> None:
+        """Wait until no request is running or queued (for background work that yields to requests)"""
+        with self._lock:
+            if not self.busy:
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._idle_waiters.append((asyncio.get_running_loop(), future))
+        await future
+
+    def _retry_after(self) -> int:
+        """Seconds until the work running and queued now is expected to be done (lock held)"""
+        queued = sum(waiter.cost.cpu_seconds for waiter in self._queue)
+        seconds = (self._cpu + queued) * self._scale / self.max_concurrent
+        return min(MAX_RETRY_AFTER_SECONDS, max(1, math.ceil(seconds)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "max_queue_seen": self.max_queue_seen,
+                "memory_reserved_bytes": self._memory,
+                "cpu_reserved_seconds": round(self._cpu, 3),
+                "admitted": self.admitted,
+                "waited": self.waited,
+                "rejected": dict(self.rejected),
+                "retry_after_seconds": self._retry_after(),
+                "max_concurrent": self.max_concurrent,
+                "memory_budget_bytes": self.memory_budget,
+                "max_queue": self.max_queue,
+                "queue_timeout_seconds": self.queue_timeout,
+                "max_request_bytes": self.max_request_bytes,
+            }
+
+
+def _set_idle(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _resolve(future: asyncio.Future, ticket: Ticket) -> None:
+    if future.cancelled():
+        # The waiter gave up (client disconnected) after being admitted
+        ticket.release()
+    else:
+        future.set_result(ticket)
+
+
+admission_controller = AdmissionController(
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "0")) or os.cpu_count() or 1,
+    memory_budget=int(os.getenv("ADMISSION_MEMORY_BYTES", str(1024 * 1024 * 1024))),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30")),
+    max_request_bytes=int(os.getenv("ADMISSION_MAX_REQUEST_BYTES", str(256 * 1024 * 1024))),
+)
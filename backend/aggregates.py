@@ -0,0 +1,640 @@
+"""
+Streaming accumulators for chart aggregates.
+
+An accumulator holds the running state of one aggregate for every group of a
+grouping, indexed by a dense group number. ``update`` folds a batch of
+(group, value) pairs into that state in place, so memory stays proportional
+to the number of groups rather than the number of rows:
+
+- COUNT, SUM, MIN, MAX, PERCENTAGE: running count / sum / min / max
+- AVG: Welford-style running mean
+- MODE: a ``Counter`` per group
+- DISTINCT_COUNT: a set of value codes per group
+- MEDIAN, P90, P95, P99: exact quantiles still need every value, which is
+  kept per group
+
+Accumulators of the same kind can be merged, which is what incremental and
+chunked computation build on. A pass over the rows in chunks calls
+``update_chunk`` per chunk and ``finish`` at the end, and gets exactly the
+state one ``update`` over all the rows would have built (float sums are
+added in row order, not chunk by chunk).
+
+The per-value state of MEDIAN, MODE and DISTINCT_COUNT can also be read
+from every group's values in row order (``attach_values``), e.g. values
+spilled to disk, instead of being held in memory.
+
+Approximate accumulators (``make_accumulator(..., approximate=True)``) keep
+a fixed-size sketch per group instead: a HyperLogLog for DISTINCT_COUNT, a
+t-digest for MEDIAN and the percentiles, a Space-Saving summary for MODE.
+Sketches merge like the exact state, and ``error_bounds`` reports how far
+their results may be off. Sizes are configured with
+``APPROXIMATE_HLL_PRECISION`` (default 12), ``APPROXIMATE_TDIGEST_COMPRESSION``
+(default 200) and ``APPROXIMATE_MODE_COUNTERS`` (default 64).
+"""
+import os
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, Mapping, Optional, Tuple
+
+import numpy as np
+
+from sketches import HyperLogLog, SpaceSaving, TDigest
+
+HLL_PRECISION = int(os.getenv("APPROXIMATE_HLL_PRECISION", "12"))
+TDIGEST_COMPRESSION = float(os.getenv("APPROXIMATE_TDIGEST_COMPRESSION", "200"))
+MODE_COUNTERS = int(os.getenv("APPROXIMATE_MODE_COUNTERS", "64"))
+
+# Quantile of each quantile aggregate
+QUANTILES = {"MEDIAN": 0.5, "P90": 0.9, "P95": 0.95, "P99": 0.99}
+
+
+def _continued_sums(sums: np.ndarray, groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    sums[i] plus the values of group i, added one by one in row order: the
+    running sum is bincount's first addend, so the result equals one bincount
+    over the rows of every chunk so far, bit for bit
+    """
+    indexes = np.concatenate((np.arange(len(sums)), groups))
+    weights = np.concatenate((sums, np.asarray(values, dtype=np.float64)))
+    return np.bincount(indexes, weights=weights, minlength=len(sums))
+
+
+def _group_parts(groups: np.ndarray, values: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+    """Every group with its values (in row order), groups ascending"""
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    boundaries = np.flatnonzero(np.diff(sorted_groups)) + 1
+    starts = np.concatenate(([0], boundaries))
+    return zip(sorted_groups[starts].tolist(), np.split(np.asarray(values)[order], boundaries))
+
+
+def _pair_table(groups: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Group, value and count of every distinct (group, value) pair, in order of the pair's first row"""
+    values = np.asarray(values)
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    new_pair = np.ones(len(order), dtype=bool)
+    new_pair[1:] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    starts = np.flatnonzero(new_pair)
+    pair_counts = np.diff(np.append(starts, len(order)))
+    # lexsort is stable, so order[start] is the first row of each pair
+    by_first_row = starts[np.argsort(order[starts], kind="stable")]
+    return sorted_groups[by_first_row], sorted_values[by_first_row], pair_counts[np.searchsorted(starts, by_first_row)]
+
+
+def _pair_counts(groups: np.ndarray, values: np.ndarray) -> Iterator[Tuple[int, Any, int]]:
+    """(group, value, count) of every distinct pair, in order of the pair's first row"""
+    pair_groups, pair_values, pair_counts = _pair_table(groups, values)
+    return zip(pair_groups.tolist(), pair_values.tolist(), pair_counts.tolist())
+
+
+def _quantile(values: np.ndarray, quantile: float, number: Callable[[Any], Any]):
+    """Value at rank quantile * (n - 1), interpolated linearly between neighbours"""
+    n = len(values)
+    position = quantile * (n - 1)
+    low, high = int(np.floor(position)), int(np.ceil(position))
+    middle = np.partition(values, [low, high])
+    if low == high:
+        return number(middle[low])
+    fraction = position - low
+    if fraction == 0.5:
+        return float((middle[low] + middle[high]) / 2)
+    return float(middle[low] + (middle[high] - middle[low]) * fraction)
+
+
+class _GroupValues(Mapping):
+    """Per-group state built on access from a mapping of group -> values in row order"""
+
+    def __init__(self, values: Mapping[int, np.ndarray], build: Callable[[np.ndarray], object]):
+        self._values = values
+        self._build = build
+
+    def __getitem__(self, group):
+        return self._build(self._values[group])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class Accumulator:
+    """Running state of one aggregate for a growing number of groups"""
+
+    def __init__(self, integral: bool = False):
+        # True when the values are Python ints, so results can stay ints
+        self.integral = integral
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def resize(self, size: int) -> None:
+        """Make room for groups up to size - 1"""
+        if size > len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(size - len(self.counts), dtype=np.int64)))
+
+    def update(self, groups: np.ndarray, values: np.ndarray) -> None:
+        """Fold values into the state of their groups"""
+        size = int(groups.max()) + 1 if len(groups) else 0
+        self.resize(size)
+        self.counts += np.bincount(groups, minlength=len(self.counts))
+
+    def update_chunk(self, groups: np.ndarray, values: np.ndarray) -> None:
+        """update with the next chunk of rows of a pass over them in row order"""
+        self.update(groups, values)
+
+    def finish(self) -> None:
+        """End a pass of update_chunk calls"""
+
+    def merge(self, other: "Accumulator", mapping: Optional[np.ndarray] = None) -> None:
+        """Fold another accumulator in; mapping[i] is the group in self for group i of other"""
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        self.resize(int(mapping.max()) + 1 if len(mapping) else 0)
+        np.add.at(self.counts, mapping, other.counts)
+
+    def result(self, group: int):
+        """Aggregate of one group (0 when it received no values)"""
+        return int(self.counts[group]) if group < len(self.counts) else 0
+
+    def _number(self, value):
+        if self.integral and float(value).is_integer():
+            return int(value)
+        return float(value)
+
+
+class CountAccumulator(Accumulator):
+    """COUNT (and DISTINCT_COUNT over whole rows)"""
+
+
+class SumAccumulator(Accumulator):
+    """SUM, and PERCENTAGE before it is normalised against the total"""
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.sums = np.zeros(0, dtype=np.float64)
+
+    def resize(self, size: int) -> None:
+        grow = size - len(self.counts)
+        super().resize(size)
+        if grow > 0:
+            self.sums = np.concatenate((self.sums, np.zeros(grow)))
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        self.sums += np.bincount(groups, weights=values, minlength=len(self.sums))
+
+    def update_chunk(self, groups, values):
+        super().update(groups, values)
+        if len(groups):
+            touched, local = np.unique(groups, return_inverse=True)
+            self.sums[touched] = _continued_sums(self.sums[touched], local.reshape(-1), values)
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        np.add.at(self.sums, mapping, other.sums)
+
+    def result(self, group):
+        if group >= len(self.counts) or not self.counts[group]:
+            return 0
+        return self._number(self.sums[group])
+
+
+class _ExtremeAccumulator(Accumulator):
+    _initial = 0.0
+    _ufunc = None
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.extremes = np.zeros(0, dtype=np.float64)
+
+    def resize(self, size):
+        grow = size - len(self.counts)
+        super().resize(size)
+        if grow > 0:
+            self.extremes = np.concatenate((self.extremes, np.full(grow, self._initial)))
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        self._ufunc.at(self.extremes, groups, np.asarray(values, dtype=np.float64))
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        self._ufunc.at(self.extremes, mapping, other.extremes)
+
+    def result(self, group):
+        if group >= len(self.counts) or not self.counts[group]:
+            return 0
+        return self._number(self.extremes[group])
+
+
+class MinAccumulator(_ExtremeAccumulator):
+    _initial = np.inf
+    _ufunc = np.minimum
+
+
+class MaxAccumulator(_ExtremeAccumulator):
+    _initial = -np.inf
+    _ufunc = np.maximum
+
+
+class MeanAccumulator(Accumulator):
+    """AVG as a running mean, combined batch by batch (Welford / Chan et al.)"""
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.means = np.zeros(0, dtype=np.float64)
+        # Counts and row-order sums of a pass of update_chunk calls, combined
+        # once in finish like a single update
+        self._pass: Optional[SumAccumulator] = None
+
+    def resize(self, size):
+        grow = size - len(self.counts)
+        super().resize(size)
+        if grow > 0:
+            self.means = np.concatenate((self.means, np.zeros(grow)))
+
+    def _combine(self, indexes, counts, means):
+        total = self.counts[indexes] + counts
+        delta = means - self.means[indexes]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            step = np.where(total > 0, delta * counts / np.maximum(total, 1), 0.0)
+        self.means[indexes] += step
+        self.counts[indexes] = total
+
+    def update(self, groups, values):
+        size = int(groups.max()) + 1 if len(groups) else 0
+        self.resize(size)
+        counts = np.bincount(groups, minlength=len(self.counts))
+        sums = np.bincount(groups, weights=values, minlength=len(self.counts))
+        touched = np.flatnonzero(counts)
+        self._combine(touched, counts[touched], sums[touched] / counts[touched])
+
+    def update_chunk(self, groups, values):
+        if self._pass is None:
+            self._pass = SumAccumulator()
+            self._pass.resize(len(self.counts))
+        self._pass.update_chunk(groups, values)
+
+    def finish(self):
+        pending, self._pass = self._pass, None
+        if pending is None:
+            return
+        self.resize(len(pending.counts))
+        touched = np.flatnonzero(pending.counts)
+        self._combine(touched, pending.counts[touched], pending.sums[touched] / pending.counts[touched])
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        self.resize(int(mapping.max()) + 1 if len(mapping) else 0)
+        touched = np.flatnonzero(other.counts)
+        targets = mapping[touched]
+        if len(np.unique(targets)) == len(targets):
+            self._combine(targets, other.counts[touched], other.means[touched])
+            return
+        # Several groups fold into one: pool them first, then combine
+        counts = np.bincount(targets, weights=other.counts[touched], minlength=len(self.counts))
+        sums = np.bincount(targets, weights=other.counts[touched] * other.means[touched], minlength=len(self.counts))
+        pooled = np.flatnonzero(counts)
+        self._combine(pooled, counts[pooled].astype(np.int64), sums[pooled] / counts[pooled])
+
+    def result(self, group):
+        if group >= len(self.counts) or not self.counts[group]:
+            return 0
+        return float(self.means[group])
+
+
+class MedianAccumulator(Accumulator):
+    """Exact MEDIAN; keeps every value of a group"""
+
+    quantile = 0.5
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.chunks: Dict[int, list] = {}
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        for group, part in _group_parts(groups, values):
+            self.chunks.setdefault(group, []).append(part)
+
+    def attach_values(self, values: Mapping[int, np.ndarray]) -> None:
+        """Read every group's values from a mapping instead of keeping them"""
+        self.chunks = _GroupValues(values, lambda part: [part])
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        for group, parts in other.chunks.items():
+            self.chunks.setdefault(int(mapping[group]), []).extend(parts)
+
+    def result(self, group):
+        parts = self.chunks.get(group)
+        if not parts:
+            return 0
+        values = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return _quantile(values, self.quantile, self._number)
+
+
+class P90Accumulator(MedianAccumulator):
+    """Exact 90th percentile"""
+
+    quantile = 0.9
+
+
+class P95Accumulator(MedianAccumulator):
+    """Exact 95th percentile"""
+
+    quantile = 0.95
+
+
+class P99Accumulator(MedianAccumulator):
+    """Exact 99th percentile"""
+
+    quantile = 0.99
+
+
+class ModeAccumulator(Accumulator):
+    """MODE with a Counter per group; ties go to the value seen first"""
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.counters: Dict[int, Counter] = {}
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        # Pairs in order of their first row keep the Counter in first-seen order
+        for group, value, count in _pair_counts(groups, values):
+            counter = self.counters.get(group)
+            if counter is None:
+                counter = self.counters[group] = Counter()
+            counter[value] += count
+
+    def attach_values(self, values: Mapping[int, np.ndarray]) -> None:
+        """Count every group's values (in row order, so ties still go to the first seen) from a mapping"""
+        self.counters = _GroupValues(values, lambda part: Counter(part.tolist()))
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        for group, counter in other.counters.items():
+            self.counters.setdefault(int(mapping[group]), Counter()).update(counter)
+
+    def result(self, group):
+        counter = self.counters.get(group)
+        if not counter:
+            return 0
+        value = counter.most_common(1)[0][0]
+        return self._number(value)
+
+
+class DistinctCountAccumulator(Accumulator):
+    """DISTINCT_COUNT with a set of value codes per group"""
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.distinct: Dict[int, set] = {}
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        pairs = np.unique(np.stack((groups.astype(np.int64), np.asarray(values, dtype=np.int64))), axis=1)
+        for group, value in zip(pairs[0].tolist(), pairs[1].tolist()):
+            seen = self.distinct.get(group)
+            if seen is None:
+                seen = self.distinct[group] = set()
+            seen.add(value)
+
+    def attach_values(self, values: Mapping[int, np.ndarray]) -> None:
+        """Read every group's value codes from a mapping instead of keeping them"""
+        self.distinct = _GroupValues(values, lambda part: set(part.tolist()))
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        for group, seen in other.distinct.items():
+            self.distinct.setdefault(int(mapping[group]), set()).update(seen)
+
+    def result(self, group):
+        return len(self.distinct.get(group, ()))
+
+
+class SketchAccumulator(Accumulator):
+    """Approximate aggregate with a mergeable sketch per group"""
+
+    # Name of the sketch and of the error its results report
+    method = ""
+    error_name = ""
+
+    def __init__(self, integral: bool = False):
+        super().__init__(integral)
+        self.sketches: Dict[int, Any] = {}
+
+    def _new_sketch(self):
+        raise NotImplementedError
+
+    def _sketch(self, group: int):
+        sketch = self.sketches.get(group)
+        if sketch is None:
+            sketch = self.sketches[group] = self._new_sketch()
+        return sketch
+
+    def merge(self, other, mapping=None):
+        if mapping is None:
+            mapping = np.arange(len(other), dtype=np.int64)
+        super().merge(other, mapping)
+        for group, sketch in other.sketches.items():
+            target = int(mapping[group])
+            existing = self.sketches.get(target)
+            # Copied, so merging leaves other untouched
+            if existing is None:
+                self.sketches[target] = sketch.copy()
+            else:
+                existing.merge(sketch)
+
+    def error(self, group: int) -> float:
+        """Error bound of the group's result (0 when it is exact)"""
+        raise NotImplementedError
+
+    def exact(self, group: int) -> bool:
+        sketch = self.sketches.get(group)
+        return sketch is None or sketch.exact
+
+
+class ApproxDistinctCountAccumulator(SketchAccumulator):
+    """DISTINCT_COUNT with a (sparse until large) HyperLogLog per group, over stable value hashes"""
+
+    method = "hyperloglog"
+    error_name = "relative_error"
+
+    def _new_sketch(self):
+        return HyperLogLog(HLL_PRECISION, sparse=True)
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        for group, hashes in _group_parts(groups, values):
+            self._sketch(group).add_hashes(hashes)
+
+    def result(self, group):
+        sketch = self.sketches.get(group)
+        return sketch.estimate() if sketch is not None else 0
+
+    def error(self, group):
+        # Relative standard error once the sketch has registers
+        return 0.0 if self.exact(group) else float(self.sketches[group].relative_error)
+
+
+class ApproxMedianAccumulator(SketchAccumulator):
+    """MEDIAN from a t-digest per group"""
+
+    method = "t-digest"
+    error_name = "rank_error"
+    quantile = 0.5
+
+    def _new_sketch(self):
+        return TDigest(TDIGEST_COMPRESSION)
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        for group, part in _group_parts(groups, values):
+            self._sketch(group).add(part)
+
+    def result(self, group):
+        digest = self.sketches.get(group)
+        if digest is None or not digest.count:
+            return 0
+        if digest.exact:
+            return _quantile(digest.values(), self.quantile, self._number)
+        return digest.quantile(self.quantile)
+
+    def error(self, group):
+        digest = self.sketches.get(group)
+        return digest.rank_error(self.quantile) if digest is not None else 0.0
+
+
+class ApproxP90Accumulator(ApproxMedianAccumulator):
+    quantile = 0.9
+
+
+class ApproxP95Accumulator(ApproxMedianAccumulator):
+    quantile = 0.95
+
+
+class ApproxP99Accumulator(ApproxMedianAccumulator):
+    quantile = 0.99
+
+
+class ApproxModeAccumulator(SketchAccumulator):
+    """MODE from a Space-Saving summary per group; ties go to the value seen first"""
+
+    method = "space-saving"
+    error_name = "frequency_error"
+
+    def _new_sketch(self):
+        return SpaceSaving(MODE_COUNTERS)
+
+    def update(self, groups, values):
+        super().update(groups, values)
+        if not len(groups):
+            return
+        pair_groups, pair_values, pair_counts = _pair_table(groups, values)
+        # Pairs by group, still in order of their first row within a group
+        order = np.argsort(pair_groups, kind="stable")
+        pair_groups, pair_values, pair_counts = pair_groups[order], pair_values[order], pair_counts[order]
+        boundaries = np.flatnonzero(np.diff(pair_groups)) + 1
+        starts = np.concatenate(([0], boundaries)).tolist()
+        ends = np.append(boundaries, len(pair_groups)).tolist()
+        for group, start, end in zip(pair_groups[starts].tolist(), starts, ends):
+            self._sketch(group).add_counts(pair_values[start:end], pair_counts[start:end])
+
+    def result(self, group):
+        summary = self.sketches.get(group)
+        best = summary.most_common() if summary is not None else None
+        return self._number(best[0]) if best is not None else 0
+
+    def error(self, group):
+        # Share of the group's values by which any value's count may be off
+        summary = self.sketches.get(group)
+        return summary.floor / summary.total if summary is not None and summary.total else 0.0
+
+
+ACCUMULATORS = {
+    "COUNT": CountAccumulator,
+    "DISTINCT_COUNT": DistinctCountAccumulator,
+    "SUM": SumAccumulator,
+    "AVG": MeanAccumulator,
+    "MEAN": MeanAccumulator,
+    "MIN": MinAccumulator,
+    "MAX": MaxAccumulator,
+    "MEDIAN": MedianAccumulator,
+    "P90": P90Accumulator,
+    "P95": P95Accumulator,
+    "P99": P99Accumulator,
+    "MODE": ModeAccumulator,
+    "PERCENTAGE": SumAccumulator,
+}
+
+# Aggregates with a sketch for approximate=True; the others are cheap exactly
+APPROXIMATE_ACCUMULATORS = {
+    "DISTINCT_COUNT": ApproxDistinctCountAccumulator,
+    "MEDIAN": ApproxMedianAccumulator,
+    "P90": ApproxP90Accumulator,
+    "P95": ApproxP95Accumulator,
+    "P99": ApproxP99Accumulator,
+    "MODE": ApproxModeAccumulator,
+}
+
+
+def regroup(accumulator: Accumulator, mapping: np.ndarray, size: int) -> Accumulator:
+    """
+    New accumulator over size groups, with group i of accumulator folded into
+    group mapping[i] (several groups may fold into one, e.g. an "Other" bucket)
+    """
+    combined = type(accumulator)(accumulator.integral)
+    combined.resize(size)
+    combined.merge(accumulator, np.asarray(mapping, dtype=np.int64))
+    return combined
+
+
+def make_accumulator(aggregate_type: Optional[str], integral: bool = False, approximate: bool = False) -> Accumulator:
+    """Accumulator for an aggregate type (unknown types count, like aggregate_values)"""
+    aggregate_type = (aggregate_type or "COUNT").upper()
+    if approximate and aggregate_type in APPROXIMATE_ACCUMULATORS:
+        return APPROXIMATE_ACCUMULATORS[aggregate_type](integral)
+    return ACCUMULATORS.get(aggregate_type, CountAccumulator)(integral)
+
+
+def error_bounds(parts: Iterable[Tuple[Accumulator, Iterable[int]]]) -> Optional[Dict[str, Any]]:
+    """
+    How far the results of some groups of approximate accumulators may be
+    off (the largest bound over them), or None when nothing was approximated
+    """
+    bounds = None
+    for accumulator, groups in parts:
+        if not isinstance(accumulator, SketchAccumulator):
+            continue
+        if bounds is None:
+            bounds = {"method": accumulator.method, "exact": True, accumulator.error_name: 0.0}
+        for group in groups:
+            bounds["exact"] = bounds["exact"] and accumulator.exact(group)
+            bounds[accumulator.error_name] = max(bounds[accumulator.error_name], accumulator.error(group))
+    return bounds
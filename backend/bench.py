@@ -0,0 +1,279 @@
+"""
+Benchmark harness for the analysis API.
+
+Generates a synthetic report and times every chart type x aggregate
+combination, both through ``analyze_data_for_chart`` directly and through
+the HTTP endpoints (in-process via FastAPI's TestClient, or against a running
+server with ``--url``). Results are written as JSON so runs of different
+revisions can be compared with ``--compare``.
+
+Examples::
+
+    python bench.py --rows 100000 --output before.json
+    python bench.py --rows 100000 --output after.json --compare before.json
+    python bench.py --rows 20000 --mode http --url http://localhost:8001
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import jsonio
+from main import ChartConfig, analyze_data_for_chart
+
+AGGREGATES = ["COUNT", "SUM", "AVG", "MIN", "MAX", "MEDIAN", "MODE", "PERCENTAGE", "DISTINCT_COUNT"]
+AGGREGATED_CHART_TYPES = ["bar_chart", "pie_chart", "line_chart", "grouped_bar_chart"]
+POINT_CHART_TYPES = ["line_chart", "xy_chart", "scatter_chart"]
+
+
+def generate_report(rows: int, cardinality: int = 50, null_rate: float = 0.0, string_columns: int = 3,
+                    numeric_columns: int = 3, date_columns: int = 1, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    Synthetic report rows.
+
+    Columns are named ``str_<i>`` (strings with ``cardinality`` distinct
+    values), ``num_<i>`` (floats, every other column integer valued) and
+    ``date_<i>`` (``%Y-%m-%d`` strings over ``cardinality`` days). Each value
+    is None with probability ``null_rate``.
+    """
+    rng = random.Random(seed)
+    categories = [f"value_{i}" for i in range(max(1, cardinality))]
+    start = date(2024, 1, 1)
+    days = [(start + timedelta(days=i)).isoformat() for i in range(max(1, cardinality))]
+
+    def maybe_null(value):
+        return None if null_rate and rng.random() < null_rate else value
+
+    report = []
+    for _ in range(rows):
+        row = {}
+        for i in range(string_columns):
+            row[f"str_{i}"] = maybe_null(rng.choice(categories))
+        for i in range(numeric_columns):
+            value = rng.uniform(0, 1000)
+            row[f"num_{i}"] = maybe_null(round(value) if i % 2 else round(value, 2))
+        for i in range(date_columns):
+            row[f"date_{i}"] = maybe_null(rng.choice(days))
+        report.append(row)
+    return report
+
+
+def benchmark_cases(report: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One chart config per chart type x aggregate combination the report's columns allow"""
+    columns = list(report[0].keys()) if report else []
+    strings = [c for c in columns if c.startswith("str_")]
+    numbers = [c for c in columns if c.startswith("num_")]
+    dates = [c for c in columns if c.startswith("date_")]
+    category = strings[0] if strings else None
+    series = strings[1] if len(strings) > 1 else category
+    value = numbers[0] if numbers else None
+    x_column = dates[0] if dates else (numbers[1] if len(numbers) > 1 else value)
+
+    cases = []
+    for chart_type in AGGREGATED_CHART_TYPES:
+        group = dates[0] if chart_type == "line_chart" and dates else category
+        if group is None:
+            continue
+        for aggregate in AGGREGATES:
+            aggregate_column = value if aggregate not in ("COUNT", "DISTINCT_COUNT") else "all"
+            if aggregate == "DISTINCT_COUNT":
+                aggregate_column = series
+            if aggregate_column is None:
+                continue
+            config = {"chart_type": chart_type, "aggregate": aggregate, "aggregate_column": aggregate_column}
+            if chart_type == "grouped_bar_chart":
+                config.update(group_column=category, series_column=series)
+            else:
+                config["column"] = group
+            cases.append(config)
+    if x_column and value:
+        for chart_type in POINT_CHART_TYPES:
+            cases.append({"chart_type": chart_type, "x_column": x_column, "y_column": value})
+    return cases
+
+
+def _time(fn: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    runs = []
+    error = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        try:
+            outcome = fn()
+        except Exception as e:
+            error = str(e)
+            break
+        runs.append((time.perf_counter() - started) * 1000)
+        if isinstance(outcome, dict) and outcome.get("error"):
+            error = outcome["error"]
+    entry: Dict[str, Any] = {"runs_ms": [round(run, 3) for run in runs]}
+    if runs:
+        entry["min_ms"] = round(min(runs), 3)
+        entry["median_ms"] = round(statistics.median(runs), 3)
+    if error:
+        entry["error"] = error
+    return entry
+
+
+def _case_name(config: Dict[str, Any]) -> str:
+    return f"{config['chart_type']}:{config.get('aggregate') or '-'}"
+
+
+def bench_direct(report: List[Dict[str, Any]], cases: List[Dict[str, Any]], repeat: int) -> List[Dict[str, Any]]:
+    """Time analyze_data_for_chart on the row dicts, one chart per call"""
+    results = []
+    for config in cases:
+        chart_config = ChartConfig(**config)
+        entry = _time(lambda: analyze_data_for_chart(report, chart_config), repeat)
+        results.append({"case": _case_name(config), "mode": "direct", "config": config, **entry})
+    return results
+
+
+class _HTTPClient:
+    """POSTs JSON to a running server, or to the app in-process when url is None"""
+
+    def __init__(self, url: Optional[str] = None):
+        self.url = url.rstrip("/") if url else None
+        self._client = None
+        if self.url is None:
+            from fastapi.testclient import TestClient
+            from main import app
+            self._client = TestClient(app)
+
+    def request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        body = jsonio.dumps(payload) if payload is not None else None
+        if self._client is not None:
+            response = self._client.request(method, path, content=body, headers={"Content-Type": "application/json"})
+            content = response.content
+            status = response.status_code
+        else:
+            request = urllib.request.Request(self.url + path, data=body, method=method,
+                                             headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request) as response:
+                    content, status = response.read(), response.status
+            except urllib.error.HTTPError as e:
+                content, status = e.read(), e.code
+        parsed = jsonio.loads(content) if content else {}
+        if status >= 400:
+            raise RuntimeError(f"HTTP {status}: {parsed.get('detail', parsed)}")
+        return parsed
+
+
+def bench_http(report: List[Dict[str, Any]], cases: List[Dict[str, Any]], repeat: int,
+               url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Time POST /api/analyze per chart, once with the rows inline and once by
+    dataset_id (result cache cleared before every run, so charts are computed)
+    """
+    client = _HTTPClient(url)
+    results = []
+
+    upload = _time(lambda: client.request("POST", "/api/datasets", {"report_data": report}), 1)
+    results.append({"case": "upload", "mode": "http", **upload})
+    dataset_id = client.request("POST", "/api/datasets", {"report_data": report})["dataset_id"]
+
+    def first_chart(response):
+        return response["charts"][0]
+
+    for config in cases:
+        inline = _time(lambda: first_chart(client.request(
+            "POST", "/api/analyze", {"report_data": report, "chart_configs": [config]})), repeat)
+        results.append({"case": _case_name(config), "mode": "http", "config": config, **inline})
+
+        def stored():
+            client.request("DELETE", f"/api/cache?dataset_id={dataset_id}")
+            return first_chart(client.request("POST", "/api/analyze", {"dataset_id": dataset_id, "chart_configs": [config]}))
+        by_id = _time(stored, repeat)
+        results.append({"case": _case_name(config), "mode": "http_dataset", "config": config, **by_id})
+
+    batch = _time(lambda: client.request("POST", "/api/analyze", {"report_data": report, "chart_configs": cases}), repeat)
+    results.append({"case": "all_charts", "mode": "http", **batch})
+    return results
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Lines comparing median times of matching cases (ratio > 1 means slower now)"""
+    previous = {(r["case"], r["mode"]): r for r in baseline.get("results", [])}
+    lines = []
+    for result in current["results"]:
+        before = previous.get((result["case"], result["mode"]))
+        if not before or "median_ms" not in before or "median_ms" not in result:
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+        lines.append(f"{result['mode']:<13} {result['case']:<32} {before['median_ms']:>10.2f} ms -> "
+                     f"{result['median_ms']:>10.2f} ms  x{ratio:.2f}")
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Benchmark chart analysis")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--cardinality", type=int, default=50, help="distinct values per string/date column")
+    parser.add_argument("--null-rate", type=float, default=0.0, help="probability of a None value")
+    parser.add_argument("--string-columns", type=int, default=3)
+    parser.add_argument("--numeric-columns", type=int, default=3)
+    parser.add_argument("--date-columns", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--mode", choices=["direct", "http", "all"], default="all")
+    parser.add_argument("--url", help="benchmark a running server instead of the app in-process")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    params = {key: getattr(args, key) for key in
+              ("rows", "cardinality", "null_rate", "string_columns", "numeric_columns", "date_columns", "seed", "repeat")}
+    report = generate_report(args.rows, args.cardinality, args.null_rate, args.string_columns,
+                             args.numeric_columns, args.date_columns, args.seed)
+    cases = benchmark_cases(report)
+
+    results = []
+    if args.mode in ("direct", "all"):
+        results += bench_direct(report, cases, args.repeat)
+    if args.mode in ("http", "all"):
+        results += bench_http(report, cases, args.repeat, args.url)
+
+    output = {
+        "meta": {
+            "revision": _revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "url": args.url,
+            "params": params,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    for result in results:
+        timing = f"{result['median_ms']:>10.2f} ms" if "median_ms" in result else "    failed"
+        print(f"{result['mode']:<13} {result['case']:<32} {timing}  {result.get('error', '')}")
+    if args.compare:
+        with open(args.compare) as f:
+            print("\nCompared to", args.compare)
+            print("\n".join(compare(output, json.load(f))))
+    return output
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+"""
+Compressed row sets for filter predicates.
+
+``RowBitmap`` is a set of row numbers split, like a Roaring bitmap, into
+chunks of ``2 ** 16`` rows. Each chunk holds one container:
+
+- sparse chunks (at most ``ARRAY_MAX`` rows) a sorted ``uint16`` array of
+  the rows' low bits,
+- dense chunks a 1024-word ``uint64`` bitmap (8 KB, whatever the count).
+
+Empty chunks are not stored. AND and OR work chunk by chunk on whichever
+containers meet, so combining a selective predicate with a broad one costs
+about the size of the selective one, and clustered selections (a date range
+over rows appended in time order) only touch the chunks they cover.
+"""
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+# A sorted array of more rows than this is larger than the chunk's bitmap
+ARRAY_MAX = 4096
+_WORDS = CHUNK_SIZE // 64
+
+
+def _popcount(words: np.ndarray) -> int:
+    return int(np.count_nonzero(np.unpackbits(words.view(np.uint8))))
+
+
+def _to_words(low: np.ndarray) -> np.ndarray:
+    mask = np.zeros(CHUNK_SIZE, dtype=bool)
+    mask[low] = True
+    return np.packbits(mask, bitorder="little").view(np.uint64)
+
+
+def _to_low(words: np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder="little")).astype(np.uint16)
+
+
+def _contains(words: np.ndarray, low: np.ndarray) -> np.ndarray:
+    """Mask of the low bits set in a bitmap container"""
+    shifts = (low & 63).astype(np.uint64)
+    return ((words[low >> 6] >> shifts) & np.uint64(1)).astype(bool)
+
+
+def _container(low: np.ndarray):
+    """Best container for sorted, unique low bits (None when empty)"""
+    if len(low) == 0:
+        return None
+    return low if len(low) <= ARRAY_MAX else _to_words(low)
+
+
+def _bitmap_container(words: np.ndarray):
+    """A computed bitmap container, turned into an array when sparse enough"""
+    count = _popcount(words)
+    if count == 0:
+        return None
+    return _to_low(words) if count <= ARRAY_MAX else words
+
+
+def _is_bitmap(container: np.ndarray) -> bool:
+    return container.dtype == np.uint64
+
+
+class RowBitmap:
+    """Set of row numbers of a dataset with num_rows rows"""
+
+    __slots__ = ("num_rows", "chunks")
+
+    def __init__(self, num_rows: int, chunks: Optional[Dict[int, np.ndarray]] = None):
+        self.num_rows = num_rows
+        # Chunk number -> container, in ascending chunk order
+        self.chunks: Dict[int, np.ndarray] = chunks or {}
+
+    @classmethod
+    def from_rows(cls, rows: np.ndarray, num_rows: int) -> "RowBitmap":
+        """Bitmap of sorted, unique row numbers"""
+        rows = np.asarray(rows, dtype=np.int64)
+        chunks = {}
+        if len(rows):
+            high = rows >> CHUNK_BITS
+            bounds = np.flatnonzero(np.diff(high)) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [len(rows)]))
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                chunks[int(high[start])] = _container((rows[start:end] & (CHUNK_SIZE - 1)).astype(np.uint16))
+        return cls(num_rows, chunks)
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray) -> "RowBitmap":
+        return cls.from_rows(np.flatnonzero(mask), len(mask))
+
+    @classmethod
+    def full(cls, num_rows: int) -> "RowBitmap":
+        return cls.from_rows(np.arange(num_rows, dtype=np.int64), num_rows)
+
+    @classmethod
+    def union(cls, bitmaps: Iterable["RowBitmap"], num_rows: int) -> "RowBitmap":
+        result = cls(num_rows)
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    def __len__(self) -> int:
+        return sum(_popcount(c) if _is_bitmap(c) else len(c) for c in self.chunks.values())
+
+    def __and__(self, other: "RowBitmap") -> "RowBitmap":
+        chunks = {}
+        for key in sorted(self.chunks.keys() & other.chunks.keys()):
+            a, b = self.chunks[key], other.chunks[key]
+            if _is_bitmap(a) and _is_bitmap(b):
+                container = _bitmap_container(a & b)
+            elif _is_bitmap(a):
+                container = _container(b[_contains(a, b)])
+            elif _is_bitmap(b):
+                container = _container(a[_contains(b, a)])
+            else:
+                container = _container(np.intersect1d(a, b, assume_unique=True))
+            if container is not None:
+                chunks[key] = container
+        return RowBitmap(self.num_rows, chunks)
+
+    def __or__(self, other: "RowBitmap") -> "RowBitmap":
+        chunks = {}
+        for key in sorted(self.chunks.keys() | other.chunks.keys()):
+            a, b = self.chunks.get(key), other.chunks.get(key)
+            if a is None or b is None:
+                chunks[key] = a if b is None else b
+            elif _is_bitmap(a) or _is_bitmap(b):
+                words = (a if _is_bitmap(a) else _to_words(a)) | (b if _is_bitmap(b) else _to_words(b))
+                chunks[key] = words
+            else:
+                chunks[key] = _container(np.union1d(a, b))
+        return RowBitmap(self.num_rows, chunks)
+
+    def to_rows(self) -> np.ndarray:
+        """Sorted row numbers"""
+        if not self.chunks:
+            return np.empty(0, dtype=np.int64)
+        parts = []
+        for key, container in self.chunks.items():
+            low = _to_low(container) if _is_bitmap(container) else container
+            parts.append(low.astype(np.int64) + (key << CHUNK_BITS))
+        return np.concatenate(parts)
+
+    def to_mask(self) -> np.ndarray:
+        mask = np.zeros(self.num_rows, dtype=bool)
+        mask[self.to_rows()] = True
+        return mask
+
+    @property
+    def nbytes(self) -> int:
+        return sum(container.nbytes for container in self.chunks.values())
@@ -0,0 +1,130 @@
+"""
+Cache of computed chart results.
+
+Users flip between the same few chart configurations, and every switch used
+to re-aggregate the whole dataset. Results are cached per (dataset content
+hash, normalised ``ChartConfig``) in an LRU bounded by an approximate byte
+budget (``RESULT_CACHE_MAX_BYTES``, default 64 MB). With a shared cache (see
+shared), results are also published for the other worker processes, and a
+local miss is looked up there before the chart is recomputed.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import jsonio
+from shared import SharedCache, shared_cache
+
+CacheKey = Tuple[str, str]
+
+
+def config_key(config) -> str:
+    """Normalised, order-independent form of a ChartConfig"""
+    fields = config.model_dump()
+    fields["chart_type"] = (fields.get("chart_type") or "").lower()
+    if fields.get("aggregate"):
+        fields["aggregate"] = fields["aggregate"].upper()
+    return jsonio.dumps(fields, sort_keys=True).decode("utf-8")
+
+
+def result_size(result: Dict[str, Any]) -> int:
+    """Approximate size of a chart result, as its JSON length"""
+    return len(jsonio.dumps(result))
+
+
+class ResultCache:
+    """Thread-safe LRU of chart results with a byte budget"""
+
+    def __init__(self, max_bytes: int, shared: Optional[SharedCache] = None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._entries: "OrderedDict[CacheKey, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, dataset_hash: str, config) -> Optional[Dict[str, Any]]:
+        key = (dataset_hash, config_key(config))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            result = self.shared.get_result(*key) if self.shared is not None else None
+            with self._lock:
+                if result is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+            entry = (result, result_size(result))
+            self._store(key, *entry)
+        # Shallow copy so callers can't alter the cached chart's top-level fields
+        return dict(entry[0])
+
+    def contains(self, dataset_hash: str, config) -> bool:
+        """True when a result is cached (here or in the shared cache), without counting a hit or miss"""
+        key = (dataset_hash, config_key(config))
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.shared is not None and os.path.exists(self.shared.result_path(*key))
+
+    def put(self, dataset_hash: str, config, result: Dict[str, Any]) -> None:
+        content = jsonio.dumps(result)
+        key = (dataset_hash, config_key(config))
+        if self.shared is not None:
+            self.shared.put_result(*key, content)
+        self._store(key, result, len(content))
+
+    def _store(self, key: CacheKey, result: Dict[str, Any], size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, dataset_hash: Optional[str] = None) -> int:
+        """
+        Drop the results of one dataset, or everything; returns the number
+        removed (from the shared cache too, when there is one)
+        """
+        shared = self.shared.invalidate(dataset_hash) if self.shared is not None else 0
+        return max(shared, self._invalidate_local(dataset_hash))
+
+    def _invalidate_local(self, dataset_hash: Optional[str]) -> int:
+        with self._lock:
+            if dataset_hash is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                self._bytes = 0
+                return removed
+            keys = [key for key in self._entries if key[0] == dataset_hash]
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[1]
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+result_cache = ResultCache(max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+                           shared=shared_cache)
@@ -0,0 +1,444 @@
+"""
+Typed columnar form of a report.
+
+The API receives report data as a list of row dicts. Every chart used to scan
+that list with ``row.get(...)`` and coerce values with ``float(...)`` on its
+own, so a dashboard with N charts paid for N full scans. ``ColumnarDataset``
+converts each column once (on first use) into NumPy arrays that all charts of
+a request share:
+
+- ``codes`` / ``categories``: dictionary encoding of ``str(value)``, the key
+  the chart branches group by (a missing key encodes as ``""``)
+- ``present``: null mask, True where the value is not None
+- ``numbers`` / ``numeric``: float coercion of the value and the mask of rows
+  where that coercion succeeded
+- ``strings``: True where the raw value is a string
+
+Columns can also be built straight from typed arrays (Arrow/Parquet uploads)
+and saved as ``.npy`` files that are opened memory-mapped, so datasets are
+shared zero-copy between requests and worker processes.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+# Per-row arrays of a Column, in the order they are saved
+ARRAY_FIELDS = ("codes", "present", "numbers", "numeric", "strings")
+
+
+class _Missing:
+    """Placeholder for a key that is absent from a row (stringifies to "")."""
+
+    def __str__(self):
+        return ""
+
+    def __repr__(self):
+        return "<missing>"
+
+
+MISSING = _Missing()
+
+
+def _to_number(value: Any, cache: Dict[str, Any]):
+    """Coerce a raw value the same way the chart branches do: ``float(value)``"""
+    if isinstance(value, (int, float)):
+        return value
+    if value is None or value is MISSING:
+        return None
+    if isinstance(value, str):
+        if value in cache:
+            return cache[value]
+        try:
+            number = float(value)
+        except (ValueError, TypeError):
+            number = None
+        cache[value] = number
+        return number
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _first_appearance(codes: np.ndarray, categories: List[str]):
+    """Codes and categories with the unused categories dropped and the rest in order of first appearance"""
+    used, first_rows = np.unique(codes, return_index=True)
+    order = used[np.argsort(first_rows)]
+    renumber = np.zeros(len(categories), dtype=np.int32)
+    renumber[order] = np.arange(len(order), dtype=np.int32)
+    return renumber[codes], [categories[code] for code in order.tolist()]
+
+
+class _MappedArray:
+    """Pickled stand-in for a memory-mapped array: the file it maps"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+
+class Column:
+    """A single report column in typed, dictionary-encoded form"""
+
+    def __init__(
+        self,
+        name: str,
+        codes: np.ndarray,
+        categories: List[str],
+        present: np.ndarray,
+        numbers: np.ndarray,
+        numeric: np.ndarray,
+        strings: np.ndarray,
+        integral: bool = False,
+    ):
+        self.name = name
+        self.codes = codes
+        self.categories = categories
+        self.present = present
+        self.numbers = numbers
+        self.numeric = numeric
+        self.strings = strings
+        # True when every numeric value came from a Python int, so results
+        # such as SUM/MIN/MAX can be reported as ints like before
+        self.integral = integral
+        # Data derived from the column (parsed dates, indexes, ...), cached
+        # for as long as the column lives
+        self.derived: Dict[Any, Any] = {}
+        self._empty_code = None
+
+    @classmethod
+    def from_values(cls, name: str, values: List[Any]) -> "Column":
+        """Build a column from raw values (``MISSING`` marks absent keys)"""
+        n = len(values)
+
+        lookup: Dict[str, int] = {}
+        codes = np.fromiter(
+            (lookup.setdefault(key, len(lookup)) for key in map(str, values)),
+            dtype=np.int32,
+            count=n,
+        )
+        categories = list(lookup)
+
+        present = np.fromiter(
+            (value is not None and value is not MISSING for value in values),
+            dtype=bool,
+            count=n,
+        )
+        strings = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=n)
+
+        cache: Dict[str, Any] = {}
+        converted = [_to_number(value, cache) for value in values]
+        numeric = np.fromiter((number is not None for number in converted), dtype=bool, count=n)
+        numbers = np.fromiter(
+            (number if number is not None else np.nan for number in converted),
+            dtype=np.float64,
+            count=n,
+        )
+        integral = bool(numeric.any()) and all(
+            isinstance(number, int) for number in converted if number is not None
+        )
+
+        return cls(name, codes, categories, present, numbers, numeric, strings, integral)
+
+    @classmethod
+    def from_numbers(cls, name: str, values: np.ndarray, valid: Optional[np.ndarray] = None) -> "Column":
+        """
+        Build a column from a bool, int or float array (invalid entries are
+        nulls), with the same keys and coercions as from_values on the
+        equivalent Python values
+        """
+        n = len(values)
+        valid = np.ones(n, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        uniques, inverse = np.unique(values[valid], return_inverse=True)
+        codes = np.zeros(n, dtype=np.int32)
+        codes[valid] = inverse.reshape(-1)
+        categories = [str(value) for value in uniques.tolist()]
+        numbers = values.astype(np.float64)
+        numbers[~valid] = np.nan
+        integral = values.dtype.kind in "biu" and bool(valid.any())
+        return cls._with_nulls(name, codes, categories, valid, numbers, valid.copy(), np.zeros(n, dtype=bool), integral)
+
+    @classmethod
+    def from_dictionary(cls, name: str, indices: np.ndarray, dictionary: List[str],
+                        valid: Optional[np.ndarray] = None) -> "Column":
+        """Build a column of strings from a dictionary encoding (invalid entries are nulls)"""
+        n = len(indices)
+        valid = np.ones(n, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        categories = [str(value) for value in dictionary]
+        cache: Dict[str, Any] = {}
+        converted = [_to_number(value, cache) for value in categories]
+        category_numeric = np.array([number is not None for number in converted], dtype=bool)
+        category_numbers = np.array([number if number is not None else np.nan for number in converted], dtype=np.float64)
+        codes = np.where(valid, indices, 0).astype(np.int32)
+        numbers = category_numbers[codes] if categories else np.full(n, np.nan)
+        numeric = (category_numeric[codes] if categories else np.zeros(n, dtype=bool)) & valid
+        numbers[~valid] = np.nan
+        return cls._with_nulls(name, codes, categories, valid, numbers, numeric, valid.copy(), False)
+
+    @classmethod
+    def _with_nulls(cls, name, codes, categories, valid, numbers, numeric, strings, integral) -> "Column":
+        """
+        Give invalid rows the code of "None" (what str(None) keys on) and
+        renumber categories in order of first appearance, like from_values
+        """
+        if not valid.all():
+            try:
+                null_code = categories.index("None")
+            except ValueError:
+                null_code = len(categories)
+                categories.append("None")
+            codes[~valid] = null_code
+        codes, categories = _first_appearance(codes, categories)
+        return cls(name, codes, categories, valid, numbers, numeric, strings, integral)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def take(self, rows: np.ndarray) -> "Column":
+        """
+        Column of the given rows, with only their categories, numbered in
+        order of first appearance like a column built from their values
+        """
+        codes, categories = _first_appearance(self.codes[rows], self.categories)
+        numeric = self.numeric[rows]
+        return Column(self.name, codes, categories, self.present[rows], self.numbers[rows], numeric,
+                      self.strings[rows], self.integral and bool(numeric.any()))
+
+    def __getstate__(self):
+        # Memory-mapped arrays travel as their file name and are mapped
+        # again on unpickling (zero-copy for worker processes)
+        state = self.__dict__.copy()
+        for field in ARRAY_FIELDS:
+            array = state[field]
+            if isinstance(array, np.memmap) and array.filename:
+                state[field] = _MappedArray(array.filename)
+        return state
+
+    def __setstate__(self, state):
+        for field in ARRAY_FIELDS:
+            if isinstance(state[field], _MappedArray):
+                state[field] = np.load(state[field].path, mmap_mode="r")
+        self.__dict__.update(state)
+
+    def save(self, directory: str, prefix: str) -> Dict[str, Any]:
+        """Write the per-row arrays as .npy files; returns what load needs besides them"""
+        for field in ARRAY_FIELDS:
+            np.save(os.path.join(directory, f"{prefix}.{field}.npy"), getattr(self, field))
+        return {"name": self.name, "prefix": prefix, "categories": self.categories, "integral": self.integral}
+
+    @classmethod
+    def load(cls, directory: str, meta: Dict[str, Any]) -> "Column":
+        """Open a saved column with its arrays memory-mapped (read-only)"""
+        arrays = [np.load(os.path.join(directory, f"{meta['prefix']}.{field}.npy"), mmap_mode="r")
+                  for field in ARRAY_FIELDS]
+        return cls(meta["name"], *arrays[:1], meta["categories"], *arrays[1:], integral=meta["integral"])
+
+    def append(self, other: "Column") -> "Column":
+        """
+        Column of this column's rows followed by other's. Categories of this
+        column keep their codes; categories new in other are added after them.
+        """
+        lookup = {category: code for code, category in enumerate(self.categories)}
+        remap = np.array([lookup.setdefault(category, len(lookup)) for category in other.categories], dtype=np.int32)
+        codes = np.concatenate((self.codes, remap[other.codes] if len(other.codes) else other.codes))
+        numeric = np.concatenate((self.numeric, other.numeric))
+        # Ints only if neither side contributed a non-int number
+        integral = bool(numeric.any()) and all(
+            part.integral or not part.numeric.any() for part in (self, other)
+        )
+        return Column(
+            self.name,
+            codes,
+            list(lookup),
+            np.concatenate((self.present, other.present)),
+            np.concatenate((self.numbers, other.numbers)),
+            numeric,
+            np.concatenate((self.strings, other.strings)),
+            integral,
+        )
+
+    @property
+    def empty_code(self) -> int:
+        """Code of the ``""`` category, or -1 when the column has none"""
+        if self._empty_code is None:
+            try:
+                self._empty_code = self.categories.index("")
+            except ValueError:
+                self._empty_code = -1
+        return self._empty_code
+
+    @property
+    def keyed(self) -> np.ndarray:
+        """Mask of rows whose group key ``str(value)`` is non-empty"""
+        if self.empty_code < 0:
+            return np.ones(len(self.codes), dtype=bool)
+        return self.codes != self.empty_code
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the column"""
+        arrays = (self.codes, self.present, self.numbers, self.numeric, self.strings)
+        return sum(a.nbytes for a in arrays) + sum(len(c) + 49 for c in self.categories)
+
+
+class ColumnarDataset:
+    """Report data converted once into per-column arrays.
+
+    Columns are built lazily on first access and then shared by every chart
+    that reads them.
+    """
+
+    def __init__(self, num_rows: int, column_names: List[str], records: Optional[List[Dict]] = None):
+        self.num_rows = num_rows
+        # Column names as reported by the first row, which is what the
+        # frontend and the column validation messages go by
+        self.column_names = column_names
+        self._records = records
+        self._columns: Dict[str, Column] = {}
+        # Columns may be requested from several analysis threads at once
+        self._lock = threading.Lock()
+        # Content hash of the data when known (stored datasets), used as cache key
+        self.fingerprint: Optional[str] = None
+        # Group-by results kept across requests (stored datasets), see planner
+        self.views = None
+        # Directory the column arrays are memory-mapped from, see open
+        self.directory: Optional[str] = None
+        # Column types and statistics, see profiling
+        self.profile: Optional[Dict[str, Any]] = None
+        # (dataset, rows) this dataset is a row subset of, see take
+        self._source = None
+
+    @classmethod
+    def from_records(cls, records: List[Dict[str, Any]]) -> "ColumnarDataset":
+        first = records[0] if records and isinstance(records[0], dict) else {}
+        return cls(len(records), list(first.keys()), records)
+
+    @classmethod
+    def from_columns(cls, columns: Iterable[Column], num_rows: int,
+                     column_names: Optional[List[str]] = None) -> "ColumnarDataset":
+        columns = list(columns)
+        dataset = cls(num_rows, column_names if column_names is not None else [c.name for c in columns])
+        for column in columns:
+            dataset._columns[column.name] = column
+        return dataset
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def column(self, name: str) -> Column:
+        column = self._columns.get(name)
+        if column is None:
+            with self._lock:
+                column = self._columns.get(name)
+                if column is None:
+                    if self._source is not None:
+                        source, rows = self._source
+                        column = source.column(name).take(rows)
+                    elif self._records is not None:
+                        column = Column.from_values(name, [row.get(name, MISSING) for row in self._records])
+                    else:
+                        # Materialised dataset: the column is absent from every row
+                        column = Column.from_values(name, [MISSING] * self.num_rows)
+                    self._columns[name] = column
+        return column
+
+    def select(self, names: Iterable[str]) -> "ColumnarDataset":
+        """
+        Dataset holding only the given columns (built now if needed) and no
+        row dicts, cheap to pickle for a worker process
+        """
+        dataset = ColumnarDataset(self.num_rows, self.column_names)
+        dataset.fingerprint = self.fingerprint
+        for name in dict.fromkeys(names):
+            dataset._columns[name] = self.column(name)
+        return dataset
+
+    def take(self, rows: np.ndarray) -> "ColumnarDataset":
+        """Dataset of the given rows (sorted row numbers); its columns are sliced from this one's when first read"""
+        dataset = ColumnarDataset(len(rows), self.column_names)
+        dataset._source = (self, rows)
+        return dataset
+
+    def append(self, other: "ColumnarDataset") -> "ColumnarDataset":
+        """New dataset with other's rows after this one's (both are materialised first)"""
+        self.materialize()
+        other.materialize()
+        names = dict.fromkeys(self._columns)
+        names.update(dict.fromkeys(other._columns))
+        columns = [self.column(name).append(other.column(name)) for name in names]
+        dataset = ColumnarDataset(self.num_rows + other.num_rows,
+                                  self.column_names if self.num_rows else other.column_names)
+        for column in columns:
+            dataset._columns[column.name] = column
+        return dataset
+
+    @property
+    def columns(self) -> List[Column]:
+        """The columns built so far (every column, once materialised)"""
+        return list(self._columns.values())
+
+    @property
+    def materialized(self) -> bool:
+        """True when every column is built and the row dicts are released"""
+        return self._records is None
+
+    def sample_rows(self, size: int) -> "ColumnarDataset":
+        """Dataset of ``size`` evenly spaced rows, taken from the row dicts (not materialised)"""
+        if self._records is None:
+            raise ValueError("sample_rows needs the row dicts of a dataset that is not materialised")
+        indexes = np.linspace(0, self.num_rows - 1, min(size, self.num_rows)).astype(np.int64)
+        return ColumnarDataset.from_records([self._records[index] for index in indexes.tolist()])
+
+    def raw_keys(self, name: str) -> Iterator[str]:
+        """``str()`` of a column's non-null values, straight from the row dicts (not materialised)"""
+        if self._records is None:
+            raise ValueError("raw_keys needs the row dicts of a dataset that is not materialised")
+        for row in self._records:
+            value = row.get(name)
+            if value is not None:
+                yield str(value)
+
+    def materialize(self) -> "ColumnarDataset":
+        """Build every column now and release the row dicts"""
+        if self._records is not None:
+            names = dict.fromkeys(self.column_names)
+            for row in self._records:
+                names.update(dict.fromkeys(row))
+            for name in names:
+                self.column(name)
+            self._records = None
+        return self
+
+    def save(self, directory: str) -> None:
+        """Write every column to a directory (materialising the dataset first)"""
+        self.materialize()
+        os.makedirs(directory, exist_ok=True)
+        columns = [column.save(directory, f"c{index}") for index, column in enumerate(self._columns.values())]
+        meta = {"num_rows": self.num_rows, "column_names": self.column_names, "columns": columns}
+        with open(os.path.join(directory, "dataset.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def open(cls, directory: str) -> "ColumnarDataset":
+        """Dataset saved with save, its column arrays memory-mapped"""
+        with open(os.path.join(directory, "dataset.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        dataset = cls.from_columns((Column.load(directory, column) for column in meta["columns"]), meta["num_rows"],
+                                   meta["column_names"])
+        dataset.directory = directory
+        return dataset
+
+    @property
+    def nbytes(self) -> int:
+        return sum(c.nbytes for c in self._columns.values())
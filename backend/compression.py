@@ -0,0 +1,177 @@
+"""
+Negotiated response compression (brotli or gzip).
+
+Chart payloads, point arrays in particular, are large and very repetitive,
+so they shrink several times over. ``CompressionMiddleware`` picks the
+encoding from the request's Accept-Encoding header (brotli preferred, when
+the optional ``brotli`` package is installed) and compresses:
+
+- complete responses of at least ``minimum_size`` bytes in one go,
+- streamed responses (NDJSON/SSE charts) chunk by chunk, flushing after
+  every chunk so each chart still reaches the client as soon as it is sent.
+
+Only text-like content types (JSON, NDJSON, SSE, text) are compressed, and
+responses that already have a Content-Encoding are left alone.
+
+Configuration (environment variables):
+
+- ``COMPRESSION_MIN_BYTES``: smallest complete response that is compressed (default 1024)
+- ``COMPRESSION_GZIP_LEVEL``: gzip level (default 6)
+- ``COMPRESSION_BROTLI_QUALITY``: brotli quality (default 5)
+"""
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # optional dependency, see requirements.txt
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """``br``, ``gzip`` or None, by the client's Accept-Encoding q-values (brotli wins ties)"""
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [(weights.get(name, weights.get("*", 0.0)), -rank, name) for rank, name in enumerate(available)]
+    weight, _, name = max(candidates)
+    return name if weight > 0 else None
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+            self._zlib = None
+        else:
+            self._brotli = None
+            # wbits 16 + 15: gzip container
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        """Compressed data, flushed so the client can decode everything sent so far"""
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing text-like responses with brotli or gzip"""
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self))
+
+
+class _CompressingSend:
+    """The send callable of one response, compressing its body on the way out"""
+
+    def __init__(self, send, encoding: str, options: CompressionMiddleware):
+        self.send = send
+        self.encoding = encoding
+        self.options = options
+        self.start: Optional[dict] = None
+        self.compressor: Optional[_Compressor] = None
+        # False once the response turned out not to be compressed
+        self.active = True
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = start.get("headers", [])
+            if not self._compressible(headers) or (not more_body and len(body) < self.options.minimum_size):
+                self.active = False
+                await self.send(start)
+            else:
+                self.compressor = _Compressor(self.encoding, self.options.gzip_level, self.options.brotli_quality)
+                if not more_body:
+                    body = self.compressor.chunk(body) + self.compressor.finish()
+                start = {**start, "headers": self._headers(headers, None if more_body else len(body))}
+                await self.send(start)
+                if not more_body:
+                    await self.send({"type": "http.response.body", "body": body})
+                else:
+                    await self.send({"type": "http.response.body", "body": self.compressor.chunk(body), "more_body": True})
+                return
+
+        if not self.active:
+            await self.send(message)
+            return
+        data = self.compressor.chunk(body) if body else b""
+        if not more_body:
+            data += self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    @staticmethod
+    def _compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+        content_type = b""
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == b"content-encoding":
+                return False
+            if lowered == b"content-type":
+                content_type = value.lower()
+        return any(content_type.startswith(kind.encode("ascii")) for kind in COMPRESSIBLE_TYPES)
+
+    def _headers(self, headers: List[Tuple[bytes, bytes]], length: Optional[int]) -> List[Tuple[bytes, bytes]]:
+        result = [(name, value) for name, value in headers if name.lower() not in (b"content-length", b"vary")]
+        vary = [value for name, value in headers if name.lower() == b"vary"]
+        result.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        result.append((b"content-encoding", self.encoding.encode("ascii")))
+        if length is not None:
+            result.append((b"content-length", str(length).encode("ascii")))
+        return result
+
+
+def compression_options() -> Dict[str, int]:
+    """Middleware options from the environment"""
+    return {
+        "minimum_size": int(os.getenv("COMPRESSION_MIN_BYTES", "1024")),
+        "gzip_level": int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")),
+        "brotli_quality": int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5")),
+    }
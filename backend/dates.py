@@ -0,0 +1,269 @@
+"""
+Date inference and parsing for report columns.
+
+Chart branches used to call ``datetime.strptime`` per row, trying several
+formats in turn until one matched. Here a column's format is inferred once
+from a sample of its values and the column is parsed in bulk:
+
+- strings are parsed per distinct value (columns are dictionary encoded),
+- ISO dates/datetimes in the inferred format go through NumPy's vectorised
+  ``datetime64`` parser,
+- only values the inferred format can't handle fall back to trying the other
+  formats with ``strptime`` one by one.
+
+Results are cached on the column, so every chart over the same dataset
+column reuses them. Timestamps are POSIX seconds for naive local times, as
+``datetime.timestamp()`` returns.
+
+``bucket_column`` truncates a column's dates to a time bucket (minute, hour,
+day, week, month or quarter), again per distinct value, for charts that
+group on the bucket rather than on the exact value.
+"""
+import re
+import time
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from columnar import Column
+
+# Formats recognised for date-like x values, in order of preference
+DATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%d-%b-%Y",  # 01-Feb-2026
+    "%d/%b/%Y",
+    "%d/%m/%Y",
+    "%m/%d/%Y",
+]
+
+# Formats NumPy can parse in bulk, with the exact shape strptime would accept
+_VECTORISED_FORMATS = {
+    "%Y-%m-%d": re.compile(r"\d{4}-\d{2}-\d{2}"),
+    "%Y-%m-%d %H:%M:%S": re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}"),
+}
+
+# Buckets dates can be truncated to, finest first; weeks start on Monday
+TIME_BUCKETS = ("minute", "hour", "day", "week", "month", "quarter")
+_BUCKET_UNITS = {"minute": "m", "hour": "h", "day": "D", "month": "M"}
+
+# Number of distinct values looked at when inferring a column's format
+INFERENCE_SAMPLE_SIZE = 100
+
+
+def _strptime_timestamp(value: str, fmt: str) -> float:
+    try:
+        return datetime.strptime(value, fmt).timestamp()
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def infer_date_format(samples: Sequence[str], formats: Sequence[str] = DATE_FORMATS) -> Optional[str]:
+    """Format that parses the most samples (earlier formats win ties), or None"""
+    best_format, best_count = None, 0
+    for fmt in formats:
+        count = sum(1 for value in samples if not np.isnan(_strptime_timestamp(value, fmt)))
+        if count > best_count:
+            best_format, best_count = fmt, count
+    return best_format
+
+
+def _parse_vectorised(values: List[str], fmt: str) -> np.ndarray:
+    """Bulk-parse values in an ISO format; NaN where a value doesn't match it"""
+    result = np.full(len(values), np.nan)
+    pattern = _VECTORISED_FORMATS[fmt]
+    matching = [index for index, value in enumerate(values) if pattern.fullmatch(value)]
+    if not matching:
+        return result
+    candidates = [values[index] for index in matching]
+    try:
+        seconds = np.array(candidates, dtype="datetime64[s]").astype(np.int64).astype(np.float64)
+    except ValueError:
+        # An out-of-range date (e.g. 2026-02-30) somewhere; let strptime sort it out
+        result[matching] = [_strptime_timestamp(value, fmt) for value in candidates]
+        return result
+    if time.daylight:
+        # Local time has DST, so the UTC offset varies; convert value by value
+        seconds = np.array([datetime.strptime(value, fmt).timestamp() for value in candidates])
+    else:
+        seconds += time.timezone
+    result[matching] = seconds
+    return result
+
+
+def parse_dates(values: Sequence[str], formats: Sequence[str] = DATE_FORMATS,
+                preferred: Optional[str] = None) -> np.ndarray:
+    """
+    Parse strings into POSIX timestamps, NaN where no format matches.
+
+    Every value is parsed with the preferred format first (in bulk where
+    possible); values that fail fall back to the remaining formats in order.
+    """
+    values = list(values)
+    order = list(formats)
+    if preferred:
+        order = [preferred] + [fmt for fmt in order if fmt != preferred]
+    if not order:
+        return np.full(len(values), np.nan)
+
+    first = order[0]
+    if first in _VECTORISED_FORMATS:
+        result = _parse_vectorised(values, first)
+    else:
+        result = np.array([_strptime_timestamp(value, first) for value in values], dtype=np.float64)
+
+    # Per-value fallback for outliers the main format didn't handle
+    for index in np.flatnonzero(np.isnan(result)).tolist():
+        for fmt in order[1:]:
+            timestamp = _strptime_timestamp(values[index], fmt)
+            if not np.isnan(timestamp):
+                result[index] = timestamp
+                break
+    return result
+
+
+def date_samples(column: Column) -> List[str]:
+    """The first distinct non-empty strings of a column, in order of appearance (cached on the column)"""
+    cache = column.derived
+    if "date_samples" not in cache:
+        codes, first_rows = np.unique(column.codes[column.strings], return_index=True)
+        samples = [column.categories[code] for code in codes[np.argsort(first_rows)].tolist()]
+        cache["date_samples"] = [value for value in samples if value][:INFERENCE_SAMPLE_SIZE]
+    return cache["date_samples"]
+
+
+def column_date_format(column: Column, formats: Sequence[str] = DATE_FORMATS) -> Optional[str]:
+    """Inferred date format of a column's string values (cached on the column)"""
+    cache = column.derived
+    key = ("date_format", tuple(formats))
+    if key not in cache:
+        cache[key] = infer_date_format(date_samples(column), formats)
+    return cache[key]
+
+
+def date_sample_share(column: Column, formats: Sequence[str] = DATE_FORMATS) -> float:
+    """Share of a column's date samples that parse as dates (0 when it has none)"""
+    samples = date_samples(column)
+    if not samples:
+        return 0.0
+    parsed = parse_dates(samples, formats, column_date_format(column, formats))
+    return float(np.count_nonzero(~np.isnan(parsed))) / len(samples)
+
+
+def column_dates(column: Column, formats: Sequence[str] = DATE_FORMATS) -> np.ndarray:
+    """
+    Timestamp of every category of a column (NaN where it isn't a date).
+
+    Index the result with ``column.codes`` to get per-row timestamps. Only
+    categories that came from string values are parsed.
+    """
+    cache = column.derived
+    key = ("dates", tuple(formats))
+    if key not in cache:
+        result = np.full(len(column.categories), np.nan)
+        string_codes = np.unique(column.codes[column.strings])
+        if len(string_codes):
+            preferred = column_date_format(column, formats)
+            parsed = parse_dates([column.categories[code] for code in string_codes.tolist()], formats, preferred)
+            result[string_codes] = parsed
+        cache[key] = result
+    return cache[key]
+
+
+def time_bucket(name: str) -> str:
+    """Normalised name of a time bucket; ValueError for an unknown one"""
+    bucket = (name or "").lower()
+    if bucket not in TIME_BUCKETS:
+        raise ValueError(f"Unknown time_bucket '{name}'. Use one of: {', '.join(TIME_BUCKETS)}")
+    return bucket
+
+
+def bucket_nests(fine: str, coarse: str) -> bool:
+    """True when every fine bucket lies within a single coarse bucket (weeks straddle months)"""
+    if fine == "week":
+        return coarse == "week"
+    return TIME_BUCKETS.index(fine) <= TIME_BUCKETS.index(coarse)
+
+
+def local_datetimes(timestamps: np.ndarray) -> np.ndarray:
+    """Naive local ``datetime64[s]`` of POSIX timestamps (NaT for NaN), the inverse of parse_dates"""
+    result = np.full(len(timestamps), np.datetime64("NaT"), dtype="datetime64[s]")
+    valid = ~np.isnan(timestamps)
+    if time.daylight:
+        # Local time has DST, so the UTC offset varies; convert value by value
+        result[valid] = [np.datetime64(datetime.fromtimestamp(value), "s") for value in timestamps[valid].tolist()]
+    else:
+        result[valid] = (np.round(timestamps[valid]) - time.timezone).astype(np.int64).astype("datetime64[s]")
+    return result
+
+
+def truncate_dates(datetimes: np.ndarray, bucket: str) -> np.ndarray:
+    """Start of the time bucket of every ``datetime64`` (NaT stays NaT), as ``datetime64[s]``"""
+    if bucket == "week":
+        days = datetimes.astype("datetime64[D]")
+        # Day 0 (1970-01-01) was a Thursday
+        starts = days - (days.astype(np.int64) + 3) % 7
+    elif bucket == "quarter":
+        months = datetimes.astype("datetime64[M]")
+        starts = months - months.astype(np.int64) % 3
+    else:
+        starts = datetimes.astype(f"datetime64[{_BUCKET_UNITS[bucket]}]")
+    return starts.astype("datetime64[s]")
+
+
+def bucket_labels(starts: np.ndarray, bucket: str) -> List[str]:
+    """Label of every bucket start: 2026-01-05 13:00, 2026-01-05 (day and week), 2026-01 or 2026-Q1"""
+    if bucket == "quarter":
+        months = starts.astype("datetime64[M]").astype(np.int64)
+        return [f"{1970 + month // 12}-Q{month % 12 // 3 + 1}" for month in months.tolist()]
+    unit = {"minute": "m", "hour": "m", "month": "M"}.get(bucket, "D")
+    return [label.replace("T", " ") for label in np.datetime_as_string(starts, unit=unit).tolist()]
+
+
+def bucket_column(column: Column, bucket: str) -> Column:
+    """
+    Column of the time bucket of every row's date (cached on the column).
+    Its categories are the buckets in date order, then ``""`` for rows
+    without a date. Dates are truncated per category, or per bucket of a
+    finer bucket column built before, and rows only look their bucket up.
+    ``derived["bucket_starts"]`` holds the start of each bucket and
+    ``derived["undated_rows"]`` the number of non-empty values that aren't
+    dates.
+    """
+    cache = column.derived
+    key = ("time_bucket", bucket)
+    if key not in cache:
+        finer = [fine for fine in TIME_BUCKETS
+                 if fine != bucket and ("time_bucket", fine) in cache and bucket_nests(fine, bucket)]
+        if finer:
+            # Whole finer buckets fall into one bucket; the last code is the finer column's ""
+            source = cache[("time_bucket", finer[-1])]
+            starts = np.append(truncate_dates(source.derived["bucket_starts"], bucket), np.datetime64("NaT"))
+        else:
+            source = column
+            starts = truncate_dates(local_datetimes(column_dates(column)), bucket)
+        dated = ~np.isnat(starts)
+        buckets, source_buckets = np.unique(starts[dated], return_inverse=True)
+        lookup = np.full(len(starts), len(buckets), dtype=np.int32)
+        lookup[dated] = source_buckets.reshape(-1)
+        codes = lookup[source.codes]
+        # Only the codes and categories are grouped on; the rest is the date column's
+        bucketed = Column(column.name, codes, bucket_labels(buckets, bucket) + [""], column.present,
+                          column.numbers, column.numeric, column.strings)
+        bucketed.derived["bucket_starts"] = buckets
+        if finer:
+            bucketed.derived["undated_rows"] = source.derived["undated_rows"]
+        else:
+            empty_rows = np.count_nonzero(column.codes == column.empty_code) if column.empty_code >= 0 else 0
+            bucketed.derived["undated_rows"] = int(np.count_nonzero(codes == len(buckets))) - int(empty_rows)
+        cache[key] = bucketed
+    return cache[key]
+
+
+def rebucket(fine: Column, coarse: Column, bucket: str) -> np.ndarray:
+    """
+    Code in coarse of every bucket of fine, two bucket_columns of the same
+    column where fine's buckets nest in coarse's (of size bucket)
+    """
+    return np.searchsorted(coarse.derived["bucket_starts"], truncate_dates(fine.derived["bucket_starts"], bucket))
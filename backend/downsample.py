@@ -0,0 +1,74 @@
+"""
+Point downsampling for xy/scatter and raw line charts.
+
+A chart can't show more points than it has pixels, but large reports used to
+return one point per row. Both methods pick a subset of the original points
+(x values must be sorted ascending) and return their indices:
+
+- ``lttb``: Largest-Triangle-Three-Buckets, keeps the points that preserve
+  the visual shape of a line best
+- ``min_max``: keeps the lowest and highest point of each bucket, so spikes
+  and the value range are never lost
+"""
+import numpy as np
+
+DOWNSAMPLE_METHODS = ("LTTB", "MINMAX")
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of threshold points chosen with Largest-Triangle-Three-Buckets"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    # Bucket edges over the points between the first and the last one
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Average of the next bucket (or the last point) is the third vertex
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+            average_x = x[next_start:next_end].mean()
+            average_y = y[next_start:next_end].mean()
+        else:
+            average_x, average_y = x[n - 1], y[n - 1]
+
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        areas = np.abs(
+            (x[previous] - average_x) * (bucket_y - y[previous])
+            - (x[previous] - bucket_x) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def min_max(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of the min and max point of threshold / 2 equal-count buckets"""
+    n = len(x)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+
+    buckets = max(threshold // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    selected = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        segment = y[start:end]
+        low, high = start + int(np.argmin(segment)), start + int(np.argmax(segment))
+        selected.extend(sorted({low, high}))
+    return np.array(selected, dtype=np.int64)
+
+
+def downsample(x: np.ndarray, y: np.ndarray, max_points: int, method: str = "LTTB") -> np.ndarray:
+    """Indices of at most max_points points, in ascending x order (x must be sorted)"""
+    if (method or "LTTB").upper() == "MINMAX":
+        return min_max(x, y, max_points)
+    return lttb(x, y, max_points)
@@ -0,0 +1,191 @@
+"""
+Worker pools for CPU-bound analysis.
+
+The analyze handlers are ``async``, so running the aggregation directly on
+the event loop stalls every other client for the duration of a large
+request. Work is dispatched by dataset size instead:
+
+- small datasets run inline, where a pool round trip would cost more than
+  the analysis itself,
+- medium datasets run on a thread pool (NumPy releases the GIL for the bulk
+  of the aggregation, and nothing has to be copied),
+- large datasets run on a process pool, so pure-Python parts don't contend
+  for the GIL either. Columns are built on a thread first and only the
+  columns a batch reads are shipped to the worker.
+
+Independent batches of work (e.g. charts over different group columns) are
+submitted separately and run in parallel. ``iterate`` runs generator
+functions the same way and passes their items on as they are produced, which
+is what streamed responses are built on.
+
+Configuration (environment variables):
+
+- ``ANALYSIS_EXECUTOR``: ``auto`` (default), ``inline``, ``thread`` or ``process``
+- ``ANALYSIS_MAX_WORKERS``: pool size (default: number of CPUs)
+- ``ANALYSIS_INLINE_MAX_ROWS``: below this many rows, analysis runs inline (default 2000)
+- ``ANALYSIS_PROCESS_MIN_ROWS``: from this many rows on, ``auto`` uses processes (default 100000)
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+EXECUTOR_MODES = ("auto", "inline", "thread", "process")
+
+# Marks the end of a generator's items on the queue of iterate
+_DONE = object()
+
+
+def _collect(fn: Callable[..., Iterator[Any]], *args) -> List[Any]:
+    """All items of a generator (run in a worker process)"""
+    return list(fn(*args))
+
+
+def partition(keys: Sequence[Hashable], batches: int) -> List[List[int]]:
+    """
+    Split item indices into at most ``batches`` groups, keeping items with the
+    same key together (they share work) and balancing the group sizes.
+    """
+    buckets: Dict[Hashable, List[int]] = {}
+    for index, key in enumerate(keys):
+        buckets.setdefault(key, []).append(index)
+    groups: List[List[int]] = [[] for _ in range(max(1, min(batches, len(buckets))))]
+    # Largest bucket first, each into the currently smallest group
+    for bucket in sorted(buckets.values(), key=len, reverse=True):
+        min(groups, key=len).extend(bucket)
+    return [sorted(group) for group in groups if group]
+
+
+class AnalysisExecutor:
+    """Runs analysis inline, on a thread pool or on a process pool by dataset size"""
+
+    def __init__(self, mode: str = "auto", max_workers: Optional[int] = None,
+                 inline_max_rows: int = 2000, process_min_rows: int = 100000):
+        mode = mode.lower()
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"Unknown executor mode '{mode}'. Use one of: {', '.join(EXECUTOR_MODES)}")
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.inline_max_rows = inline_max_rows
+        self.process_min_rows = process_min_rows
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def choose(self, num_rows: int) -> str:
+        """Where work over a dataset of num_rows rows runs: inline, thread or process"""
+        if self.mode != "auto":
+            return self.mode
+        if num_rows < self.inline_max_rows:
+            return "inline"
+        if num_rows >= self.process_min_rows and self.max_workers > 1:
+            return "process"
+        return "thread"
+
+    def _pool(self, kind: str) -> Executor:
+        with self._lock:
+            if kind == "process":
+                if self._processes is None:
+                    # spawn: forking a process that runs threads (the event
+                    # loop's and the thread pool's) can deadlock in the child
+                    self._processes = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                    )
+                return self._processes
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analysis")
+            return self._threads
+
+    async def run_in_thread(self, fn: Callable[..., Any], *args) -> Any:
+        """Run a blocking call on the thread pool, off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool("thread"), fn, *args)
+
+    async def map(self, fn: Callable[..., Any], calls: Sequence[Sequence[Any]], kind: str) -> List[Any]:
+        """
+        Run fn(*args) for every args tuple in calls, in parallel on the pool
+        of the given kind (or one after another inline); results in order.
+        """
+        if kind == "inline":
+            return [fn(*args) for args in calls]
+        loop = asyncio.get_running_loop()
+        pool = self._pool(kind)
+        return list(await asyncio.gather(*(loop.run_in_executor(pool, fn, *args) for args in calls)))
+
+    async def iterate(self, fn: Callable[..., Iterator[Any]], calls: Sequence[Sequence[Any]],
+                      kind: str) -> AsyncIterator[Tuple[int, Any]]:
+        """
+        Run the generator function fn(*args) for every args tuple in calls and
+        yield (call index, item) as items are produced.
+
+        Inline, the generators run one after another on the event loop, which
+        gets control back after every item. On threads they run in parallel
+        and hand items over through a queue. Generators can't be streamed out
+        of a worker process, so there each call's items are yielded together
+        when it completes (calls in order of completion).
+        """
+        if kind == "inline":
+            for index, args in enumerate(calls):
+                for item in fn(*args):
+                    yield index, item
+                    await asyncio.sleep(0)
+            return
+
+        loop = asyncio.get_running_loop()
+        pool = self._pool(kind)
+        if kind == "process":
+            async def collect(index, args):
+                return index, await loop.run_in_executor(pool, _collect, fn, *args)
+            for completed in asyncio.as_completed([collect(index, args) for index, args in enumerate(calls)]):
+                index, items = await completed
+                for item in items:
+                    yield index, item
+            return
+
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def drain(index, args):
+            try:
+                for item in fn(*args):
+                    loop.call_soon_threadsafe(queue.put_nowait, (index, item, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (index, _DONE, e))
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, (index, _DONE, None))
+
+        for index, args in enumerate(calls):
+            loop.run_in_executor(pool, drain, index, args)
+        remaining = len(calls)
+        while remaining:
+            index, item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                remaining -= 1
+                continue
+            yield index, item
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "max_workers": self.max_workers,
+            "inline_max_rows": self.inline_max_rows,
+            "process_min_rows": self.process_min_rows,
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for pool in (self._threads, self._processes):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._threads = self._processes = None
+
+
+analysis_executor = AnalysisExecutor(
+    mode=os.getenv("ANALYSIS_EXECUTOR", "auto"),
+    max_workers=int(os.getenv("ANALYSIS_MAX_WORKERS", "0")) or None,
+    inline_max_rows=int(os.getenv("ANALYSIS_INLINE_MAX_ROWS", "2000")),
+    process_min_rows=int(os.getenv("ANALYSIS_PROCESS_MIN_ROWS", "100000")),
+)
@@ -0,0 +1,194 @@
+"""
+Filter predicates for charts, resolved through per-column bitmap indexes.
+
+A chart's ``filters`` restrict it to the rows matching every predicate:
+
+- ``{"column": c, "op": "eq", "value": v}``: rows whose value has the label
+  ``str(v)`` (the labels charts group by, so a clicked bar drills down),
+- ``{"column": c, "op": "in", "values": [...]}``: any of several labels,
+- ``{"column": c, "op": "range", "min": lo, "max": hi}``: numeric values in
+  ``[lo, hi]`` when the bounds are numbers, dates in the range when they are
+  date strings (a date-only ``max`` includes that whole day); either bound
+  may be left out.
+
+Predicates never scan the rows. The first time a column is filtered it gets
+an index, cached on the column (so stored datasets keep it across
+requests):
+
+- per category, the rows holding it (posting lists in one ``argsort``),
+  which answer ``eq``, ``in`` and, via the per-category timestamps of
+  ``dates``, date ranges,
+- the numeric rows sorted by value, which answer numeric ranges with two
+  binary searches.
+
+Each predicate's rows are a ``RowBitmap``; bitmaps are cached per column and
+predicate, and ANDed (most selective first) into the chart's selection.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import jsonio
+from bitmaps import RowBitmap
+from columnar import Column, ColumnarDataset
+from dates import DATE_FORMATS, column_date_format, column_dates, infer_date_format, parse_dates
+
+FILTER_OPS = ("eq", "in", "range")
+# Predicate bitmaps cached per column
+MAX_CACHED_PREDICATES = 64
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_filter(predicate) -> None:
+    """Raise ValueError for an unknown op or missing/mismatched operands"""
+    op = (predicate.op or "").lower()
+    if op not in FILTER_OPS:
+        raise ValueError(f"Unknown filter op '{predicate.op}'. Use one of: {', '.join(FILTER_OPS)}")
+    if op == "in" and not isinstance(predicate.values, list):
+        raise ValueError(f"Filter on '{predicate.column}': 'in' needs a values list")
+    if op == "range":
+        bounds = [bound for bound in (predicate.min, predicate.max) if bound is not None]
+        if not bounds:
+            raise ValueError(f"Filter on '{predicate.column}': 'range' needs min and/or max")
+        if not (all(_is_number(bound) for bound in bounds) or all(isinstance(bound, str) for bound in bounds)):
+            raise ValueError(f"Filter on '{predicate.column}': range bounds must both be numbers or both be dates")
+
+
+def filters_key(filters: Sequence) -> str:
+    """Order-independent key of a list of predicates (charts with equal keys see the same rows)"""
+    return jsonio.dumps(sorted(jsonio.dumps(predicate.model_dump(), sort_keys=True).decode("utf-8")
+                               for predicate in filters)).decode("utf-8")
+
+
+def filter_columns(filters: Optional[Sequence]) -> List[str]:
+    return [predicate.column for predicate in filters or ()]
+
+
+def _row_index(column: Column) -> dict:
+    # Row-level indexes and bitmaps of a column (not shared with row subsets)
+    return column.derived.setdefault("row_index", {})
+
+
+def category_rows(column: Column) -> Tuple[np.ndarray, np.ndarray]:
+    """Rows grouped by category (ascending within each) and each category's offset into them"""
+    index = _row_index(column)
+    if "categories" not in index:
+        order = np.argsort(column.codes, kind="stable")
+        counts = np.bincount(column.codes, minlength=len(column.categories))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        index["categories"] = (order, offsets)
+    return index["categories"]
+
+
+def numeric_rows(column: Column) -> Tuple[np.ndarray, np.ndarray]:
+    """Numeric rows sorted by value, and their values"""
+    index = _row_index(column)
+    if "numbers" not in index:
+        rows = np.flatnonzero(column.numeric)
+        order = rows[np.argsort(column.numbers[rows], kind="stable")]
+        index["numbers"] = (order, column.numbers[order])
+    return index["numbers"]
+
+
+def _codes_bitmap(column: Column, codes: np.ndarray, num_rows: int) -> RowBitmap:
+    order, offsets = category_rows(column)
+    parts = [order[offsets[code]:offsets[code + 1]] for code in codes.tolist()]
+    rows = np.sort(np.concatenate(parts)) if len(parts) > 1 else (parts[0] if parts else order[:0])
+    return RowBitmap.from_rows(rows, num_rows)
+
+
+def _label_codes(column: Column, values: List[Any]) -> np.ndarray:
+    lookup = column.derived.get("category_codes")
+    if lookup is None:
+        lookup = column.derived["category_codes"] = {category: code for code, category in enumerate(column.categories)}
+    codes = {lookup[str(value)] for value in values if str(value) in lookup}
+    return np.array(sorted(codes), dtype=np.int64)
+
+
+def _date_bound(value: str, column: Column) -> float:
+    timestamp = parse_dates([value], DATE_FORMATS, column_date_format(column))[0]
+    if np.isnan(timestamp):
+        raise ValueError(f"Filter on '{column.name}': cannot parse '{value}' as a date")
+    return timestamp
+
+
+def _date_only(value: str, column: Column) -> Optional[datetime]:
+    """The date of a bound without a time of day, else None"""
+    # Ambiguous bounds (01/02/2026) read the way the column's dates are
+    formats = DATE_FORMATS
+    preferred = column_date_format(column)
+    if preferred:
+        formats = [preferred] + [fmt for fmt in DATE_FORMATS if fmt != preferred]
+    fmt = infer_date_format([value], formats)
+    return datetime.strptime(value, fmt) if fmt is not None and "%H" not in fmt else None
+
+
+def predicate_bitmap(column: Column, predicate, num_rows: int) -> RowBitmap:
+    """Rows of the column matching one predicate (cached on the column)"""
+    validate_filter(predicate)
+    op = predicate.op.lower()
+    cache = _row_index(column).setdefault("bitmaps", OrderedDict())
+    key = jsonio.dumps({"op": op, "value": predicate.value, "values": predicate.values,
+                        "min": predicate.min, "max": predicate.max}, sort_keys=True)
+    bitmap = cache.get(key)
+    if bitmap is not None:
+        cache.move_to_end(key)
+        return bitmap
+
+    if op == "eq":
+        bitmap = _codes_bitmap(column, _label_codes(column, [predicate.value]), num_rows)
+    elif op == "in":
+        bitmap = _codes_bitmap(column, _label_codes(column, predicate.values), num_rows)
+    elif _is_number(predicate.min) or _is_number(predicate.max):
+        order, values = numeric_rows(column)
+        start = np.searchsorted(values, predicate.min, side="left") if predicate.min is not None else 0
+        end = np.searchsorted(values, predicate.max, side="right") if predicate.max is not None else len(values)
+        bitmap = RowBitmap.from_rows(np.sort(order[start:end]), num_rows)
+    else:
+        timestamps = column_dates(column)
+        matching = ~np.isnan(timestamps)
+        if predicate.min is not None:
+            matching &= timestamps >= _date_bound(predicate.min, column)
+        if predicate.max is not None:
+            day = _date_only(predicate.max, column)
+            if day is not None:
+                # A date-only upper bound includes the whole day
+                matching &= timestamps < (day + timedelta(days=1)).timestamp()
+            else:
+                matching &= timestamps <= _date_bound(predicate.max, column)
+        bitmap = _codes_bitmap(column, np.flatnonzero(matching), num_rows)
+
+    cache[key] = bitmap
+    while len(cache) > MAX_CACHED_PREDICATES:
+        cache.popitem(last=False)
+    return bitmap
+
+
+def select_rows(dataset: ColumnarDataset, filters: Sequence) -> RowBitmap:
+    """Rows matching every predicate"""
+    bitmaps = []
+    for predicate in filters:
+        if predicate.column not in dataset.column_names:
+            available = ", ".join(dataset.column_names[:10])
+            raise ValueError(f"Filter column '{predicate.column}' not found in data. Available columns: {available}")
+        bitmaps.append(predicate_bitmap(dataset.column(predicate.column), predicate, dataset.num_rows))
+    if not bitmaps:
+        return RowBitmap.full(dataset.num_rows)
+    # Smallest first, so every AND is bounded by the most selective predicate
+    bitmaps.sort(key=len)
+    selection = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        if not selection.chunks:
+            break
+        selection = selection & bitmap
+    return selection
+
+
+def filter_dataset(dataset: ColumnarDataset, filters: Sequence) -> ColumnarDataset:
+    """Dataset of the rows matching every predicate (columns are sliced when first read)"""
+    return dataset.take(select_rows(dataset, filters).to_rows())
@@ -0,0 +1,421 @@
+"""
+Columnar upload formats.
+
+Besides a JSON array of row objects, report data can be sent as:
+
+- an Apache Arrow IPC stream (``application/vnd.apache.arrow.stream``) or
+  file (``application/vnd.apache.arrow.file``),
+- a Parquet file (``application/vnd.apache.parquet``),
+- CSV (``text/csv``) with a header row of column names and optional typed
+  column hints.
+
+Arrow and Parquet columns are converted straight from their typed buffers to
+``Column`` arrays: numbers are never boxed into Python objects, strings are
+dictionary encoded by Arrow, and only the distinct values are stringified.
+Dates and timestamps become ``%Y-%m-%d`` / ``%Y-%m-%d %H:%M:%S`` strings,
+which is what a JSON export of the same report contains. Arrow and Parquet
+need pyarrow; CSV only needs the standard library.
+
+CSV type hints map column names to ``int``, ``float``, ``bool``, ``string``
+or ``date``; unhinted columns are ints if every non-empty cell is one, else
+floats if every non-empty cell is one, else strings. Empty cells are nulls.
+
+Uploads too large to parse at once are saved to a file and read back in
+chunks of rows (``read_dataset_chunks``, see outofcore): Arrow by record
+batch, Parquet by row group batch, CSV in two passes (types first), and JSON
+as a stream of rows, from ``{"report_data": [...]}``, a bare array of rows or
+NDJSON (one row object per line).
+"""
+import csv
+import hashlib
+import io
+import itertools
+import json
+import re
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+import jsonio
+from columnar import Column, ColumnarDataset
+from outofcore import CHUNK_ROWS
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, see requirements.txt
+    pa = None
+
+# Content types of the formats (``format`` query values as keys)
+FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "application/vnd.apache.arrow"),
+    "arrow_file": ("application/vnd.apache.arrow.file", "application/x-apache-arrow-file"),
+    "parquet": ("application/vnd.apache.parquet", "application/x-parquet", "application/parquet"),
+    "csv": ("text/csv", "application/csv"),
+}
+CSV_TYPES = ("int", "float", "bool", "string", "date")
+
+# Text read at a time when streaming JSON rows, and the most a row may span
+JSON_BLOCK_CHARS = 1 << 20
+JSON_MAX_ROW_CHARS = 64 << 20
+# A JSON body whose rows are in a report_data array (the first key)
+_JSON_ARRAY_START = re.compile(r'\s*(\{\s*"report_data"\s*:\s*)?\[')
+_JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+_TRUE = {"true", "1", "yes", "y", "t"}
+_FALSE = {"false", "0", "no", "n", "f"}
+
+
+class IngestError(ValueError):
+    """The body could not be read in the given format"""
+
+
+class UnsupportedFormatError(IngestError):
+    """The format needs an optional dependency that is not installed"""
+
+
+def body_format(content_type: Optional[str], explicit: Optional[str] = None) -> Optional[str]:
+    """
+    Upload format from the ``format`` query parameter or the Content-Type
+    header; None for JSON. Raises IngestError for an unknown explicit format.
+    """
+    if explicit:
+        explicit = explicit.lower()
+        if explicit == "json":
+            return None
+        if explicit not in FORMATS:
+            raise IngestError(f"Unknown format '{explicit}'. Use one of: json, {', '.join(FORMATS)}")
+        return explicit
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    for fmt, media_types in FORMATS.items():
+        if media_type in media_types:
+            return fmt
+    return None
+
+
+def parse_column_types(raw: Optional[str]) -> Dict[str, str]:
+    """Validate the ``column_types`` query parameter: a JSON object of column name -> CSV type"""
+    if not raw:
+        return {}
+    try:
+        hints = jsonio.loads(raw)
+    except ValueError as e:
+        raise IngestError(f"column_types is not valid JSON: {e}")
+    if not isinstance(hints, dict):
+        raise IngestError("column_types must be an object mapping column names to types")
+    for name, kind in hints.items():
+        if not isinstance(kind, str) or kind.lower() not in CSV_TYPES:
+            raise IngestError(f"Unknown type {kind!r} for column '{name}'. Use one of: {', '.join(CSV_TYPES)}")
+    return {name: kind.lower() for name, kind in hints.items()}
+
+
+def body_fingerprint(body: bytes, fmt: Optional[str], column_types: Optional[Dict[str, str]] = None) -> str:
+    """Content hash of an uploaded body, used as the dataset id"""
+    return digest_fingerprint(hashlib.sha256(body), fmt, column_types)
+
+
+def digest_fingerprint(digest, fmt: Optional[str], column_types: Optional[Dict[str, str]] = None) -> str:
+    """body_fingerprint of a body fed to a sha256 digest piece by piece"""
+    digest.update(jsonio.dumps({"format": fmt, "column_types": column_types or {}}, sort_keys=True))
+    return digest.hexdigest()
+
+
+def read_dataset(body: bytes, fmt: str, column_types: Optional[Dict[str, str]] = None) -> ColumnarDataset:
+    """Build a dataset from an uploaded body in one of FORMATS"""
+    if fmt == "csv":
+        return read_csv(body, column_types)
+    if pa is None:
+        raise UnsupportedFormatError(f"Reading {fmt} uploads requires pyarrow, which is not installed")
+    try:
+        if fmt == "arrow":
+            table = pa.ipc.open_stream(body).read_all()
+        elif fmt == "arrow_file":
+            table = pa.ipc.open_file(pa.BufferReader(body)).read_all()
+        else:
+            table = pq.read_table(pa.BufferReader(body))
+    except (pa.ArrowInvalid, OSError) as e:
+        raise IngestError(f"Invalid {fmt} data: {e}")
+    return from_arrow(table)
+
+
+def read_dataset_chunks(path: str, fmt: Optional[str], column_types: Optional[Dict[str, str]] = None,
+                        chunk_rows: int = CHUNK_ROWS) -> Iterator[ColumnarDataset]:
+    """
+    Datasets of consecutive chunks of at most chunk_rows rows of an upload
+    saved to path (fmt None for JSON), without reading the whole file at once
+    """
+    if fmt is None:
+        with open(path, "rb") as f:
+            rows = _json_rows(f)
+            while True:
+                batch = list(itertools.islice(rows, chunk_rows))
+                if not batch:
+                    return
+                yield ColumnarDataset.from_records(batch)
+    elif fmt == "csv":
+        yield from _csv_chunks(path, column_types, chunk_rows)
+    else:
+        yield from _arrow_chunks(path, fmt, chunk_rows)
+
+
+def _json_rows(f) -> Iterator[Dict]:
+    """Row objects of a JSON body, parsed one at a time"""
+    text = io.TextIOWrapper(f, encoding="utf-8-sig")
+    try:
+        buffer = text.read(JSON_BLOCK_CHARS)
+        start = _JSON_ARRAY_START.match(buffer)
+        if start is None:
+            if buffer.lstrip().startswith("{") and '"report_data"' in buffer.split("\n", 1)[0]:
+                raise IngestError("Chunked JSON uploads need report_data as the first key of the body")
+            text.seek(0)
+            yield from _ndjson_rows(text)
+            return
+        yield from _json_array_rows(text, buffer, start.end())
+    except UnicodeDecodeError as e:
+        raise IngestError(f"JSON must be UTF-8 encoded: {e}")
+    finally:
+        text.detach()
+
+
+def _ndjson_rows(text) -> Iterator[Dict]:
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = jsonio.loads(line)
+        except json.JSONDecodeError as e:
+            raise IngestError(f"Invalid JSON on line {line_number}: {e}")
+        if not isinstance(row, dict):
+            raise IngestError(f"Line {line_number} is not a row object")
+        yield row
+
+
+def _json_array_rows(text, buffer: str, position: int) -> Iterator[Dict]:
+    """Elements of a JSON array starting at position of buffer, reading more text as needed"""
+    decoder = json.JSONDecoder()
+    index = 0
+    at_end = False
+    while True:
+        position = _JSON_SEPARATORS.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Expecting value", buffer, position)
+            row, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            # Most likely the row goes on in the next block
+            if at_end or len(buffer) - position > JSON_MAX_ROW_CHARS:
+                raise IngestError(f"Invalid JSON in report_data[{index}]: {e.msg}")
+            more = text.read(JSON_BLOCK_CHARS)
+            at_end = not more
+            buffer, position = buffer[position:] + more, 0
+            continue
+        if not isinstance(row, dict):
+            raise IngestError(f"report_data[{index}] is not a row object")
+        yield row
+        index += 1
+
+
+def _arrow_chunks(path: str, fmt: str, chunk_rows: int) -> Iterator[ColumnarDataset]:
+    if pa is None:
+        raise UnsupportedFormatError(f"Reading {fmt} uploads requires pyarrow, which is not installed")
+    try:
+        source = pa.memory_map(path)
+        if fmt == "arrow":
+            reader = pa.ipc.open_stream(source)
+            schema, batches = reader.schema, iter(reader)
+        elif fmt == "arrow_file":
+            reader = pa.ipc.open_file(source)
+            schema = reader.schema
+            batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+        else:
+            parquet = pq.ParquetFile(source)
+            schema, batches = parquet.schema_arrow, parquet.iter_batches(batch_size=chunk_rows)
+        # The columns, even when there are no rows
+        yield from_arrow(schema.empty_table())
+        for batch in batches:
+            for offset in range(0, batch.num_rows, chunk_rows):
+                yield from_arrow(pa.Table.from_batches([batch.slice(offset, chunk_rows)]))
+    except (pa.ArrowInvalid, OSError) as e:
+        raise IngestError(f"Invalid {fmt} data: {e}")
+
+
+def from_arrow(table: "pa.Table") -> ColumnarDataset:
+    """Dataset of an Arrow table, column by column from the typed buffers"""
+    columns = [_arrow_column(name, table.column(index)) for index, name in enumerate(table.column_names)]
+    return ColumnarDataset.from_columns(columns, table.num_rows)
+
+
+def _arrow_column(name: str, array: "pa.ChunkedArray") -> Column:
+    array = array.combine_chunks() if array.num_chunks != 1 else array.chunk(0)
+    kind = array.type
+    if pa.types.is_dictionary(kind):
+        if pa.types.is_string(kind.value_type) or pa.types.is_large_string(kind.value_type):
+            return _dictionary_column(name, array)
+        array = array.dictionary_decode()
+        kind = array.type
+
+    if pa.types.is_date(kind):
+        array = pc.strftime(array.cast(pa.timestamp("s")), format="%Y-%m-%d")
+    elif pa.types.is_timestamp(kind):
+        array = pc.strftime(array, format="%Y-%m-%d %H:%M:%S")
+
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        return _dictionary_column(name, array.dictionary_encode())
+    if pa.types.is_boolean(kind) or pa.types.is_integer(kind) or pa.types.is_floating(kind):
+        valid = _valid(array)
+        fill = False if pa.types.is_boolean(kind) else 0
+        values = array.fill_null(fill).to_numpy(zero_copy_only=False)
+        if values.dtype == np.float16:
+            values = values.astype(np.float32)
+        return Column.from_numbers(name, values, valid)
+    # Decimals, binary, nested types: through Python values
+    return Column.from_values(name, array.to_pylist())
+
+
+def _dictionary_column(name: str, array: "pa.DictionaryArray") -> Column:
+    indices = array.indices.fill_null(0).to_numpy(zero_copy_only=False)
+    return Column.from_dictionary(name, indices, array.dictionary.to_pylist(), _valid(array))
+
+
+def _valid(array: "pa.Array") -> Optional[np.ndarray]:
+    if array.null_count == 0:
+        return None
+    return array.is_valid().to_numpy(zero_copy_only=False)
+
+
+def read_csv(body: bytes, column_types: Optional[Dict[str, str]] = None) -> ColumnarDataset:
+    """Dataset of a CSV body whose first row holds the column names"""
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise IngestError(f"CSV must be UTF-8 encoded: {e}")
+    rows = csv.reader(io.StringIO(text, newline=""))
+    header = next(rows, None)
+    if header is None:
+        return ColumnarDataset.from_columns([], 0)
+    column_types = _csv_hints(header, column_types)
+    return _csv_dataset(header, _csv_rows(rows, header), [column_types.get(name) for name in header])
+
+
+def _csv_hints(header: List[str], column_types: Optional[Dict[str, str]]) -> Dict[str, str]:
+    column_types = column_types or {}
+    unknown = [name for name in column_types if name not in header]
+    if unknown:
+        raise IngestError(f"column_types names unknown CSV columns: {', '.join(unknown)}")
+    return column_types
+
+
+def _csv_rows(rows, header: List[str]) -> Iterator[List[str]]:
+    """Non-blank rows, padded to the header's width"""
+    for line, row in enumerate(rows, start=2):
+        if not row:
+            continue
+        if len(row) > len(header):
+            raise IngestError(f"CSV line {line} has {len(row)} fields, the header has {len(header)}")
+        yield row + [""] * (len(header) - len(row))
+
+
+def _csv_dataset(header: List[str], rows, kinds: List[Optional[str]]) -> ColumnarDataset:
+    cells: List[List[str]] = [[] for _ in header]
+    for row in rows:
+        for index, value in enumerate(row):
+            cells[index].append(value)
+    columns = [_csv_column(name, values, kind) for name, values, kind in zip(header, cells, kinds)]
+    return ColumnarDataset.from_columns(columns, len(cells[0]) if cells else 0)
+
+
+def _csv_chunks(path: str, column_types: Optional[Dict[str, str]], chunk_rows: int) -> Iterator[ColumnarDataset]:
+    """A CSV file in chunks; the types of unhinted columns come from a first pass over every row"""
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            rows = csv.reader(f)
+            header = next(rows, None)
+            if header is None:
+                yield ColumnarDataset.from_columns([], 0)
+                return
+            column_types = _csv_hints(header, column_types)
+            guesses = [None if name in column_types else _CsvTypeGuess() for name in header]
+            for row in _csv_rows(rows, header):
+                for guess, value in zip(guesses, row):
+                    if guess is not None:
+                        guess.add(value)
+            kinds = [column_types.get(name) or guess.kind for name, guess in zip(header, guesses)]
+
+            f.seek(0)
+            rows = _csv_rows(itertools.islice(csv.reader(f), 1, None), header)
+            batch = list(itertools.islice(rows, chunk_rows))
+            # The columns, even when there are no rows
+            yield _csv_dataset(header, batch, kinds)
+            while batch:
+                batch = list(itertools.islice(rows, chunk_rows))
+                if batch:
+                    yield _csv_dataset(header, batch, kinds)
+    except UnicodeDecodeError as e:
+        raise IngestError(f"CSV must be UTF-8 encoded: {e}")
+
+
+def _csv_column(name: str, values: List[str], kind: Optional[str]) -> Column:
+    if kind is None:
+        kind = _infer_csv_type(values)
+    if kind in ("string", "date"):
+        # Dates stay strings; the chart branches parse them in bulk
+        return Column.from_values(name, [value if value != "" else None for value in values])
+
+    valid = np.array([value != "" for value in values], dtype=bool)
+    try:
+        if kind == "bool":
+            numbers = np.array([_parse_bool(value) for value in values], dtype=bool)
+        elif kind == "int":
+            numbers = np.array([int(value) if value != "" else 0 for value in values], dtype=np.int64)
+        else:
+            numbers = np.array([float(value) if value != "" else 0.0 for value in values], dtype=np.float64)
+    except (ValueError, OverflowError) as e:
+        raise IngestError(f"Column '{name}' is not {kind}: {e}")
+    return Column.from_numbers(name, numbers, valid)
+
+
+class _CsvTypeGuess:
+    """Type of a CSV column by the cells seen so far: int, else float, else string"""
+
+    def __init__(self):
+        self.present = False
+        self._kind = "int"
+
+    def add(self, value: str) -> None:
+        if value == "" or self._kind == "string":
+            return
+        self.present = True
+        # Every int cell is a float cell too, so a column only ever widens
+        if self._kind == "int":
+            try:
+                int(value)
+                return
+            except ValueError:
+                self._kind = "float"
+        try:
+            float(value)
+        except ValueError:
+            self._kind = "string"
+
+    @property
+    def kind(self) -> str:
+        return self._kind if self.present else "string"
+
+
+def _infer_csv_type(values: List[str]) -> str:
+    guess = _CsvTypeGuess()
+    for value in values:
+        guess.add(value)
+    return guess.kind
+
+
+def _parse_bool(value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered in _TRUE:
+        return True
+    if lowered in _FALSE or lowered == "":
+        return False
+    raise ValueError(f"invalid boolean {value!r}")
@@ -0,0 +1,43 @@
+"""
+Fast JSON parsing and serialisation.
+
+Report payloads are large, and parsing/serialising them with the standard
+library used to cost more than the aggregation itself. orjson is used when it
+is installed; otherwise everything falls back to the ``json`` module.
+"""
+import json
+from typing import Any, Union
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional dependency, see requirements.txt
+    orjson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Parse JSON; raises json.JSONDecodeError on bad input (orjson's error subclasses it)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(content: Any, sort_keys: bool = False) -> bytes:
+    """Serialise to compact UTF-8 JSON"""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(content, option=option, default=str)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, sort_keys=sort_keys,
+        separators=(",", ":"), default=str,
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,16 +1,49 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import AsyncIterator, Callable, Iterator, List, Dict, Any, Optional, Tuple, Union
 import json
+from contextlib import asynccontextmanager, contextmanager
 from collections import Counter
-from datetime import datetime
 import statistics
 
+import asyncio
+import functools
+import hashlib
+import heapq
 import os
+import tempfile
+import time
 
-app = FastAPI(title="Report Analysis API")
+import numpy as np
+
+import jsonio
+from admission import AdmissionRejected, Cost, Ticket, admission_controller
+from aggregates import QUANTILES, error_bounds, regroup
+from columnar import ColumnarDataset
+from executor import analysis_executor, partition
+from filters import filter_columns, filter_dataset, filters_key
+from ingest import (IngestError, UnsupportedFormatError, body_fingerprint, body_format, digest_fingerprint,
+                    parse_column_types, read_dataset, read_dataset_chunks)
+from dates import DATE_FORMATS, bucket_column, column_dates, parse_dates, time_bucket
+from downsample import DOWNSAMPLE_METHODS, downsample
+from jsonio import FastJSONResponse
+from cache import ResultCache, config_key, result_cache
+from compression import CompressionMiddleware, compression_options
+from outofcore import CHUNK_ROWS, SPILL_DIR
+from metrics import RequestTimer, REQUEST_BYTES, RESPONSE_BYTES, ROWS, profiled, render_metrics, track_request
+from planner import QueryPlan, TimeBucket
+from precompute import Precomputer, precomputer
+from profiling import profile_dataset
+from shared import shared_cache
+from store import dataset_fingerprint, dataset_store
+from streaming import STREAM_FORMATS, encode_event, negotiate_stream_format, stream_headers
+
+app = FastAPI(title="Report Analysis API", default_response_class=FastJSONResponse)
 
 # CORS middleware to allow Laravel frontend to access the API
 # Allow specific origins from environment variable, or allow all for development
@@ -29,6 +62,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli for large chart payloads, negotiated per request
+app.add_middleware(CompressionMiddleware, **compression_options())
+
+class ChartFilter(BaseModel):
+    column: str
+    op: str  # eq, in or range
+    value: Optional[Any] = None  # eq: the label to keep
+    values: Optional[List[Any]] = None  # in: the labels to keep
+    min: Optional[Union[float, str]] = None  # range: lower bound, a number or a date (inclusive)
+    max: Optional[Union[float, str]] = None  # range: upper bound, a number or a date (inclusive)
+
 class ChartConfig(BaseModel):
     chart_type: str
     column: Optional[str] = None
@@ -36,16 +80,45 @@ class ChartConfig(BaseModel):
     y_column: Optional[str] = None
     group_column: Optional[str] = None
     series_column: Optional[str] = None
-    aggregate: Optional[str] = None  # COUNT, SUM, AVG, MIN, MAX, MEDIAN, MODE, PERCENTAGE, DISTINCT_COUNT
+    aggregate: Optional[str] = None  # COUNT, SUM, AVG, MIN, MAX, MEDIAN, P90, P95, P99, MODE, PERCENTAGE, DISTINCT_COUNT
     aggregate_column: Optional[str] = None  # Column to aggregate (or "all" for COUNT)
     title: Optional[str] = None
     x_label: Optional[str] = None
     y_label: Optional[str] = None
+    max_points: Optional[int] = None  # Downsample xy/scatter and raw line charts to at most this many points
+    downsample: Optional[str] = None  # LTTB (default) or MINMAX
+    top_n: Optional[int] = None  # Bar/pie/grouped bar: keep only the N groups with the largest values
+    top_series: Optional[int] = None  # Grouped bar: keep only the N series with the largest values
+    sort_by: Optional[str] = None  # Bar/pie/grouped bar: "label" (default) or "value"
+    sort_order: Optional[str] = None  # "asc" or "desc" (default: asc by label, desc by value)
+    other_bucket: Optional[bool] = None  # Aggregate the groups cut by top_n/top_series into "Other"
+    filters: Optional[List[ChartFilter]] = None  # Only rows matching every predicate are charted
+    approximate: Optional[bool] = None  # Sketch DISTINCT_COUNT, MEDIAN, P90/P95/P99 and MODE; adds error bounds
+    time_bucket: Optional[str] = None  # Aggregated line chart over dates: minute, hour, day, week, month or quarter
 
 class ReportRequest(BaseModel):
+    report_data: Optional[List[Dict[str, Any]]] = None
+    dataset_id: Optional[str] = None  # Id returned by /api/datasets, instead of report_data
+    chart_configs: List[ChartConfig]
+
+class DatasetUpload(BaseModel):
     report_data: List[Dict[str, Any]]
+
+class ProfileRequest(BaseModel):
+    report_data: Optional[List[Dict[str, Any]]] = None
+    dataset_id: Optional[str] = None  # Id returned by /api/datasets, instead of report_data
+
+class BatchJob(BaseModel):
+    id: Optional[str] = None  # Echoed back with the job's result
+    report_data: Optional[List[Dict[str, Any]]] = None
+    dataset_id: Optional[str] = None  # Id returned by /api/datasets, instead of report_data
     chart_configs: List[ChartConfig]
 
+class BatchRequest(BaseModel):
+    jobs: List[BatchJob]
+
+chart_configs_adapter = TypeAdapter(List[ChartConfig])
+
 def aggregate_values(values: List[float], aggregate_type: str) -> float:
     """Aggregate a list of values based on aggregate type"""
     if not values:
@@ -67,6 +140,8 @@ def aggregate_values(values: List[float], aggregate_type: str) -> float:
         return max(values)
     elif aggregate_type == "MEDIAN":
         return statistics.median(values) if values else 0
+    elif aggregate_type in QUANTILES:
+        return float(np.quantile(values, QUANTILES[aggregate_type]))
     elif aggregate_type == "MODE":
         try:
             return statistics.mode(values)
@@ -79,7 +154,443 @@ def aggregate_values(values: List[float], aggregate_type: str) -> float:
     else:
         return len(values)  # Default to count
 
-def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict[str, Any]:
+# Formats recognised for x values of raw-mode line charts
+LINE_DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]
+
+# Aggregations that need a numeric aggregate_column in grouped_bar_chart
+NUMERIC_AGGREGATIONS = ["SUM", "AVG", "MIN", "MAX", "MEDIAN", "P90", "P95", "P99", "MODE", "PERCENTAGE"]
+
+SORT_BY_OPTIONS = ["label", "value"]
+SORT_ORDER_OPTIONS = ["asc", "desc"]
+OTHER_LABEL = "Other"
+
+CHART_COLORS = [
+    'rgba(102, 126, 234, 0.6)',
+    'rgba(118, 75, 162, 0.6)',
+    'rgba(255, 99, 132, 0.6)',
+    'rgba(54, 162, 235, 0.6)',
+    'rgba(255, 206, 86, 0.6)',
+    'rgba(75, 192, 192, 0.6)',
+    'rgba(153, 102, 255, 0.6)',
+    'rgba(255, 159, 64, 0.6)',
+    'rgba(199, 199, 199, 0.6)',
+    'rgba(83, 102, 255, 0.6)'
+]
+
+def _resolve_aggregate_column(dataset: ColumnarDataset, aggregate_column: str) -> str:
+    """Match aggregate_column against the first row's columns, case-insensitively if needed"""
+    if dataset.num_rows == 0:
+        return aggregate_column
+    first_row_columns = dataset.column_names
+    if aggregate_column in first_row_columns:
+        return aggregate_column
+    # Try case-insensitive match
+    for col in first_row_columns:
+        if col.lower() == aggregate_column.lower():
+            return col
+    available_cols = ", ".join(first_row_columns[:10])
+    raise ValueError(f"Column '{aggregate_column}' not found in data. Available columns: {available_cols}")
+
+def _chart_plan(plan: QueryPlan, config: ChartConfig) -> QueryPlan:
+    """The plan over the rows a chart reads: the request's, or one over the rows its filters select"""
+    if not config.filters:
+        return plan
+    return plan.filtered(filters_key(config.filters), lambda: filter_dataset(plan.dataset, config.filters))
+
+def _line_group_column(config: ChartConfig) -> Union[str, TimeBucket]:
+    """What an aggregated line chart groups on: its column, or the column's dates truncated to time_bucket"""
+    if config.time_bucket:
+        return TimeBucket(config.column, time_bucket(config.time_bucket))
+    return config.column
+
+def _plan_chart(plan: QueryPlan, config: ChartConfig) -> None:
+    """Register the grouped work a chart will need (invalid configs are left to analyze_data_for_chart)"""
+    chart_type = config.chart_type.lower()
+    try:
+        plan = _chart_plan(plan, config)
+        if chart_type in ["bar_chart", "count_chart", "pie_chart"] and config.column:
+            plan.add((config.column,), config.aggregate, config.aggregate_column, config.approximate)
+        elif chart_type == "line_chart" and config.column and config.aggregate:
+            plan.add((_line_group_column(config),), config.aggregate, config.aggregate_column, config.approximate)
+        elif chart_type == "grouped_bar_chart" and config.group_column and config.series_column:
+            aggregate_column = config.aggregate_column
+            if (config.aggregate or "COUNT").upper() in NUMERIC_AGGREGATIONS and aggregate_column and aggregate_column != "all":
+                aggregate_column = _resolve_aggregate_column(plan.dataset, aggregate_column)
+            plan.add((config.group_column, config.series_column), config.aggregate, aggregate_column, config.approximate)
+    except ValueError:
+        pass
+
+def analyze_charts(report_data: Union[List[Dict], ColumnarDataset], chart_configs: List[ChartConfig],
+                   cache: Optional[ResultCache] = None) -> List[Dict[str, Any]]:
+    """
+    Analyze report data for several charts at once.
+
+    Grouped work shared between charts (same group columns and aggregate) is
+    planned up front and computed in one pass per set of group columns. When
+    a cache is given and the dataset has a content hash, cached charts are
+    reused and newly computed ones are stored.
+    """
+    if isinstance(report_data, ColumnarDataset):
+        dataset = report_data
+    else:
+        dataset = ColumnarDataset.from_records(report_data)
+    
+    if cache is None or dataset.fingerprint is None:
+        cache = None
+        charts = [None] * len(chart_configs)
+    else:
+        charts = [cache.get(dataset.fingerprint, config) for config in chart_configs]
+    
+    missing = [index for index, chart in enumerate(charts) if chart is None]
+    if missing:
+        computed, _, _ = compute_charts(dataset, [chart_configs[index] for index in missing])
+        for index, chart in zip(missing, computed):
+            if cache is not None and "error" not in chart:
+                cache.put(dataset.fingerprint, chart_configs[index], chart)
+            charts[index] = chart
+    
+    return charts
+
+def compute_charts(dataset: ColumnarDataset, chart_configs: List[ChartConfig]) -> Tuple[List[Dict[str, Any]], float, List[float]]:
+    """
+    Compute charts without the cache: returns the charts, the seconds spent
+    on the shared group-by pass and the seconds spent on each chart
+    """
+    plan = QueryPlan(dataset)
+    for config in chart_configs:
+        _plan_chart(plan, config)
+    started = time.perf_counter()
+    plan.execute()
+    plan_seconds = time.perf_counter() - started
+    
+    charts, chart_seconds = [], []
+    for config in chart_configs:
+        started = time.perf_counter()
+        charts.append(analyze_data_for_chart(dataset, config, plan))
+        chart_seconds.append(time.perf_counter() - started)
+    return charts, plan_seconds, chart_seconds
+
+def _chart_group_key(index: int, config: ChartConfig) -> Tuple:
+    """Charts with equal keys share grouped work and are best computed together"""
+    chart_type = config.chart_type.lower()
+    rows = filters_key(config.filters) if config.filters else None
+    if chart_type in ["bar_chart", "count_chart", "pie_chart", "line_chart"] and config.column:
+        return ("group", rows, config.column)
+    if chart_type == "grouped_bar_chart":
+        return ("group", rows, config.group_column, config.series_column)
+    return ("chart", index)
+
+def _chart_columns(dataset: ColumnarDataset, config: ChartConfig) -> List[str]:
+    """Every dataset column a chart may read"""
+    names = [config.column, config.x_column, config.y_column, config.group_column, config.series_column]
+    names += filter_columns(config.filters)
+    if config.aggregate_column:
+        # aggregate_column is matched case-insensitively ("all" usually matches nothing)
+        names += [col for col in dataset.column_names if col.lower() == config.aggregate_column.lower()]
+    return [name for name in names if name]
+
+def iter_charts(dataset: ColumnarDataset, chart_configs: List[ChartConfig]) -> Iterator[Tuple[int, Dict[str, Any], float]]:
+    """
+    Generator over chart_configs: yields (position, chart, seconds) as each
+    chart is computed. All grouped work is planned up front, so charts that
+    share a grouping still share its pass, but a grouping is only computed
+    when the first chart that needs it comes up (its time counts towards
+    that chart).
+    """
+    plan = QueryPlan(dataset)
+    for config in chart_configs:
+        _plan_chart(plan, config)
+    for position, config in enumerate(chart_configs):
+        started = time.perf_counter()
+        chart = analyze_data_for_chart(dataset, config, plan)
+        yield position, chart, time.perf_counter() - started
+
+def _cached_charts(dataset: ColumnarDataset, chart_configs: List[ChartConfig], cache: Optional[ResultCache],
+                   timer: RequestTimer) -> Tuple[Optional[ResultCache], List[Optional[Dict[str, Any]]]]:
+    """The cache to use (None when the dataset has no content hash) and the cached chart per config"""
+    with timer.stage("cache"):
+        if cache is None or dataset.fingerprint is None:
+            cache = None
+            charts = [None] * len(chart_configs)
+        else:
+            charts = [cache.get(dataset.fingerprint, config) for config in chart_configs]
+    for index, chart in enumerate(charts):
+        if chart is not None:
+            timer.add_chart(index, chart_configs[index].chart_type, chart_configs[index].aggregate, 0, cached=True)
+    return cache, charts
+
+def _analysis_kind(dataset: ColumnarDataset, inline: bool, pooled: bool = False) -> str:
+    kind = "inline" if inline else analysis_executor.choose(dataset.num_rows)
+    if kind == "inline" and pooled:
+        kind = "thread"
+    if kind == "process" and dataset.views is not None:
+        # Groupings of stored datasets are kept for later requests and
+        # appends, which only works when they are computed in this process
+        kind = "thread"
+    return kind
+
+async def _batch_calls(dataset: ColumnarDataset, chart_configs: List[ChartConfig], batches: List[List[int]],
+                       kind: str, timer: RequestTimer) -> List[Tuple[ColumnarDataset, List[ChartConfig]]]:
+    """(dataset, configs) per batch; for process workers, a dataset of only the columns the batch reads"""
+    calls = [(dataset, [chart_configs[index] for index in batch]) for batch in batches]
+    if kind == "process":
+        # Build the needed columns once here, then ship each batch only its own
+        def select_columns():
+            return [
+                (dataset.select(name for config in configs for name in _chart_columns(dataset, config)), configs)
+                for _, configs in calls
+            ]
+        with timer.stage("select"):
+            calls = await analysis_executor.run_in_thread(select_columns)
+    return calls
+
+async def analyze_charts_async(dataset: ColumnarDataset, chart_configs: List[ChartConfig],
+                               cache: Optional[ResultCache] = None, timer: Optional[RequestTimer] = None,
+                               inline: bool = False, pooled: bool = False) -> List[Dict[str, Any]]:
+    """
+    analyze_charts off the event loop.
+
+    Cached charts are served directly; the rest are split into batches of
+    charts that share grouped work, and the batches run in parallel on the
+    worker pool picked for the dataset size (or inline when asked to, e.g.
+    so a profile covers the work). pooled keeps small datasets off the event
+    loop too, so that several analyzed at once run in parallel. Stage and
+    chart timings go to the timer.
+    """
+    timer = timer or RequestTimer("internal")
+    cache, charts = _cached_charts(dataset, chart_configs, cache, timer)
+    missing = [index for index, chart in enumerate(charts) if chart is None]
+    if not missing:
+        return charts
+    
+    kind = _analysis_kind(dataset, inline, pooled)
+    keys = [_chart_group_key(index, chart_configs[index]) for index in missing]
+    batches = [[missing[position] for position in group]
+               for group in partition(keys, analysis_executor.max_workers if kind != "inline" else 1)]
+    calls = await _batch_calls(dataset, chart_configs, batches, kind, timer)
+    
+    with timer.stage(f"analyze-{kind}"):
+        results = await analysis_executor.map(compute_charts, calls, kind)
+    for batch, (batch_charts, plan_seconds, chart_seconds) in zip(batches, results):
+        timer.add("group_by", plan_seconds)
+        for index, chart, seconds in zip(batch, batch_charts, chart_seconds):
+            timer.add_chart(index, chart_configs[index].chart_type, chart_configs[index].aggregate, seconds, cached=False)
+            if cache is not None and "error" not in chart:
+                cache.put(dataset.fingerprint, chart_configs[index], chart)
+            charts[index] = chart
+    
+    return charts
+
+async def stream_charts_async(dataset: ColumnarDataset, chart_configs: List[ChartConfig],
+                              cache: Optional[ResultCache] = None,
+                              timer: Optional[RequestTimer] = None) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Like analyze_charts_async, but yields (index, chart) as soon as each chart
+    is ready: cached charts first, then computed ones in order of completion.
+    Batches run iter_charts; on a process pool every grouping is a batch of
+    its own, so charts come back as their grouping completes.
+    """
+    timer = timer or RequestTimer("internal")
+    cache, charts = _cached_charts(dataset, chart_configs, cache, timer)
+    for index, chart in enumerate(charts):
+        if chart is not None:
+            yield index, chart
+    missing = [index for index, chart in enumerate(charts) if chart is None]
+    if not missing:
+        return
+    
+    kind = _analysis_kind(dataset, False)
+    keys = [_chart_group_key(index, chart_configs[index]) for index in missing]
+    batch_count = {"inline": 1, "process": len(set(keys))}.get(kind, analysis_executor.max_workers)
+    batches = [[missing[position] for position in group] for group in partition(keys, batch_count)]
+    calls = await _batch_calls(dataset, chart_configs, batches, kind, timer)
+    
+    started = time.perf_counter()
+    async for batch, (position, chart, seconds) in analysis_executor.iterate(iter_charts, calls, kind):
+        index = batches[batch][position]
+        timer.add_chart(index, chart_configs[index].chart_type, chart_configs[index].aggregate, seconds, cached=False)
+        if cache is not None and "error" not in chart:
+            cache.put(dataset.fingerprint, chart_configs[index], chart)
+        yield index, chart
+    timer.add(f"analyze-{kind}", time.perf_counter() - started)
+
+def _charts_until(dataset: ColumnarDataset, chart_configs: List[ChartConfig],
+                  stop: Callable[[], bool]) -> List[Tuple[int, Dict[str, Any]]]:
+    """(position, chart) of the charts computed in order, until stop() returns True before one of them"""
+    charts = []
+    computed = iter_charts(dataset, chart_configs)
+    while not stop():
+        item = next(computed, None)
+        if item is None:
+            break
+        position, chart, _ = item
+        charts.append((position, chart))
+    return charts
+
+async def precompute_default_charts(dataset_id: str, precomputer: Precomputer) -> int:
+    """
+    Background job computing a stored dataset's suggested charts into the
+    result cache; it stops whenever requests come in and continues with the
+    charts left (and not cached meanwhile) once they are done. Returns the
+    number of charts computed.
+    """
+    computed = 0
+    remaining: Optional[List[ChartConfig]] = None
+    while True:
+        await precomputer.wait_turn()
+        entry = dataset_store.get(dataset_id)
+        if entry is None:
+            # Deleted or evicted meanwhile
+            return computed
+        dataset = entry.dataset
+        if remaining is None:
+            profile = await analysis_executor.run_in_thread(profile_dataset, dataset)
+            remaining = parse_chart_configs(profile["suggested_charts"])
+            continue
+        remaining = [config for config in remaining if not result_cache.contains(dataset.fingerprint, config)]
+        if not remaining:
+            return computed
+        charts = await analysis_executor.run_in_thread(_charts_until, dataset, remaining, precomputer.should_yield)
+        for position, chart in charts:
+            if "error" not in chart:
+                result_cache.put(dataset.fingerprint, remaining[position], chart)
+        computed += len(charts)
+        done = {position for position, _ in charts}
+        remaining = [config for position, config in enumerate(remaining) if position not in done]
+        if remaining:
+            precomputer.preempted += 1
+
+def queue_precompute(entry) -> None:
+    """Queue the default charts of a newly stored dataset to be computed in the background"""
+    precomputer.submit(entry.dataset_id, functools.partial(precompute_default_charts, entry.dataset_id))
+
+def _xy_points(dataset: ColumnarDataset, config: ChartConfig, date_formats: List[str], date_scale: float = 1):
+    """
+    Build {"x", "y"} points in row order.
+
+    y must be numeric. x may be numeric, a date string (converted to a
+    timestamp times date_scale) or any other string (mapped to an index in
+    order of first appearance). With config.max_points set and exceeded, the
+    points are sorted by x and downsampled.
+    Returns (points, skipped_count, parsed_any_date, original_point_count).
+    """
+    x_column = dataset.column(config.x_column)
+    y_column = dataset.column(config.y_column)
+
+    both = x_column.present & y_column.present
+    usable = both & y_column.numeric
+    x_numeric = usable & x_column.numeric
+    x_string = usable & ~x_column.numeric & x_column.strings
+    skipped_count = int(np.count_nonzero(both & ~y_column.numeric))
+    skipped_count += int(np.count_nonzero(usable & ~x_column.numeric & ~x_column.strings))
+
+    x_values = np.where(x_numeric, x_column.numbers, np.nan)
+    parsed_any_date = False
+    if x_string.any():
+        # Dates are parsed once per distinct string and cached on the column
+        string_rows = np.flatnonzero(x_string)
+        timestamps = column_dates(x_column, date_formats)[x_column.codes[string_rows]]
+        is_date = ~np.isnan(timestamps)
+        parsed_any_date = bool(is_date.any())
+        x_values[string_rows[is_date]] = timestamps[is_date] * date_scale
+
+        # Non-date strings are indexed in order of first appearance
+        other_rows = string_rows[~is_date]
+        if len(other_rows):
+            _, first_rows, inverse = np.unique(x_column.codes[other_rows], return_index=True, return_inverse=True)
+            rank = np.empty(len(first_rows), dtype=np.int64)
+            rank[np.argsort(first_rows, kind="stable")] = np.arange(len(first_rows))
+            x_values[other_rows] = rank[inverse.reshape(-1)]
+
+    point_rows = np.flatnonzero(x_numeric | x_string)
+    original_point_count = len(point_rows)
+    if config.max_points is not None and original_point_count > config.max_points:
+        order = np.argsort(x_values[point_rows], kind="stable")
+        point_rows = point_rows[order]
+        kept = downsample(x_values[point_rows], y_column.numbers[point_rows], config.max_points, config.downsample)
+        point_rows = point_rows[kept]
+
+    if x_column.integral and not x_string.any():
+        xs = x_values[point_rows].astype(np.int64).tolist()
+    else:
+        xs = x_values[point_rows].tolist()
+    ys = y_column.numbers[point_rows]
+    ys = ys.astype(np.int64).tolist() if y_column.integral else ys.tolist()
+    points = [{"x": x, "y": y} for x, y in zip(xs, ys)]
+    return points, skipped_count, parsed_any_date, original_point_count
+
+def _validate_downsampling(config: ChartConfig) -> None:
+    if config.max_points is not None and config.max_points < 3:
+        raise ValueError("max_points must be at least 3")
+    if config.downsample and config.downsample.upper() not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unsupported downsample method: {config.downsample}. Use one of: {', '.join(DOWNSAMPLE_METHODS)}")
+
+def _validate_ranking(config: ChartConfig) -> None:
+    for option in ("top_n", "top_series"):
+        if getattr(config, option) is not None and getattr(config, option) < 1:
+            raise ValueError(f"{option} must be at least 1")
+    if config.sort_by and config.sort_by.lower() not in SORT_BY_OPTIONS:
+        raise ValueError(f"Unsupported sort_by: {config.sort_by}. Use one of: {', '.join(SORT_BY_OPTIONS)}")
+    if config.sort_order and config.sort_order.lower() not in SORT_ORDER_OPTIONS:
+        raise ValueError(f"Unsupported sort_order: {config.sort_order}. Use one of: {', '.join(SORT_ORDER_OPTIONS)}")
+
+def _ranked(config: ChartConfig) -> bool:
+    """Whether a chart asks for top-N selection, value ordering or an Other bucket"""
+    return bool(config.top_n is not None or config.top_series is not None or config.other_bucket
+                or (config.sort_by and config.sort_by.lower() != "label") or config.sort_order)
+
+def _top_n(indexes: List[int], values: Union[List, Dict], n: Optional[int]) -> Tuple[List[int], List[int]]:
+    """
+    The n indexes with the largest values (ties go to the earlier index) and
+    the remaining ones; a heap selection, so no full sort of every group
+    """
+    if not n or len(indexes) <= n:
+        return indexes, []
+    top = heapq.nlargest(n, indexes, key=values.__getitem__)
+    kept = set(top)
+    return top, [index for index in indexes if index not in kept]
+
+def _sort_indexes(indexes: List[int], labels: Union[List, Dict], values: Union[List, Dict], config: ChartConfig) -> List[int]:
+    """Order entries by label or by value, as configured"""
+    sort_by = (config.sort_by or "label").lower()
+    descending = (config.sort_order or ("desc" if sort_by == "value" else "asc")).lower() == "desc"
+    key = values.__getitem__ if sort_by == "value" else labels.__getitem__
+    return sorted(indexes, key=key, reverse=descending)
+
+def _point_data(points: list, original_point_count: int, config: ChartConfig) -> Dict[str, Any]:
+    data = {"points": points}
+    if config.max_points is not None:
+        data["original_point_count"] = original_point_count
+        data["downsampled"] = len(points) < original_point_count
+    return data
+
+def sort_labels(labels: List[str]) -> List[str]:
+    """
+    Sort group labels chronologically if they are dates, numerically if they
+    are numbers, and as strings otherwise. Dates are parsed in bulk; mixed
+    labels sort dates first, then numbers, then strings.
+    """
+    timestamps = parse_dates(labels, ["%Y-%m-%d"])
+    keys = []
+    for label, timestamp in zip(labels, timestamps.tolist()):
+        if timestamp == timestamp:  # not NaN
+            keys.append((0, timestamp, ""))
+            continue
+        try:
+            keys.append((1, float(label), ""))
+        except ValueError:
+            keys.append((2, 0.0, label))
+    order = sorted(range(len(labels)), key=keys.__getitem__)
+    return [labels[index] for index in order]
+
+def _add_error_bounds(result: Dict[str, Any], shown) -> None:
+    """Report how far approximate values may be off, given (accumulator, groups shown) pairs"""
+    bounds = error_bounds(shown)
+    if bounds is not None:
+        result["approximation"] = bounds
+
+def analyze_data_for_chart(report_data: Union[List[Dict], ColumnarDataset], config: ChartConfig,
+                           plan: Optional[QueryPlan] = None) -> Dict[str, Any]:
     """Analyze report data based on chart configuration"""
     
     chart_type = config.chart_type.lower()
@@ -92,75 +603,60 @@ def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict
     }
     
     try:
-        if chart_type in ["bar_chart", "pie_chart"]:
+        if isinstance(report_data, ColumnarDataset):
+            dataset = report_data
+        else:
+            dataset = ColumnarDataset.from_records(report_data)
+        if plan is None:
+            plan = QueryPlan(dataset)
+        if config.filters:
+            plan = _chart_plan(plan, config)
+            dataset = plan.dataset
+
+        if chart_type in ["bar_chart", "count_chart", "pie_chart"]:
             # Bar/Pie chart with aggregation support
             if not config.column:
                 raise ValueError(f"Column is required for {chart_type}")
             
             aggregate_type = (config.aggregate or "COUNT").upper()
-            aggregate_column = config.aggregate_column
             
             # Group by column and aggregate
-            grouped_data = {}
-            for row in report_data:
-                col_val = str(row.get(config.column, ""))
-                if not col_val:
-                    continue
-                
-                if aggregate_type == "COUNT" and (not aggregate_column or aggregate_column == "all"):
-                    # Simple count of rows
-                    if col_val not in grouped_data:
-                        grouped_data[col_val] = []
-                    grouped_data[col_val].append(1)  # Count each row
-                elif aggregate_type == "DISTINCT_COUNT":
-                    # Distinct count - can count distinct values of a specific column or all rows
-                    if not aggregate_column or aggregate_column == "all":
-                        # Count distinct rows (each row is unique) - use a unique identifier
-                        if col_val not in grouped_data:
-                            grouped_data[col_val] = []
-                        # Use row index or a combination to make each row unique
-                        row_id = str(id(row))  # Unique identifier for each row
-                        grouped_data[col_val].append(row_id)
-                    else:
-                        # Count distinct values of a specific column
-                        distinct_val = row.get(aggregate_column)
-                        if distinct_val is not None:
-                            distinct_val = str(distinct_val)
-                            if col_val not in grouped_data:
-                                grouped_data[col_val] = []
-                            grouped_data[col_val].append(distinct_val)  # Store value for distinct counting
-                else:
-                    # Aggregate a specific column
-                    agg_col = aggregate_column if aggregate_column and aggregate_column != "all" else None
-                    if not agg_col:
-                        # Default: count rows
-                        if col_val not in grouped_data:
-                            grouped_data[col_val] = []
-                        grouped_data[col_val].append(1)
-                    else:
-                        agg_val = row.get(agg_col)
-                        if agg_val is not None:
-                            try:
-                                agg_val = float(agg_val) if not isinstance(agg_val, (int, float)) else agg_val
-                                if col_val not in grouped_data:
-                                    grouped_data[col_val] = []
-                                grouped_data[col_val].append(agg_val)
-                            except (ValueError, TypeError):
-                                pass
+            grouped, accumulator = plan.grouped((config.column,), aggregate_type, config.aggregate_column,
+                                                config.approximate)
+            
+            # Only groups that received a value are shown, by label unless
+            # ranked (then only the groups kept are sorted)
+            ranked = _ranked(config)
+            filled = np.flatnonzero(accumulator.counts).tolist()
+            group_labels = {index: grouped.labels(int(grouped.keys[index]))[0] for index in filled}
+            if not ranked:
+                filled.sort(key=group_labels.__getitem__)
+            group_values = {index: accumulator.result(index) for index in filled}
             
             # Calculate aggregates
             labels = []
             values = []
-            total_for_percentage = 0
+            other_indexes = []
+            if ranked:
+                _validate_ranking(config)
+                kept, other_indexes = _top_n(filled, group_values, config.top_n)
+                filled = _sort_indexes(kept, group_labels, group_values, config)
+            shown = [(accumulator, filled)]
+            for index in filled:
+                labels.append(group_labels[index])
+                values.append(group_values[index])
             
-            for col_val in sorted(grouped_data.keys()):
-                agg_result = aggregate_values(grouped_data[col_val], aggregate_type)
-                labels.append(col_val)
-                values.append(agg_result)
-                if aggregate_type == "PERCENTAGE":
-                    total_for_percentage += agg_result
+            if other_indexes and config.other_bucket:
+                # One group holding everything cut by top_n
+                mapping = np.ones(len(accumulator), dtype=np.int64)
+                mapping[other_indexes] = 0
+                other = regroup(accumulator, mapping, 2)
+                labels.append(OTHER_LABEL)
+                values.append(other.result(0))
+                shown.append((other, [0]))
             
-            # Convert to percentage if needed
+            # Convert to percentage if needed (of the total over every group)
+            total_for_percentage = sum(group_values.values()) if aggregate_type == "PERCENTAGE" else 0
             if aggregate_type == "PERCENTAGE" and total_for_percentage > 0:
                 values = [(v / total_for_percentage * 100) for v in values]
             
@@ -168,114 +664,60 @@ def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict
                 "labels": labels,
                 "values": values
             }
+            if other_indexes:
+                result["data"]["total_groups"] = len(group_values)
+            _add_error_bounds(result, shown)
             
         elif chart_type == "line_chart":
             # Line chart - can be raw data or aggregated
             # Check if it's aggregated mode (has column and aggregate) or raw mode (has x_column and y_column)
             if config.column and config.aggregate:
                 # Aggregated mode - same structure as bar chart
-                if not config.column:
-                    raise ValueError("column is required for aggregated line chart")
-                
                 aggregate_type = (config.aggregate or "COUNT").upper()
-                aggregate_column = config.aggregate_column
-                
-                grouped_data = {}
-                for row in report_data:
-                    col_val = str(row.get(config.column, ""))
-                    
-                    if col_val:
-                        if col_val not in grouped_data:
-                            grouped_data[col_val] = []
-                        
-                        if aggregate_type == "COUNT" and (not aggregate_column or aggregate_column == "all"):
-                            grouped_data[col_val].append(1)
-                        elif aggregate_type == "DISTINCT_COUNT":
-                            agg_col = aggregate_column if aggregate_column and aggregate_column != "all" else None
-                            if not agg_col:
-                                grouped_data[col_val].append(1)
-                            else:
-                                distinct_val = row.get(agg_col)
-                                if distinct_val is not None:
-                                    grouped_data[col_val].append(str(distinct_val))
-                        else:
-                            agg_col = aggregate_column if aggregate_column and aggregate_column != "all" else None
-                            if not agg_col:
-                                grouped_data[col_val].append(1)
-                            else:
-                                agg_val = row.get(agg_col)
-                                if agg_val is not None:
-                                    try:
-                                        agg_val = float(agg_val) if not isinstance(agg_val, (int, float)) else agg_val
-                                        grouped_data[col_val].append(agg_val)
-                                    except (ValueError, TypeError):
-                                        pass
-                
-                # Calculate aggregates
-                aggregated_data = {}
-                for col_val, values in grouped_data.items():
-                    aggregated_data[col_val] = aggregate_values(values, aggregate_type)
+                group_column = _line_group_column(config)
                 
-                # Sort by column value if possible (try to convert to date/number)
-                sorted_items = sorted(aggregated_data.items(), key=lambda x: try_convert_sort(x[0]))
+                grouped, accumulator = plan.grouped((group_column,), aggregate_type, config.aggregate_column,
+                                                    config.approximate)
                 
-                result["data"] = {
-                    "labels": [item[0] for item in sorted_items],
-                    "values": [item[1] for item in sorted_items]
-                }
+                if isinstance(group_column, TimeBucket):
+                    # Buckets are numbered in date order, so the groups are in order already
+                    buckets = bucket_column(dataset.column(config.column), group_column.bucket)
+                    labels = [buckets.categories[key] for key in grouped.keys.tolist()]
+                    result["data"] = {
+                        "labels": labels,
+                        "values": [accumulator.result(index) for index in range(len(labels))],
+                        "time_bucket": group_column.bucket
+                    }
+                    undated_rows = buckets.derived["undated_rows"]
+                    if undated_rows > 0 and not labels:
+                        result["error"] = f"Could not convert column '{config.column}' to dates for time_bucket '{group_column.bucket}'."
+                    elif undated_rows > 0:
+                        result["warning"] = f"Skipped {undated_rows} rows with non-date values"
+                else:
+                    # Every non-empty value is a point, even if nothing was aggregated for it
+                    aggregated_data = {}
+                    for index, key in enumerate(grouped.keys.tolist()):
+                        aggregated_data[grouped.labels(key)[0]] = accumulator.result(index)
+                    
+                    # Sort by column value if possible (date, then number, then string)
+                    sorted_labels = sort_labels(list(aggregated_data))
+                    
+                    result["data"] = {
+                        "labels": sorted_labels,
+                        "values": [aggregated_data[label] for label in sorted_labels]
+                    }
+                _add_error_bounds(result, [(accumulator, range(len(grouped.keys)))])
             elif config.x_column and config.y_column:
                 # Raw data mode - plot all points without aggregation (like XY chart)
-                points = []
-                skipped_count = 0
-                x_string_map = {}  # Map string x-values to numeric indices
-                x_index = 0
-                
-                for row in report_data:
-                    x_val = row.get(config.x_column)
-                    y_val = row.get(config.y_column)
-                    
-                    if x_val is not None and y_val is not None:
-                        try:
-                            # Try to convert y to float
-                            y_val = float(y_val) if not isinstance(y_val, (int, float)) else y_val
-                            
-                            # Try to convert x to float or date
-                            try:
-                                x_val = float(x_val) if not isinstance(x_val, (int, float)) else x_val
-                            except (ValueError, TypeError):
-                                # Try to parse as date first
-                                if isinstance(x_val, str):
-                                    try:
-                                        # Try common date formats
-                                        date_obj = datetime.strptime(x_val, "%Y-%m-%d")
-                                        x_val = date_obj.timestamp()  # Convert to timestamp
-                                    except (ValueError, TypeError):
-                                        try:
-                                            date_obj = datetime.strptime(x_val, "%Y-%m-%d %H:%M:%S")
-                                            x_val = date_obj.timestamp()
-                                        except (ValueError, TypeError):
-                                            # If not a date, convert to numeric index
-                                            if x_val not in x_string_map:
-                                                x_string_map[x_val] = x_index
-                                                x_index += 1
-                                            x_val = x_string_map[x_val]
-                                else:
-                                    skipped_count += 1
-                                    continue
-                            
-                            points.append({"x": x_val, "y": y_val})
-                        except (ValueError, TypeError):
-                            skipped_count += 1
-                            pass
+                _validate_downsampling(config)
+                points, skipped_count, _, original_point_count = _xy_points(dataset, config, LINE_DATE_FORMATS)
                 
                 if skipped_count > 0 and len(points) == 0:
                     result["error"] = f"Could not convert x_column '{config.x_column}' and y_column '{config.y_column}' to numeric values."
                 elif skipped_count > 0:
                     result["warning"] = f"Skipped {skipped_count} rows with non-numeric values"
                 
-                result["data"] = {
-                    "points": points
-                }
+                result["data"] = _point_data(points, original_point_count, config)
             else:
                 raise ValueError("For line chart, either provide column+aggregate (aggregated mode) or x_column+y_column (raw mode)")
             
@@ -284,109 +726,25 @@ def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict
             if not config.x_column or not config.y_column:
                 raise ValueError("x_column and y_column are required for xy chart")
             
-            points = []
-            skipped_count = 0
-            x_string_map = {}  # Map string x-values to numeric indices
-            x_index = 0
-            is_date_column = False
-            date_format = None
+            # The x column counts as a date column if one of its first few
+            # values is a date string
+            x_column = dataset.column(config.x_column)
+            first_rows = np.arange(min(5, dataset.num_rows))
+            first_rows = first_rows[x_column.strings[first_rows]]
+            is_date_column = bool(np.any(~np.isnan(column_dates(x_column)[x_column.codes[first_rows]])))
             
-            # Try to detect if x_column is a date column by checking first few rows
-            date_formats_to_try = [
-                ("%Y-%m-%d", "%Y-%m-%d"),
-                ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S"),
-                ("%d-%b-%Y", "%d-%b-%Y"),  # 01-Feb-2026
-                ("%d/%b/%Y", "%d/%b/%Y"),
-                ("%d/%m/%Y", "%d/%m/%Y"),
-                ("%m/%d/%Y", "%m/%d/%Y"),
-            ]
-            
-            for row in report_data[:5]:  # Check first 5 rows
-                x_val = row.get(config.x_column)
-                if x_val and isinstance(x_val, str):
-                    for fmt, fmt_name in date_formats_to_try:
-                        try:
-                            datetime.strptime(x_val, fmt)
-                            is_date_column = True
-                            date_format = fmt
-                            break
-                        except (ValueError, TypeError):
-                            continue
-                    if is_date_column:
-                        break
-            
-            for row in report_data:
-                x_val = row.get(config.x_column)
-                y_val = row.get(config.y_column)
-                
-                if x_val is not None and y_val is not None:
-                    try:
-                        # Try to convert y to float
-                        y_val = float(y_val) if not isinstance(y_val, (int, float)) else y_val
-                        
-                        # Try to convert x to float or date
-                        try:
-                            x_val = float(x_val) if not isinstance(x_val, (int, float)) else x_val
-                        except (ValueError, TypeError):
-                            # Try to parse as date first
-                            if isinstance(x_val, str):
-                                if is_date_column and date_format:
-                                    try:
-                                        date_obj = datetime.strptime(x_val, date_format)
-                                        x_val = date_obj.timestamp() * 1000  # Convert to milliseconds for Chart.js
-                                    except (ValueError, TypeError):
-                                        # If date parsing fails, try other formats
-                                        parsed = False
-                                        for fmt, _ in date_formats_to_try:
-                                            try:
-                                                date_obj = datetime.strptime(x_val, fmt)
-                                                x_val = date_obj.timestamp() * 1000
-                                                parsed = True
-                                                break
-                                            except (ValueError, TypeError):
-                                                continue
-                                        if not parsed:
-                                            # If not a date, convert to numeric index
-                                            if x_val not in x_string_map:
-                                                x_string_map[x_val] = x_index
-                                                x_index += 1
-                                            x_val = x_string_map[x_val]
-                                else:
-                                    # Try to parse as date anyway
-                                    parsed = False
-                                    for fmt, _ in date_formats_to_try:
-                                        try:
-                                            date_obj = datetime.strptime(x_val, fmt)
-                                            x_val = date_obj.timestamp() * 1000
-                                            is_date_column = True
-                                            parsed = True
-                                            break
-                                        except (ValueError, TypeError):
-                                            continue
-                                    if not parsed:
-                                        # If not a date, convert to numeric index
-                                        if x_val not in x_string_map:
-                                            x_string_map[x_val] = x_index
-                                            x_index += 1
-                                        x_val = x_string_map[x_val]
-                            else:
-                                skipped_count += 1
-                                continue
-                        
-                        points.append({"x": x_val, "y": y_val})
-                    except (ValueError, TypeError):
-                        skipped_count += 1
-                        pass
+            # Dates are converted to milliseconds for Chart.js
+            _validate_downsampling(config)
+            points, skipped_count, parsed_any_date, original_point_count = _xy_points(dataset, config, DATE_FORMATS, date_scale=1000)
+            is_date_column = is_date_column or parsed_any_date
             
             if skipped_count > 0 and len(points) == 0:
                 result["error"] = f"Could not convert x_column '{config.x_column}' and y_column '{config.y_column}' to numeric values. XY charts require numeric data."
             elif skipped_count > 0:
                 result["warning"] = f"Skipped {skipped_count} rows with non-numeric values"
             
-            result["data"] = {
-                "points": points,
-                "x_is_date": is_date_column
-            }
+            result["data"] = _point_data(points, original_point_count, config)
+            result["data"]["x_is_date"] = is_date_column
             
         elif chart_type == "grouped_bar_chart":
             # Grouped bar chart - group by group_column, series by series_column, with aggregation support
@@ -397,127 +755,86 @@ def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict
             aggregate_column = config.aggregate_column
             
             # Validate that aggregate_column is provided for numeric aggregations
-            numeric_aggregations = ["SUM", "AVG", "MIN", "MAX", "MEDIAN", "MODE", "PERCENTAGE"]
-            if aggregate_type in numeric_aggregations:
+            if aggregate_type in NUMERIC_AGGREGATIONS:
                 if not aggregate_column or aggregate_column == "all":
                     raise ValueError(f"aggregate_column is required for {aggregate_type} aggregation in grouped_bar_chart")
                 
                 # Verify the column exists in the data
-                if report_data and len(report_data) > 0:
-                    first_row = report_data[0]
-                    if aggregate_column not in first_row:
-                        # Try case-insensitive match
-                        matching_col = None
-                        for col in first_row.keys():
-                            if col.lower() == aggregate_column.lower():
-                                matching_col = col
-                                break
-                        if matching_col:
-                            aggregate_column = matching_col
-                        else:
-                            available_cols = ", ".join(list(first_row.keys())[:10])
-                            raise ValueError(f"Column '{aggregate_column}' not found in data. Available columns: {available_cols}")
+                aggregate_column = _resolve_aggregate_column(dataset, aggregate_column)
             
-            # Structure: {group_value: {series_value: [values]}}
-            grouped_data = {}
-            all_series_values = set()
+            grouped, accumulator = plan.grouped((config.group_column, config.series_column), aggregate_type, aggregate_column,
+                                                config.approximate)
             
-            for row in report_data:
-                group_val = str(row.get(config.group_column, ""))
-                series_val = str(row.get(config.series_column, ""))
-                
-                if group_val and series_val:
-                    all_series_values.add(series_val)
-                    
-                    if group_val not in grouped_data:
-                        grouped_data[group_val] = {}
-                    
-                    if series_val not in grouped_data[group_val]:
-                        grouped_data[group_val][series_val] = []
-                    
-                    # Collect values for aggregation
-                    if aggregate_type == "COUNT" and (not aggregate_column or aggregate_column == "all"):
-                        # Simple count of rows
-                        grouped_data[group_val][series_val].append(1)
-                    elif aggregate_type == "DISTINCT_COUNT":
-                        # Distinct count - can count distinct values of a specific column or all rows
-                        if not aggregate_column or aggregate_column == "all":
-                            # Count distinct rows - use unique identifier
-                            row_id = str(id(row))
-                            grouped_data[group_val][series_val].append(row_id)
-                        else:
-                            # Count distinct values of a specific column
-                            distinct_val = row.get(aggregate_column)
-                            if distinct_val is not None:
-                                distinct_val = str(distinct_val)
-                                grouped_data[group_val][series_val].append(distinct_val)
-                    else:
-                        # Aggregate a specific column (SUM, AVG, MIN, MAX, etc.)
-                        agg_col = aggregate_column if aggregate_column and aggregate_column != "all" else None
-                        if not agg_col:
-                            # This shouldn't happen due to validation above, but handle gracefully
-                            raise ValueError(f"aggregate_column is required for {aggregate_type} aggregation")
-                        else:
-                            agg_val = row.get(agg_col)
-                            if agg_val is not None:
-                                try:
-                                    agg_val = float(agg_val) if not isinstance(agg_val, (int, float)) else agg_val
-                                    grouped_data[group_val][series_val].append(agg_val)
-                                except (ValueError, TypeError):
-                                    # Skip non-numeric values
-                                    pass
+            # Groups and series that occur in some pair, and each pair's group
+            # and series; pairs stay sparse until the chart is cut down
+            group_codes, series_codes = grouped.key_codes()
+            group_ids, pair_group = np.unique(group_codes, return_inverse=True)
+            series_ids, pair_series = np.unique(series_codes, return_inverse=True)
+            group_categories = dataset.column(config.group_column).categories
+            series_categories = dataset.column(config.series_column).categories
+            group_labels = [group_categories[code] for code in group_ids.tolist()]
+            series_labels = [series_categories[code] for code in series_ids.tolist()]
             
-            # Sort series values for consistent ordering
-            sorted_series = sorted(all_series_values)
+            other_groups, other_series = [], []
+            if not _ranked(config):
+                # Sort group and series values for consistent ordering
+                sorted_groups = sorted(range(len(group_labels)), key=group_labels.__getitem__)
+                sorted_series = sorted(range(len(series_labels)), key=series_labels.__getitem__)
+            else:
+                _validate_ranking(config)
+                # Rank groups (series) by their aggregate over all series (groups)
+                sorted_groups = list(range(len(group_labels)))
+                sorted_series = list(range(len(series_labels)))
+                group_totals = regroup(accumulator, pair_group, len(group_labels))
+                group_values = [group_totals.result(index) for index in range(len(group_labels))]
+                sorted_groups, other_groups = _top_n(sorted_groups, group_values, config.top_n)
+                sorted_groups = _sort_indexes(sorted_groups, group_labels, group_values, config)
+                series_totals = regroup(accumulator, pair_series, len(series_labels))
+                series_values = [series_totals.result(index) for index in range(len(series_labels))]
+                sorted_series, other_series = _top_n(sorted_series, series_values, config.top_series)
+                sorted_series = _sort_indexes(sorted_series, series_labels, series_values, config)
             
-            # Sort group values
-            sorted_groups = sorted(grouped_data.keys())
+            # Cells of the kept groups x series, plus the Other row/column
+            group_slots = np.full(len(group_labels), len(sorted_groups), dtype=np.int64)
+            group_slots[sorted_groups] = np.arange(len(sorted_groups))
+            series_slots = np.full(len(series_labels), len(sorted_series), dtype=np.int64)
+            series_slots[sorted_series] = np.arange(len(sorted_series))
+            row_size = len(sorted_series) + 1
+            pair_cells = group_slots[pair_group] * row_size + series_slots[pair_series]
             
-            # Calculate aggregates for each group/series combination
-            aggregated_data = {}
-            for group_val in sorted_groups:
-                aggregated_data[group_val] = {}
-                for series_val in sorted_series:
-                    if group_val in grouped_data and series_val in grouped_data[group_val]:
-                        values = grouped_data[group_val][series_val]
-                        if values:  # Only aggregate if there are values
-                            aggregated_data[group_val][series_val] = aggregate_values(values, aggregate_type)
-                        else:
-                            aggregated_data[group_val][series_val] = 0
-                    else:
-                        aggregated_data[group_val][series_val] = 0
+            show_other_group = bool(other_groups and config.other_bucket)
+            show_other_series = bool(other_series and config.other_bucket)
+            group_count = len(sorted_groups) + show_other_group
+            series_count = len(sorted_series) + show_other_series
+            if other_groups or other_series:
+                cells = regroup(accumulator, pair_cells, (len(sorted_groups) + 1) * row_size)
+                cell_value = cells.result
+                shown = [(cells, range(len(cells)))]
+            else:
+                # Nothing was cut, so every cell is one pair
+                pair_of_cell = dict(zip(pair_cells.tolist(), range(len(pair_cells))))
+                cell_value = lambda cell: accumulator.result(pair_of_cell[cell]) if cell in pair_of_cell else 0
+                shown = [(accumulator, range(len(pair_cells)))]
             
             # Create datasets for each series
             datasets = []
-            colors = [
-                'rgba(102, 126, 234, 0.6)',
-                'rgba(118, 75, 162, 0.6)',
-                'rgba(255, 99, 132, 0.6)',
-                'rgba(54, 162, 235, 0.6)',
-                'rgba(255, 206, 86, 0.6)',
-                'rgba(75, 192, 192, 0.6)',
-                'rgba(153, 102, 255, 0.6)',
-                'rgba(255, 159, 64, 0.6)',
-                'rgba(199, 199, 199, 0.6)',
-                'rgba(83, 102, 255, 0.6)'
-            ]
-            
-            for idx, series_val in enumerate(sorted_series):
-                data = []
-                for group_val in sorted_groups:
-                    value = aggregated_data[group_val].get(series_val, 0)
-                    data.append(value)
+            for idx in range(series_count):
+                data = [cell_value(group * row_size + idx) for group in range(group_count)]
                 
                 datasets.append({
-                    "label": series_val,
+                    "label": series_labels[sorted_series[idx]] if idx < len(sorted_series) else OTHER_LABEL,
                     "data": data,
-                    "backgroundColor": colors[idx % len(colors)]
+                    "backgroundColor": CHART_COLORS[idx % len(CHART_COLORS)]
                 })
             
             result["data"] = {
-                "labels": sorted_groups,
+                "labels": [group_labels[index] for index in sorted_groups] + ([OTHER_LABEL] if show_other_group else []),
                 "datasets": datasets
             }
+            if other_groups or other_series:
+                result["data"]["total_groups"] = len(group_labels)
+                result["data"]["total_series"] = len(series_labels)
+            _add_error_bounds(result, shown)
             
         else:
             raise ValueError(f"Unsupported chart type: {chart_type}")
@@ -527,88 +844,799 @@ def analyze_data_for_chart(report_data: List[Dict], config: ChartConfig) -> Dict
     
     return result
 
-def try_convert_sort(value: str):
-    """Try to convert value for sorting (date, number, or string)"""
-    # Try date format
-    try:
-        return datetime.strptime(value, "%Y-%m-%d")
-    except:
-        pass
+def get_stored_dataset(dataset_id: str) -> ColumnarDataset:
+    """Look up a dataset uploaded through /api/datasets"""
+    entry = dataset_store.get(dataset_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Dataset '{dataset_id}' not found or expired. Upload it again via /api/datasets.")
+    return entry.dataset
+
+def _request_body_schema(model) -> Dict[str, Any]:
+    """OpenAPI requestBody for handlers that parse the raw body themselves"""
+    schema = model.model_json_schema()
+    definitions = schema.pop("$defs", {})
+    
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(definitions[node["$ref"].split("/")[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
     
-    # Try number
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": resolve(schema)}}}}
+
+@contextmanager
+def admission_errors():
+    """Report requests admission control turned away as 413, or 429 with Retry-After"""
     try:
-        return float(value)
-    except:
-        pass
+        yield
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers)
+
+@asynccontextmanager
+async def admitted(request: Request, timer: RequestTimer, fmt: Optional[str] = None,
+                   payload_bytes: Optional[int] = None):
+    """
+    Hold an admission ticket for the block, reserved by the body size before
+    the body is read (Content-Length unless payload_bytes is given). Refine it
+    with charge() once the dataset is known; a streamed response detaches the
+    ticket and releases it when the stream ends.
+    """
+    if payload_bytes is None:
+        try:
+            payload_bytes = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            payload_bytes = 0
+    with admission_errors():
+        admission_controller.check_size(payload_bytes)
+        with timer.stage("queue"):
+            ticket = await admission_controller.admit(admission_controller.estimate(payload_bytes, fmt))
+    try:
+        yield ticket
+    finally:
+        if not ticket.detached:
+            ticket.release()
+
+def analysis_cost(dataset: ColumnarDataset, chart_configs: List[ChartConfig], stored: bool = False) -> Cost:
+    """Estimated cost of analyzing dataset (whose columns are already built if stored), besides its payload"""
+    columns = set()
+    point_charts = 0
+    for config in chart_configs:
+        columns.update(_chart_columns(dataset, config))
+        chart_type = config.chart_type.lower()
+        if chart_type in ("xy_chart", "scatter_chart") or (chart_type == "line_chart" and not config.column):
+            point_charts += 1
+    return admission_controller.estimate(rows=dataset.num_rows, columns=0 if stored else len(columns),
+                                         charts=len(chart_configs), point_charts=point_charts)
+
+def records_cost(report_data: List[Dict[str, Any]]) -> Cost:
+    """Estimated cost of building the columns of report rows (by the first row's keys)"""
+    columns = len(report_data[0]) if report_data else 0
+    return admission_controller.estimate(rows=len(report_data), columns=columns)
+
+def chunked_ingest_cost() -> Cost:
+    """Estimated cost of a chunked upload: one chunk of rows at a time (of a wide report, as the columns are unknown yet)"""
+    return admission_controller.estimate(rows=CHUNK_ROWS, columns=CHUNKED_INGEST_COLUMNS)
+
+def charge(ticket: Ticket, cost: Cost) -> None:
+    """Reserve cost on top of the payload estimate the ticket was admitted with"""
+    with admission_errors():
+        ticket.resize(ticket.admitted_cost + cost)
+
+async def read_body(request: Request, timer: RequestTimer) -> bytes:
+    """The raw request body (413 as soon as it grows past ADMISSION_MAX_REQUEST_BYTES)"""
+    chunks = []
+    size = 0
+    with timer.stage("read"):
+        async for chunk in request.stream():
+            size += len(chunk)
+            with admission_errors():
+                admission_controller.check_size(size)
+            chunks.append(chunk)
+    body = b"".join(chunks)
+    REQUEST_BYTES.observe(len(body), endpoint=timer.endpoint)
+    return body
+
+async def spool_body(request: Request, timer: RequestTimer, fmt: Optional[str],
+                     hints: Dict[str, str]) -> Tuple[str, str]:
+    """
+    Write the request body to a temporary file as it arrives (it is never
+    held in memory, nor limited to ADMISSION_MAX_REQUEST_BYTES); returns the
+    file's path, which the caller removes, and the body's fingerprint
+    """
+    digest = hashlib.sha256()
+    size = 0
+    descriptor, path = tempfile.mkstemp(prefix="report-upload-", dir=SPILL_DIR)
+    try:
+        with timer.stage("read"), os.fdopen(descriptor, "wb") as f:
+            async for chunk in request.stream():
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    REQUEST_BYTES.observe(size, endpoint=timer.endpoint)
+    return path, digest_fingerprint(digest, fmt, hints)
+
+async def read_json_body(request: Request, timer: Optional[RequestTimer] = None) -> Dict[str, Any]:
+    """Parse the raw request body with the fast JSON parser"""
+    timer = timer or RequestTimer("internal")
+    body = await read_body(request, timer)
+    try:
+        with timer.stage("parse"):
+            payload = jsonio.loads(body)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
+    if not isinstance(payload, dict):
+        raise RequestValidationError([{"type": "dict_type", "loc": ("body",), "msg": "Input should be a valid dictionary", "input": None}])
+    return payload
+
+@contextmanager
+def ingest_errors():
+    """Report unreadable uploads as 400, and formats needing a missing dependency as 415"""
+    try:
+        yield
+    except UnsupportedFormatError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def upload_format(request: Request, explicit: Optional[str]) -> Optional[str]:
+    """Format of a report upload (None for JSON), from ?format= or the Content-Type header"""
+    with ingest_errors():
+        return body_format(request.headers.get("content-type"), explicit)
+
+async def read_columnar_body(request: Request, timer: RequestTimer, fmt: str,
+                             column_types: Optional[str]) -> Tuple[ColumnarDataset, str]:
+    """Dataset of an Arrow, Parquet or CSV body, and the body's fingerprint"""
+    body = await read_body(request, timer)
+    with ingest_errors():
+        hints = parse_column_types(column_types)
+        with timer.stage("ingest"):
+            dataset = await analysis_executor.run_in_thread(read_dataset, body, fmt, hints)
+    return dataset, body_fingerprint(body, fmt, hints)
+
+def parse_chart_configs(raw: Any, loc: tuple = ("body", "chart_configs")) -> List[ChartConfig]:
+    """Validate chart configurations with pydantic (they are small, unlike report rows)"""
+    try:
+        return chart_configs_adapter.validate_python(raw)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": loc + tuple(error["loc"])} for error in e.errors(include_url=False)])
+
+def analysis_response(content: Dict[str, Any], timer: RequestTimer, include_timings: bool = False,
+                      profile_path: Optional[str] = None) -> FastJSONResponse:
+    """
+    Serialise an analyze response, with a Server-Timing header and (if asked
+    for) a ``timings`` block; serialisation itself only shows in the header
+    """
+    if include_timings:
+        content["timings"] = timer.as_dict()
+    with timer.stage("serialize"):
+        response = FastJSONResponse(content=content)
+    RESPONSE_BYTES.observe(len(response.body), endpoint=timer.endpoint)
+    response.headers["Server-Timing"] = timer.server_timing()
+    if profile_path:
+        response.headers["X-Profile-File"] = os.path.basename(profile_path)
+    return response
+
+def stream_format(request: Request, explicit: Optional[str]) -> Optional[str]:
+    """Streamed response format (None for one JSON document), from ?stream= or the Accept header"""
+    try:
+        return negotiate_stream_format(request.headers.get("accept"), explicit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def streaming_analysis_response(dataset: ColumnarDataset, chart_configs: List[ChartConfig], timer: RequestTimer,
+                                fmt: str, include_timings: bool = False,
+                                ticket: Optional[Ticket] = None) -> StreamingResponse:
+    """
+    Stream every chart as soon as it is ready, then a final record with the
+    report count (and timings if asked for). The Server-Timing header only
+    covers the stages before streaming started. The admission ticket is held
+    until the stream ends (or the client goes away).
+    """
+    if ticket is not None:
+        ticket.detach()
+    
+    async def records():
+        sent = 0
+        try:
+            async for index, chart in stream_charts_async(dataset, chart_configs, result_cache, timer):
+                record = encode_event(fmt, "chart", {"index": index, "chart": chart})
+                sent += len(record)
+                yield record
+            done = {"done": True, "success": True, "report_count": dataset.num_rows, "chart_count": len(chart_configs)}
+            if include_timings:
+                done["timings"] = timer.as_dict()
+            record = encode_event(fmt, "done", done)
+        except Exception as e:
+            record = encode_event(fmt, "error", {"done": True, "success": False, "error": str(e)})
+        finally:
+            if ticket is not None:
+                ticket.release()
+        RESPONSE_BYTES.observe(sent + len(record), endpoint=timer.endpoint)
+        yield record
+    
+    response = StreamingResponse(records(), media_type=STREAM_FORMATS[fmt], headers=stream_headers(),
+                                 background=BackgroundTask(ticket.release) if ticket is not None else None)
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+class BatchDataset:
+    """A distinct dataset of a batch, the distinct charts its jobs ask for, and those jobs"""
+    
+    def __init__(self, dataset: ColumnarDataset, stored: bool):
+        self.dataset = dataset
+        self.stored = stored
+        self.configs: List[ChartConfig] = []
+        # (position in the batch, id, position of each chart among configs) per job
+        self.jobs: List[Tuple[int, Any, List[int]]] = []
+        self._positions: Dict[str, int] = {}
+    
+    def add_job(self, index: int, job_id: Any, configs: List[ChartConfig]) -> None:
+        positions = []
+        for config in configs:
+            key = config_key(config)
+            if key not in self._positions:
+                self._positions[key] = len(self.configs)
+                self.configs.append(config)
+            positions.append(self._positions[key])
+        self.jobs.append((index, job_id, positions))
+    
+    def results(self, charts: Union[List[Dict[str, Any]], Exception]) -> List[Dict[str, Any]]:
+        """The result of every job, given the charts of configs (or the error analyzing them)"""
+        if isinstance(charts, Exception):
+            return [_batch_error(index, job_id, 500, str(charts)) for index, job_id, _ in self.jobs]
+        return [{"index": index, "id": job_id, "success": True, "charts": [charts[position] for position in positions],
+                 "report_count": self.dataset.num_rows} for index, job_id, positions in self.jobs]
+
+def _batch_error(index: int, job_id: Any, status_code: int, detail: Any) -> Dict[str, Any]:
+    return {"index": index, "id": job_id, "success": False, "status_code": status_code, "error": detail}
+
+def resolve_batch_jobs(raw_jobs: List[Any]) -> Tuple[List[Optional[Dict[str, Any]]], Dict[str, BatchDataset]]:
+    """
+    Validate the jobs of a batch and group them by dataset content hash (the
+    id of stored datasets, the hash of the rows otherwise, so rows already
+    uploaded use the stored dataset). Returns the result of every invalid
+    job (None for the others) and the distinct datasets with their jobs.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(raw_jobs)
+    datasets: Dict[str, BatchDataset] = {}
+    for index, job in enumerate(raw_jobs):
+        loc = ("body", "jobs", index)
+        job_id = job.get("id", index) if isinstance(job, dict) else index
+        try:
+            if not isinstance(job, dict):
+                raise RequestValidationError([{"type": "dict_type", "loc": loc, "msg": "Input should be a valid dictionary", "input": None}])
+            configs = parse_chart_configs(job.get("chart_configs"), loc + ("chart_configs",))
+            if job.get("dataset_id"):
+                key = job["dataset_id"]
+                if key not in datasets:
+                    datasets[key] = BatchDataset(get_stored_dataset(key), stored=True)
+            elif job.get("report_data") is not None:
+                report_data = parse_report_data(job["report_data"], loc + ("report_data",))
+                key = dataset_fingerprint(report_data)
+                if key not in datasets:
+                    entry = dataset_store.get(key)
+                    if entry is not None:
+                        datasets[key] = BatchDataset(entry.dataset, stored=True)
+                    else:
+                        dataset = ColumnarDataset.from_records(report_data)
+                        # Content addressed like a stored dataset, so results are cached
+                        dataset.fingerprint = key
+                        datasets[key] = BatchDataset(dataset, stored=False)
+            else:
+                raise HTTPException(status_code=400, detail="Either report_data or dataset_id is required")
+        except RequestValidationError as e:
+            results[index] = _batch_error(index, job_id, 422, jsonable_encoder(e.errors()))
+            continue
+        except HTTPException as e:
+            results[index] = _batch_error(index, job_id, e.status_code, e.detail)
+            continue
+        datasets[key].add_job(index, job_id, configs)
+    return results, datasets
+
+async def analyze_batch_async(datasets: Dict[str, BatchDataset],
+                              timer: RequestTimer) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Analyze the distinct datasets of a batch at once, each on the worker pool
+    picked for its size (small ones on threads rather than inline, so they
+    run in parallel); yields the results of a dataset's jobs as it completes
+    """
+    async def analyze(batch_dataset: BatchDataset):
+        dataset_timer = RequestTimer(timer.endpoint)
+        try:
+            charts = await analyze_charts_async(batch_dataset.dataset, batch_dataset.configs, result_cache,
+                                                dataset_timer, pooled=True)
+        except Exception as e:
+            charts = e
+        timer.include(dataset_timer)
+        return batch_dataset.results(charts)
     
-    # Return as string
-    return value
+    for completed in asyncio.as_completed([analyze(batch_dataset) for batch_dataset in datasets.values()]):
+        yield await completed
+
+def streaming_batch_response(results: List[Optional[Dict[str, Any]]], datasets: Dict[str, BatchDataset],
+                             timer: RequestTimer, fmt: str, ticket: Ticket) -> StreamingResponse:
+    """Stream the result of every job as soon as its dataset is analyzed (invalid jobs first), then a done record"""
+    ticket.detach()
+    
+    async def records():
+        sent = 0
+        try:
+            for result in results:
+                if result is not None:
+                    record = encode_event(fmt, "job", result)
+                    sent += len(record)
+                    yield record
+            async for job_results in analyze_batch_async(datasets, timer):
+                for result in job_results:
+                    record = encode_event(fmt, "job", result)
+                    sent += len(record)
+                    yield record
+            record = encode_event(fmt, "done", {"done": True, "success": True, "job_count": len(results),
+                                                "dataset_count": len(datasets)})
+        except Exception as e:
+            record = encode_event(fmt, "error", {"done": True, "success": False, "error": str(e)})
+        finally:
+            ticket.release()
+        RESPONSE_BYTES.observe(sent + len(record), endpoint=timer.endpoint)
+        yield record
+    
+    response = StreamingResponse(records(), media_type=STREAM_FORMATS[fmt], headers=stream_headers(),
+                                 background=BackgroundTask(ticket.release))
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+def parse_report_data(raw: Any, loc: tuple = ("body", "report_data")) -> List[Dict[str, Any]]:
+    """Check report_data is a list of row objects without copying the rows"""
+    if not isinstance(raw, list):
+        raise RequestValidationError([{"type": "list_type", "loc": loc, "msg": "Input should be a valid list", "input": None}])
+    for index, row in enumerate(raw):
+        if not isinstance(row, dict):
+            raise RequestValidationError([{"type": "dict_type", "loc": loc + (index,), "msg": "Input should be a valid dictionary", "input": row}])
+    return raw
+
+FORMAT_QUERY = Query(None, description="Body format: json (default), arrow, arrow_file, parquet or csv; "
+                                         "defaults to what the Content-Type header says")
+COLUMN_TYPES_QUERY = Query(None, description='JSON object of CSV column types, e.g. {"amount": "float"} '
+                                             "(int, float, bool, string or date)")
+CHUNKED_QUERY = Query(False, description="Stream the body to disk and build the dataset in chunks of rows, "
+                                         "for reports too large to parse in memory")
+PRECOMPUTE_QUERY = Query(True, description="Compute the dataset's default (suggested) charts in the background, "
+                                          "so the first analyze request for them is a cache hit")
+# Columns a chunked upload is assumed to have when it is admitted
+CHUNKED_INGEST_COLUMNS = 32
+
+@app.post("/api/datasets", openapi_extra=_request_body_schema(DatasetUpload))
+async def upload_dataset(request: Request, format: Optional[str] = FORMAT_QUERY,
+                         column_types: Optional[str] = COLUMN_TYPES_QUERY, chunked: bool = CHUNKED_QUERY,
+                         precompute_charts: bool = PRECOMPUTE_QUERY):
+    """
+    Store report data server-side and return its content-addressed id.
+    Pass the id as dataset_id to /api/analyze instead of sending report_data again.
+    
+    The body is {"report_data": [...]}, or an Arrow IPC stream/file, Parquet
+    or CSV file (see the format parameter). With chunked=true it is written
+    to disk as it arrives and read back in chunks of rows (a JSON body may
+    then also be a bare array of rows or NDJSON).
+    
+    Unless precompute_charts is false, the dataset's suggested charts are
+    then computed in the background whenever no request is being served.
+    """
+    try:
+        with track_request("upload") as timer:
+            fmt = upload_format(request, format)
+            if chunked:
+                return await upload_chunked(request, timer, fmt, column_types, precompute_charts)
+            async with admitted(request, timer, fmt) as ticket:
+                if fmt is not None:
+                    body = await read_body(request, timer)
+                    with ingest_errors():
+                        hints = parse_column_types(column_types)
+                        with timer.stage("ingest"):
+                            entry = await analysis_executor.run_in_thread(
+                                dataset_store.put_dataset, body_fingerprint(body, fmt, hints),
+                                lambda: read_dataset(body, fmt, hints),
+                            )
+                    ROWS.observe(entry.dataset.num_rows, endpoint=timer.endpoint)
+                    if precompute_charts:
+                        queue_precompute(entry)
+                    return analysis_response({"success": True, **entry.info()}, timer)
+                
+                payload = await read_json_body(request, timer)
+                report_data = parse_report_data(payload.get("report_data"))
+                ROWS.observe(len(report_data), endpoint=timer.endpoint)
+                charge(ticket, records_cost(report_data))
+                with timer.stage("ingest"):
+                    entry = await analysis_executor.run_in_thread(dataset_store.put, report_data)
+                if precompute_charts:
+                    queue_precompute(entry)
+                return analysis_response({"success": True, **entry.info()}, timer)
+    except (HTTPException, RequestValidationError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def upload_chunked(request: Request, timer: RequestTimer, fmt: Optional[str],
+                         column_types: Optional[str], precompute_charts: bool = True) -> FastJSONResponse:
+    """Store an upload written to disk first and built chunk by chunk (see outofcore)"""
+    with ingest_errors():
+        hints = parse_column_types(column_types)
+    async with admitted(request, timer, fmt, payload_bytes=0) as ticket:
+        charge(ticket, chunked_ingest_cost())
+        path, fingerprint = await spool_body(request, timer, fmt, hints)
+        try:
+            with ingest_errors(), timer.stage("ingest"):
+                entry = await analysis_executor.run_in_thread(
+                    dataset_store.put_chunks, fingerprint, lambda: read_dataset_chunks(path, fmt, hints),
+                )
+        finally:
+            os.remove(path)
+    ROWS.observe(entry.dataset.num_rows, endpoint=timer.endpoint)
+    if precompute_charts:
+        queue_precompute(entry)
+    return analysis_response({"success": True, **entry.info()}, timer)
+
+@app.post("/api/datasets/{dataset_id}/append", openapi_extra=_request_body_schema(DatasetUpload))
+async def append_dataset(dataset_id: str, request: Request, format: Optional[str] = FORMAT_QUERY,
+                         column_types: Optional[str] = COLUMN_TYPES_QUERY,
+                         precompute_charts: bool = PRECOMPUTE_QUERY):
+    """
+    Append report rows to a stored dataset. The grown dataset gets a new id
+    (returned as dataset_id); group-by results already computed for the old
+    one are updated with the new rows only instead of being recomputed.
+    The rows can be sent in any format /api/datasets accepts.
+    """
+    try:
+        with track_request("append") as timer:
+            fmt = upload_format(request, format)
+            async with admitted(request, timer, fmt) as ticket:
+                if fmt is not None:
+                    rows, rows_fingerprint = await read_columnar_body(request, timer, fmt, column_types)
+                    row_count = rows.num_rows
+                    with timer.stage("append"):
+                        entry = await analysis_executor.run_in_thread(
+                            dataset_store.append_dataset, dataset_id, rows_fingerprint, lambda: rows,
+                        )
+                else:
+                    payload = await read_json_body(request, timer)
+                    report_data = parse_report_data(payload.get("report_data"))
+                    row_count = len(report_data)
+                    charge(ticket, records_cost(report_data))
+                    with timer.stage("append"):
+                        entry = await analysis_executor.run_in_thread(dataset_store.append, dataset_id, report_data)
+            ROWS.observe(row_count, endpoint=timer.endpoint)
+            if entry is None:
+                raise HTTPException(status_code=404, detail=f"Dataset '{dataset_id}' not found or expired. Upload it again via /api/datasets.")
+            if precompute_charts:
+                queue_precompute(entry)
+            return analysis_response({"success": True, **entry.info(), "appended_rows": row_count}, timer)
+    except (HTTPException, RequestValidationError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/datasets/{dataset_id}")
+async def dataset_info(dataset_id: str):
+    entry = dataset_store.get(dataset_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Dataset '{dataset_id}' not found or expired")
+    return FastJSONResponse(content={"success": True, **entry.info()})
+
+@app.delete("/api/datasets/{dataset_id}")
+async def delete_dataset(dataset_id: str):
+    if not dataset_store.delete(dataset_id):
+        raise HTTPException(status_code=404, detail=f"Dataset '{dataset_id}' not found or expired")
+    precomputer.discard(dataset_id)
+    result_cache.invalidate(dataset_id)
+    return FastJSONResponse(content={"success": True})
+
+@app.get("/api/cache")
+async def cache_stats():
+    """
+    Hit/miss/eviction counters of the chart result cache, the dataset store
+    and the shared cache, and the background precomputation queue
+    """
+    content = {"success": True, "result_cache": result_cache.stats(), "dataset_store": dataset_store.stats(),
+               "precompute": precomputer.stats()}
+    if shared_cache is not None:
+        content["shared_cache"] = shared_cache.stats()
+    return FastJSONResponse(content=content)
+
+@app.delete("/api/cache")
+async def invalidate_cache(dataset_id: Optional[str] = Query(None, description="Only drop results of this dataset")):
+    """Invalidate cached chart results"""
+    removed = result_cache.invalidate(dataset_id)
+    return FastJSONResponse(content={"success": True, "removed": removed})
+
+@app.get("/api/admission")
+async def admission_stats():
+    """Running and queued analysis requests, reserved memory and rejection counts of admission control"""
+    return FastJSONResponse(content={"success": True, **admission_controller.stats()})
 
 @app.get("/api/analyze")
 async def analyze_report(
-    report_data: str = Query(..., description="JSON string of report data"),
-    chart_configs: str = Query(..., description="JSON string of chart configurations")
+    request: Request,
+    chart_configs: str = Query(..., description="JSON string of chart configurations"),
+    report_data: Optional[str] = Query(None, description="JSON string of report data"),
+    dataset_id: Optional[str] = Query(None, description="Id of a dataset uploaded via /api/datasets"),
+    timings: bool = Query(False, description="Include per-stage and per-chart timings in the response"),
+    profile: bool = Query(False, description="Dump a cProfile of the request (needs ANALYSIS_PROFILE_DIR)"),
+    stream: Optional[str] = Query(None, description="Stream charts as they are computed: ndjson or sse (also negotiated via Accept)")
 ):
     """
     Analyze report data and generate chart configurations
     
     Example:
     /api/analyze?report_data=[{...}]&chart_configs=[{"chart_type":"count_chart","column":"partyType","title":"Orders by Party Type"}]
+    /api/analyze?dataset_id=<id>&chart_configs=[...]
+    
+    With stream=ndjson or stream=sse (or a matching Accept header), charts are
+    streamed as they are computed instead; SSE works with EventSource.
     """
     try:
-        # Parse JSON strings
-        report_json = json.loads(report_data)
-        configs_json = json.loads(chart_configs)
-        
-        # Validate and convert to models
-        if not isinstance(report_json, list):
-            raise ValueError("report_data must be an array")
-        
-        if not isinstance(configs_json, list):
-            raise ValueError("chart_configs must be an array")
-        
-        chart_configs_list = [ChartConfig(**config) for config in configs_json]
-        
-        # Generate chart data for each configuration
-        charts = []
-        for config in chart_configs_list:
-            chart_data = analyze_data_for_chart(report_json, config)
-            charts.append(chart_data)
-        
-        return JSONResponse(content={
-            "success": True,
-            "charts": charts,
-            "report_count": len(report_json)
-        })
+        with track_request("analyze_get") as timer:
+            payload_bytes = len(chart_configs) + len(report_data or "")
+            async with admitted(request, timer, payload_bytes=payload_bytes) as ticket:
+                with profiled(profile) as profile_result:
+                    # Parse JSON strings
+                    with timer.stage("parse"):
+                        configs_json = jsonio.loads(chart_configs)
+                    
+                    if not isinstance(configs_json, list):
+                        raise ValueError("chart_configs must be an array")
+                    
+                    with timer.stage("validate"):
+                        chart_configs_list = parse_chart_configs(configs_json, ("query", "chart_configs"))
+                    
+                    if dataset_id:
+                        dataset = get_stored_dataset(dataset_id)
+                    elif report_data is not None:
+                        REQUEST_BYTES.observe(len(report_data), endpoint=timer.endpoint)
+                        with timer.stage("parse"):
+                            report_json = jsonio.loads(report_data)
+                        
+                        # Validate and convert to models
+                        if not isinstance(report_json, list):
+                            raise ValueError("report_data must be an array")
+                        
+                        # Convert the rows to columnar form once; every chart reads from it
+                        dataset = ColumnarDataset.from_records(report_json)
+                    else:
+                        raise HTTPException(status_code=400, detail="Either report_data or dataset_id is required")
+                    ROWS.observe(dataset.num_rows, endpoint=timer.endpoint)
+                    charge(ticket, analysis_cost(dataset, chart_configs_list, stored=bool(dataset_id)))
+                    
+                    streamed = stream_format(request, stream)
+                    if streamed is not None and not profile:
+                        return streaming_analysis_response(dataset, chart_configs_list, timer, streamed, timings, ticket)
+                    
+                    # Generate chart data for each configuration
+                    charts = await analyze_charts_async(dataset, chart_configs_list, result_cache, timer,
+                                                        inline=profile)
+            
+            return analysis_response({
+                "success": True,
+                "charts": charts,
+                "report_count": dataset.num_rows
+            }, timer, timings, profile_result["path"])
         
+    except (HTTPException, RequestValidationError):
+        raise
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/analyze")
-async def analyze_report_post(request: ReportRequest):
+@app.post("/api/analyze", openapi_extra=_request_body_schema(ReportRequest))
+async def analyze_report_post(
+    request: Request,
+    timings: bool = Query(False, description="Include per-stage and per-chart timings in the response"),
+    profile: bool = Query(False, description="Dump a cProfile of the request (needs ANALYSIS_PROFILE_DIR)"),
+    format: Optional[str] = FORMAT_QUERY,
+    column_types: Optional[str] = COLUMN_TYPES_QUERY,
+    chart_configs: Optional[str] = Query(None, description="JSON string of chart configurations (Arrow, Parquet and CSV bodies)"),
+    stream: Optional[str] = Query(None, description="Stream charts as they are computed: ndjson or sse (also negotiated via Accept)")
+):
     """
-    Analyze report data via POST request
+    Analyze report data via POST request, with either report_data or the
+    dataset_id of a dataset uploaded via /api/datasets
+    
+    The body is parsed directly instead of through ReportRequest, so report
+    rows are not walked and copied by pydantic; only chart_configs are validated.
+    
+    The report can also be sent as an Arrow IPC stream/file, Parquet or CSV
+    body, with the chart configurations in the chart_configs parameter.
+    
+    With stream=ndjson or stream=sse (or a matching Accept header), charts are
+    streamed as they are computed instead of returned together.
     """
     try:
-        charts = []
-        for config in request.chart_configs:
-            chart_data = analyze_data_for_chart(request.report_data, config)
-            charts.append(chart_data)
-        
-        return JSONResponse(content={
-            "success": True,
-            "charts": charts,
-            "report_count": len(request.report_data)
-        })
+        with track_request("analyze_post") as timer:
+            fmt = upload_format(request, format)
+            async with admitted(request, timer, fmt) as ticket:
+                with profiled(profile) as profile_result:
+                    stored = False
+                    if fmt is not None:
+                        if chart_configs is None:
+                            raise HTTPException(status_code=400, detail="chart_configs is required with a non-JSON body")
+                        with timer.stage("validate"):
+                            configs = parse_chart_configs(jsonio.loads(chart_configs), ("query", "chart_configs"))
+                        dataset, _ = await read_columnar_body(request, timer, fmt, column_types)
+                    else:
+                        payload = await read_json_body(request, timer)
+                        with timer.stage("validate"):
+                            configs = parse_chart_configs(payload.get("chart_configs"))
+                        
+                        if payload.get("dataset_id"):
+                            dataset = get_stored_dataset(payload["dataset_id"])
+                            stored = True
+                        elif payload.get("report_data") is not None:
+                            # Convert the rows to columnar form once; every chart reads from it
+                            with timer.stage("validate"):
+                                report_data = parse_report_data(payload["report_data"])
+                            dataset = ColumnarDataset.from_records(report_data)
+                        else:
+                            raise HTTPException(status_code=400, detail="Either report_data or dataset_id is required")
+                    ROWS.observe(dataset.num_rows, endpoint=timer.endpoint)
+                    charge(ticket, analysis_cost(dataset, configs, stored))
+                    
+                    streamed = stream_format(request, stream)
+                    if streamed is not None and not profile:
+                        return streaming_analysis_response(dataset, configs, timer, streamed, timings, ticket)
+                    
+                    charts = await analyze_charts_async(dataset, configs, result_cache, timer, inline=profile)
+            
+            return analysis_response({
+                "success": True,
+                "charts": charts,
+                "report_count": dataset.num_rows
+            }, timer, timings, profile_result["path"])
         
+    except (HTTPException, RequestValidationError):
+        raise
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/analyze/batch", openapi_extra=_request_body_schema(BatchRequest))
+async def analyze_batch(
+    request: Request,
+    stream: Optional[str] = Query(None, description="Stream job results as they complete: ndjson or sse (also negotiated via Accept)")
+):
+    """
+    Analyze many (dataset, chart_configs) jobs in one request. Each job has
+    report_data or the dataset_id of a stored dataset, its chart_configs and
+    an optional id that is echoed back.
+    
+    Jobs over the same rows share one dataset (by content hash) and identical
+    charts are computed once; the distinct datasets are analyzed in parallel.
+    The result of every job, with its charts or its error, comes back in
+    jobs, in order; an invalid job or unknown dataset fails only that job.
+    With stream=ndjson or stream=sse, job results are streamed as they are
+    ready instead.
+    """
+    try:
+        with track_request("analyze_batch") as timer:
+            async with admitted(request, timer) as ticket:
+                payload = await read_json_body(request, timer)
+                raw_jobs = payload.get("jobs")
+                if not isinstance(raw_jobs, list):
+                    raise RequestValidationError([{"type": "list_type", "loc": ("body", "jobs"), "msg": "Input should be a valid list", "input": None}])
+                with timer.stage("validate"):
+                    results, datasets = await analysis_executor.run_in_thread(resolve_batch_jobs, raw_jobs)
+                cost = Cost(0, 0.0)
+                for batch_dataset in datasets.values():
+                    ROWS.observe(batch_dataset.dataset.num_rows, endpoint=timer.endpoint)
+                    cost += analysis_cost(batch_dataset.dataset, batch_dataset.configs, batch_dataset.stored)
+                charge(ticket, cost)
+                
+                streamed = stream_format(request, stream)
+                if streamed is not None:
+                    return streaming_batch_response(results, datasets, timer, streamed, ticket)
+                
+                async for job_results in analyze_batch_async(datasets, timer):
+                    for result in job_results:
+                        results[result["index"]] = result
+            
+            return analysis_response({
+                "success": True,
+                "jobs": results,
+                "job_count": len(results),
+                "dataset_count": len(datasets)
+            }, timer)
+    
+    except (HTTPException, RequestValidationError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/profile", openapi_extra=_request_body_schema(ProfileRequest))
+async def profile_report(request: Request, format: Optional[str] = FORMAT_QUERY,
+                         column_types: Optional[str] = COLUMN_TYPES_QUERY):
+    """
+    Column types (numeric, date, categorical), null rates, cardinalities,
+    numeric min/max and date formats of a report, plus suggested chart configs.
+    
+    The body is {"dataset_id": ...} or {"report_data": [...]}, or an Arrow,
+    Parquet or CSV file as for /api/datasets. Profiles of stored datasets
+    are cached with the dataset.
+    """
+    try:
+        with track_request("profile") as timer:
+            fmt = upload_format(request, format)
+            async with admitted(request, timer, fmt) as ticket:
+                stored = False
+                if fmt is not None:
+                    dataset, _ = await read_columnar_body(request, timer, fmt, column_types)
+                else:
+                    payload = await read_json_body(request, timer)
+                    if payload.get("dataset_id"):
+                        dataset = get_stored_dataset(payload["dataset_id"])
+                        stored = True
+                    elif payload.get("report_data") is not None:
+                        with timer.stage("validate"):
+                            report_data = parse_report_data(payload["report_data"])
+                        dataset = ColumnarDataset.from_records(report_data)
+                    else:
+                        raise HTTPException(status_code=400, detail="Either report_data or dataset_id is required")
+                ROWS.observe(dataset.num_rows, endpoint=timer.endpoint)
+                if not stored:
+                    charge(ticket, admission_controller.estimate(rows=dataset.num_rows,
+                                                                 columns=len(dataset.column_names)))
+                with timer.stage("profile"):
+                    profile = await analysis_executor.run_in_thread(profile_dataset, dataset)
+                return analysis_response({"success": True, **profile}, timer)
+    except (HTTPException, RequestValidationError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: latency histograms, row counts, payload sizes, in-flight requests"""
+    cache, store, admission = result_cache.stats(), dataset_store.stats(), admission_controller.stats()
+    background = precomputer.stats()
+    extra = [
+        ("analysis_result_cache_hits_total", "counter", "Chart result cache hits", cache["hits"]),
+        ("analysis_result_cache_misses_total", "counter", "Chart result cache misses", cache["misses"]),
+        ("analysis_result_cache_bytes", "gauge", "Approximate size of cached chart results", cache["size_bytes"]),
+        ("analysis_datasets_stored", "gauge", "Datasets in the dataset store", store["datasets"]),
+        ("analysis_dataset_store_bytes", "gauge", "Approximate size of stored datasets", store["size_bytes"]),
+        ("analysis_admission_running", "gauge", "Requests admitted and running", admission["running"]),
+        ("analysis_admission_queue_depth", "gauge", "Requests waiting for admission", admission["queued"]),
+        ("analysis_admission_memory_reserved_bytes", "gauge", "Estimated memory reserved by running requests",
+         admission["memory_reserved_bytes"]),
+        ("analysis_admission_admitted_total", "counter", "Requests admitted", admission["admitted"]),
+        ("analysis_precompute_queue_depth", "gauge", "Datasets waiting for their default charts to be precomputed",
+         background["queued"]),
+        ("analysis_precompute_charts_total", "counter", "Charts precomputed in the background", background["charts"]),
+        ("analysis_precompute_preempted_total", "counter", "Precomputation jobs that stopped for requests",
+         background["preempted"]),
+    ]
+    if shared_cache is not None:
+        shared = shared_cache.stats()
+        extra += [
+            ("analysis_shared_cache_bytes", "gauge", "Size of the datasets and results in the shared cache",
+             shared["size_bytes"]),
+            ("analysis_shared_cache_hits_total", "counter", "Shared cache hits of this worker", shared["hits"]),
+            ("analysis_shared_cache_misses_total", "counter", "Shared cache misses of this worker", shared["misses"]),
+        ]
+    return PlainTextResponse(render_metrics(extra), media_type="text/plain; version=0.0.4")
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    precomputer.shutdown()
+    analysis_executor.shutdown()
+
 @app.get("/")
 async def root():
-    return {"message": "Report Analysis API", "endpoints": ["/api/analyze"]}
+    return {"message": "Report Analysis API", "endpoints": ["/api/analyze", "/api/analyze/batch", "/api/datasets", "/api/profile", "/api/cache", "/api/admission", "/metrics"]}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,257 @@
+"""
+Request instrumentation.
+
+- ``RequestTimer`` times the stages of one analyze request (body read, JSON
+  parsing, chart config validation, the shared group-by pass, every chart,
+  response serialisation) and renders them as a ``Server-Timing`` header or
+  a ``timings`` payload block.
+- Process-wide counters, gauges and histograms are exposed in the
+  Prometheus text format by ``GET /metrics``.
+- ``profiled`` dumps a cProfile of a request to ``ANALYSIS_PROFILE_DIR``; it
+  is only available when that variable is set.
+"""
+import cProfile
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+# Chart types and aggregates come from requests; anything else is
+# reported as "other" to keep label cardinality bounded
+CHART_TYPE_LABELS = {"bar_chart", "pie_chart", "count_chart", "line_chart", "xy_chart", "scatter_chart", "grouped_bar_chart"}
+AGGREGATE_LABELS = {"", "COUNT", "SUM", "AVG", "MIN", "MAX", "MEDIAN", "P90", "P95", "P99", "MODE", "PERCENTAGE",
+                    "DISTINCT_COUNT"}
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label set: cumulative bucket counts, sum, count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("analysis_request_duration_seconds", "Analyze request latency", ("endpoint", "status"))
+REQUESTS_IN_FLIGHT = Gauge("analysis_requests_in_flight", "Analyze requests currently being processed", ("endpoint",))
+STAGE_SECONDS = Histogram("analysis_stage_duration_seconds", "Time spent per request stage", ("stage",))
+CHART_SECONDS = Histogram("analysis_chart_duration_seconds", "Time spent per chart", ("chart_type", "aggregate"))
+CHARTS_TOTAL = Counter("analysis_charts_total", "Charts returned", ("chart_type", "aggregate", "source"))
+ROWS = Histogram("analysis_rows", "Rows per analyzed dataset", ("endpoint",), buckets=ROW_BUCKETS)
+REQUEST_BYTES = Histogram("analysis_request_bytes", "Request body size", ("endpoint",), buckets=BYTE_BUCKETS)
+RESPONSE_BYTES = Histogram("analysis_response_bytes", "Response body size", ("endpoint",), buckets=BYTE_BUCKETS)
+ADMISSION_WAIT_SECONDS = Histogram("analysis_admission_wait_seconds", "Time admitted requests waited in the admission queue")
+ADMISSION_REJECTIONS = Counter("analysis_admission_rejections_total", "Requests rejected by admission control", ("reason",))
+
+REGISTRY: List[_Metric] = [
+    REQUEST_SECONDS, REQUESTS_IN_FLIGHT, STAGE_SECONDS, CHART_SECONDS, CHARTS_TOTAL, ROWS, REQUEST_BYTES, RESPONSE_BYTES,
+    ADMISSION_WAIT_SECONDS, ADMISSION_REJECTIONS,
+]
+
+
+def render_metrics(extra: Sequence[Tuple[str, str, str, float]] = ()) -> str:
+    """
+    All metrics in the Prometheus text exposition format, plus extra
+    unlabelled (name, type, help, value) samples read at scrape time
+    """
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for name, kind, documentation, value in extra:
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {_format_value(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimer:
+    """Stage and per-chart timings of one request"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.charts: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages.append((name, seconds))
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+    def add_chart(self, index: int, chart_type: str, aggregate: Optional[str], seconds: float, cached: bool) -> None:
+        aggregate = (aggregate or "").upper()
+        chart_type = chart_type.lower()
+        self.charts.append({"index": index, "chart_type": chart_type, "aggregate": aggregate or None,
+                            "ms": round(seconds * 1000, 3), "cached": cached})
+        chart_type = chart_type if chart_type in CHART_TYPE_LABELS else "other"
+        aggregate = aggregate if aggregate in AGGREGATE_LABELS else "other"
+        CHARTS_TOTAL.inc(chart_type=chart_type, aggregate=aggregate, source="cache" if cached else "computed")
+        if not cached:
+            CHART_SECONDS.observe(seconds, chart_type=chart_type, aggregate=aggregate)
+
+    def include(self, other: "RequestTimer") -> None:
+        """Add the stages of a sub-request's timer (already observed) to this one's, without its charts"""
+        self.stages.extend(other.stages)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: every stage, then every computed chart"""
+        entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages]
+        for chart in self.charts:
+            if not chart["cached"]:
+                desc = f'{chart["chart_type"]} {chart["aggregate"] or ""}'.strip()
+                entries.append(f'chart-{chart["index"]};desc="{desc}";dur={chart["ms"]:.3f}')
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ", ".join(entries)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """The ``timings`` block of a response (milliseconds)"""
+        stages: Dict[str, float] = {}
+        for name, seconds in self.stages:
+            stages[name] = round(stages.get(name, 0) + seconds * 1000, 3)
+        return {
+            "stages_ms": stages,
+            "charts": self.charts,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 3),
+        }
+
+
+@contextmanager
+def track_request(endpoint: str) -> Iterator[RequestTimer]:
+    """Count a request in flight and record its latency and status"""
+    timer = RequestTimer(endpoint)
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    status = "500"
+    try:
+        yield timer
+        status = "200"
+    except Exception as e:
+        status = str(getattr(e, "status_code", 422 if type(e).__name__ == "RequestValidationError" else 500))
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        REQUEST_SECONDS.observe(time.perf_counter() - timer.started, endpoint=endpoint, status=status)
+
+
+PROFILE_DIR = os.getenv("ANALYSIS_PROFILE_DIR")
+# Only one profiler can be active at a time
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def profiled(enabled: bool) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    cProfile the block when enabled and ANALYSIS_PROFILE_DIR is set; the
+    dump's path is available as ``["path"]`` afterwards (else None)
+    """
+    result: Dict[str, Optional[str]] = {"path": None}
+    if not enabled or not PROFILE_DIR or not _profile_lock.acquire(blocking=False):
+        yield result
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        _profile_lock.release()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof")
+        profiler.dump_stats(path)
+        result["path"] = path
@@ -0,0 +1,231 @@
+"""
+Out-of-core execution for reports larger than memory.
+
+Two parts of the pipeline hold a whole report at once when it is done in
+memory: parsing the upload into row dicts, and grouping (a key and a group
+number per row, one ``np.unique`` over all of them). For large datasets both
+work in fixed-size chunks of rows instead:
+
+- ``DatasetWriter`` builds a stored dataset chunk by chunk. Each chunk is
+  converted to columns on its own, its categories are renumbered against the
+  dictionaries of the chunks before it, and the arrays are appended to the
+  dataset's files on disk, which are opened memory-mapped at the end. The
+  result is the dataset ``ColumnarDataset.from_records`` (or the Arrow/CSV
+  readers) would build from the whole body.
+- ``QueryPlan`` groups datasets of at least ``OUT_OF_CORE_MIN_ROWS`` rows
+  chunk by chunk: one pass collects the group keys, a second folds every
+  chunk into the accumulators with ``update_chunk``, which ends in the same
+  state (bit for bit) as aggregating all rows at once.
+- MEDIAN, MODE and DISTINCT_COUNT keep per-value state. MEDIAN and MODE
+  always, and DISTINCT_COUNT when a grouping has more than
+  ``OUT_OF_CORE_MAX_GROUPS`` groups, spill their values to a temporary file
+  ordered by group (``ValueSpill``) and read a group's values back from it
+  when its result is asked for. Their approximate sketches are bounded in
+  size and stay in memory.
+
+Configuration (environment variables):
+
+- ``OUT_OF_CORE_MIN_ROWS``: datasets with at least this many rows are grouped
+  in chunks (default 4194304)
+- ``OUT_OF_CORE_CHUNK_ROWS``: rows per chunk (default 1048576)
+- ``OUT_OF_CORE_MAX_GROUPS``: group count above which DISTINCT_COUNT state is
+  spilled to disk (default 100000)
+- ``OUT_OF_CORE_SPILL_DIR``: where spill files are created (default: the temp directory)
+"""
+import io
+import json
+import os
+import tempfile
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from columnar import ARRAY_FIELDS, MISSING, Column, ColumnarDataset
+
+MIN_ROWS = int(os.getenv("OUT_OF_CORE_MIN_ROWS", str(1 << 22)))
+CHUNK_ROWS = max(int(os.getenv("OUT_OF_CORE_CHUNK_ROWS", str(1 << 20))), 1)
+MAX_GROUPS = int(os.getenv("OUT_OF_CORE_MAX_GROUPS", "100000"))
+SPILL_DIR = os.getenv("OUT_OF_CORE_SPILL_DIR") or None
+
+# Array type of each per-row field of a Column, as written by DatasetWriter
+FIELD_DTYPES = {
+    "codes": np.int32,
+    "present": np.bool_,
+    "numbers": np.float64,
+    "numeric": np.bool_,
+    "strings": np.bool_,
+}
+
+
+def in_chunks(dataset: ColumnarDataset) -> bool:
+    """True when the dataset is large enough to be grouped chunk by chunk"""
+    return dataset.num_rows >= MIN_ROWS
+
+
+def chunk_bounds(num_rows: int, chunk_rows: int = CHUNK_ROWS) -> Iterator[Tuple[int, int]]:
+    """(start, end) of consecutive chunks of at most chunk_rows rows"""
+    for start in range(0, num_rows, chunk_rows):
+        yield start, min(start + chunk_rows, num_rows)
+
+
+def _disk_array(size: int, dtype) -> np.ndarray:
+    """Writable array of size items backed by an anonymous temporary file"""
+    if size == 0:
+        return np.empty(0, dtype=dtype)
+    # The file has no name, so it disappears with the mapping
+    return np.memmap(tempfile.TemporaryFile(dir=SPILL_DIR), dtype=dtype, mode="w+", shape=(size,))
+
+
+class ValueSpill(Mapping):
+    """
+    The values of a holistic aggregate on disk, ordered by group and by row
+    within a group. Built from the per-group counts of a first pass, then
+    filled chunk by chunk with add; maps a group to its values (a slice of
+    the file, read when used).
+    """
+
+    def __init__(self, counts: np.ndarray, dtype):
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.values = _disk_array(int(self.offsets[-1]), dtype)
+        # Where the next value of each group goes
+        self._next = self.offsets[:-1].copy()
+        # Groups in order of their first value, the order in which an
+        # accumulator holding them in memory would have seen them
+        self._seen: List[np.ndarray] = []
+
+    def add(self, groups: np.ndarray, values: np.ndarray) -> None:
+        """Write the next values of their groups (rows in order)"""
+        if not len(groups):
+            return
+        order = np.argsort(groups, kind="stable")
+        sorted_groups = groups[order]
+        touched, starts, counts = np.unique(sorted_groups, return_index=True, return_counts=True)
+        new = self._next[touched] == self.offsets[touched]
+        self._seen.append(touched[new][np.argsort(order[starts][new])])
+        # Rank of every value among its group's values in this chunk
+        ranks = np.arange(len(order)) - np.repeat(starts, counts)
+        self.values[self._next[sorted_groups] + ranks] = np.asarray(values)[order]
+        self._next[touched] += counts
+
+    def __getitem__(self, group):
+        start, end = self.offsets[group], self.offsets[group + 1]
+        if start == end:
+            raise KeyError(group)
+        return self.values[start:end]
+
+    def __iter__(self):
+        if len(self._seen) != 1:
+            self._seen = [np.concatenate(self._seen) if self._seen else np.zeros(0, dtype=np.int64)]
+        return iter(self._seen[0].tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+
+def _npy_header(dtype, rows: int) -> bytes:
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (rows,)}
+    )
+    return header.getvalue()
+
+
+class _ColumnWriter:
+    """Appends the chunks of one column to its .npy files"""
+
+    def __init__(self, directory: str, name: str, prefix: str):
+        self.name = name
+        self.prefix = prefix
+        self.rows = 0
+        # Category -> code over every chunk so far, in order of first appearance
+        self.lookup: Dict[str, int] = {}
+        self.any_numeric = False
+        self.all_ints = True
+        self.files = {}
+        for field in ARRAY_FIELDS:
+            f = open(os.path.join(directory, f"{prefix}.{field}.npy"), "wb")
+            # numpy pads the header so a longer shape fits in place later
+            f.write(_npy_header(FIELD_DTYPES[field], 0))
+            self.files[field] = f
+
+    def add(self, column: Column) -> None:
+        remap = np.array([self.lookup.setdefault(category, len(self.lookup)) for category in column.categories],
+                         dtype=np.int32)
+        codes = remap[column.codes] if len(column.codes) else column.codes
+        arrays = {"codes": codes, "present": column.present, "numbers": column.numbers,
+                  "numeric": column.numeric, "strings": column.strings}
+        for field in ARRAY_FIELDS:
+            np.asarray(arrays[field], dtype=FIELD_DTYPES[field]).tofile(self.files[field])
+        # Ints only if no chunk contributed a non-int number, like Column.append
+        numeric = bool(column.numeric.any())
+        self.any_numeric = self.any_numeric or numeric
+        self.all_ints = self.all_ints and (column.integral or not numeric)
+        self.rows += len(column)
+
+    def add_missing(self, rows: int) -> None:
+        """Rows that lack the column"""
+        for start, end in chunk_bounds(rows):
+            self.add(Column.from_values(self.name, [MISSING] * (end - start)))
+
+    def finish(self) -> Dict[str, object]:
+        for field, f in self.files.items():
+            header = _npy_header(FIELD_DTYPES[field], self.rows)
+            if len(header) != len(_npy_header(FIELD_DTYPES[field], 0)):
+                raise RuntimeError(f"Cannot write the shape of column '{self.name}' into its .npy header")
+            f.seek(0)
+            f.write(header)
+            f.close()
+        return {"name": self.name, "prefix": self.prefix, "categories": list(self.lookup),
+                "integral": self.any_numeric and self.all_ints}
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+
+
+class DatasetWriter:
+    """
+    Writes a dataset to a directory chunk by chunk, in the layout
+    ``ColumnarDataset.save`` uses; only one chunk is in memory at a time
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.num_rows = 0
+        # As reported by the first row, like ColumnarDataset.from_records
+        self.column_names: Optional[List[str]] = None
+        self._columns: Dict[str, _ColumnWriter] = {}
+
+    def add(self, chunk: ColumnarDataset) -> None:
+        """Append the rows of a chunk (its columns are built here)"""
+        if self.column_names is None or (not self.num_rows and chunk.num_rows):
+            self.column_names = chunk.column_names
+        columns = chunk.materialize().columns
+        for column in columns:
+            writer = self._columns.get(column.name)
+            if writer is None:
+                writer = self._columns[column.name] = _ColumnWriter(self.directory, column.name,
+                                                                    f"c{len(self._columns)}")
+                # Rows of earlier chunks lack it
+                writer.add_missing(self.num_rows)
+            writer.add(column)
+        names = {column.name for column in columns}
+        for name, writer in self._columns.items():
+            if name not in names:
+                writer.add_missing(chunk.num_rows)
+        self.num_rows += chunk.num_rows
+
+    def finish(self) -> ColumnarDataset:
+        """Complete the files and open the dataset memory-mapped"""
+        columns = [writer.finish() for writer in self._columns.values()]
+        meta = {"num_rows": self.num_rows, "column_names": self.column_names or [], "columns": columns}
+        with open(os.path.join(self.directory, "dataset.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        return ColumnarDataset.open(self.directory)
+
+    def close(self) -> None:
+        """Release the files of an abandoned write"""
+        for writer in self._columns.values():
+            writer.close()
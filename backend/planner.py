@@ -0,0 +1,495 @@
+"""
+Query planning for grouped charts.
+
+Bar, pie, aggregated line and grouped bar charts all reduce to "group rows by
+one or more columns, then aggregate a value per group". A dashboard usually
+asks for several of those over the same columns (bar + pie + line on
+``partyType``, or SUM and AVG over the same group). ``QueryPlan`` collects the
+(group columns, aggregate, aggregate column) work of every chart in a request,
+drops duplicates, and computes each grouping in a single pass that all of its
+aggregates share. Charts then read their groups back from the plan.
+
+Stored datasets keep their groupings (``MaterializedViews``) across requests.
+When rows are appended, ``extend_views`` carries them over to the grown
+dataset by folding in only the new rows.
+
+Large datasets are grouped chunk by chunk instead of all rows at once, see
+outofcore.
+
+A group column may also be a ``TimeBucket``: a date column truncated to a
+time bucket (see ``dates.bucket_column``). Once a grouping on some bucket
+exists, a coarser one over the same column (day -> month, hour -> week) is
+rolled up from it, merging the accumulators of its groups instead of going
+over the rows again; a plan computes the finest bucket of a column first.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from aggregates import (APPROXIMATE_ACCUMULATORS, Accumulator, CountAccumulator, DistinctCountAccumulator,
+                        MedianAccumulator, ModeAccumulator, make_accumulator)
+from columnar import Column, ColumnarDataset
+from dates import TIME_BUCKETS, bucket_column, bucket_nests, rebucket
+from outofcore import CHUNK_ROWS, MAX_GROUPS, ValueSpill, chunk_bounds, in_chunks
+from sketches import stable_hashes
+
+
+class TimeBucket(NamedTuple):
+    """Group column of a date column's values truncated to a time bucket (one of dates.TIME_BUCKETS)"""
+    column: str
+    bucket: str
+
+
+GroupColumns = Tuple[Union[str, TimeBucket], ...]
+# (aggregate type, aggregate column, approximate)
+AggregateSpec = Tuple[str, Optional[str], bool]
+
+# Groupings kept per stored dataset; each holds a group number per row
+MAX_MATERIALIZED_GROUPINGS = 32
+
+
+def aggregate_column_name(aggregate_column: Optional[str]) -> Optional[str]:
+    """Column to aggregate, or None when rows themselves are aggregated ("all")"""
+    return aggregate_column if aggregate_column and aggregate_column != "all" else None
+
+
+def normalize_aggregate(aggregate_type: Optional[str], aggregate_column: Optional[str],
+                        approximate: Optional[bool] = False) -> AggregateSpec:
+    """
+    Key of an aggregate; approximate only distinguishes aggregates that have
+    a sketch (the others are computed exactly either way)
+    """
+    aggregate_type = (aggregate_type or "COUNT").upper()
+    column = aggregate_column_name(aggregate_column)
+    # DISTINCT_COUNT over whole rows is a row count
+    sketched = aggregate_type in APPROXIMATE_ACCUMULATORS and (column is not None or aggregate_type != "DISTINCT_COUNT")
+    return aggregate_type, column, bool(approximate) and sketched
+
+
+def group_column(dataset: ColumnarDataset, name: Union[str, TimeBucket]) -> Column:
+    """Column a group column name stands for"""
+    if isinstance(name, TimeBucket):
+        return bucket_column(dataset.column(name.column), name.bucket)
+    return dataset.column(name)
+
+
+def _time_bucket(group_columns: GroupColumns) -> Optional[TimeBucket]:
+    """The time bucket of a grouping on one bucketed date column, else None"""
+    if len(group_columns) == 1 and isinstance(group_columns[0], TimeBucket):
+        return group_columns[0]
+    return None
+
+
+def category_hashes(column: Column) -> np.ndarray:
+    """Stable hash of every category of a column (cached), what approximate DISTINCT_COUNT sketches"""
+    hashes = column.derived.get("category_hashes")
+    if hashes is None:
+        hashes = column.derived["category_hashes"] = stable_hashes(column.categories)
+    return hashes
+
+
+class GroupedResult:
+    """Groups of one grouping and an accumulator per aggregate over them"""
+
+    def __init__(self, dataset: ColumnarDataset, group_columns: GroupColumns,
+                 radices: List[int], keys: np.ndarray, group_index: Optional[np.ndarray]):
+        self.dataset = dataset
+        self.group_columns = group_columns
+        self._radices = radices
+        # Integer key of every group that has at least one row, ascending;
+        # accumulators index groups by position in this array
+        self.keys = keys
+        # Dense group number per row, -1 for rows outside every group (None
+        # when grouped in chunks, which never holds one for every row)
+        self.group_index = group_index
+        self.accumulators: Dict[AggregateSpec, Accumulator] = {}
+
+    def key_codes(self) -> List[np.ndarray]:
+        """Per group column, the category code of every group (decoded keys)"""
+        remaining = self.keys
+        codes = []
+        for radix in reversed(self._radices):
+            remaining, code = np.divmod(remaining, radix)
+            codes.append(code)
+        return codes[::-1]
+
+    def labels(self, key: int) -> Tuple[str, ...]:
+        """Decode a group key back into its column values"""
+        labels = []
+        for name, radix in zip(reversed(self.group_columns), reversed(self._radices)):
+            key, code = divmod(key, radix)
+            labels.append(group_column(self.dataset, name).categories[code])
+        return tuple(reversed(labels))
+
+
+class MaterializedViews(OrderedDict):
+    """Groupings of a stored dataset shared by its requests; the oldest are dropped past max_groupings"""
+
+    def __init__(self, max_groupings: int = MAX_MATERIALIZED_GROUPINGS):
+        super().__init__()
+        self.max_groupings = max_groupings
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        while len(self) > self.max_groupings:
+            self.popitem(last=False)
+
+
+class QueryPlan:
+    """Deduplicated grouped work for the charts of one request"""
+
+    def __init__(self, dataset: ColumnarDataset):
+        self.dataset = dataset
+        self._pending: Dict[GroupColumns, List[AggregateSpec]] = {}
+        # Stored datasets share their groupings between requests
+        self._results: Dict[GroupColumns, GroupedResult] = dataset.views if dataset.views is not None else {}
+        # Plans over filtered row subsets, by filter key
+        self._filtered: Dict[str, "QueryPlan"] = {}
+
+    def filtered(self, key: str, select: Callable[[], ColumnarDataset]) -> "QueryPlan":
+        """
+        Plan over a subset of the rows (select builds it, once per key), so
+        charts with the same filters share its grouped work
+        """
+        plan = self._filtered.get(key)
+        if plan is None:
+            plan = self._filtered[key] = QueryPlan(select())
+        return plan
+
+    def add(self, group_columns: GroupColumns, aggregate_type: Optional[str],
+            aggregate_column: Optional[str], approximate: Optional[bool] = False) -> None:
+        """Register grouped work; identical requests are only computed once"""
+        spec = normalize_aggregate(aggregate_type, aggregate_column, approximate)
+        result = self._results.get(group_columns)
+        if result is not None and spec in result.accumulators:
+            return
+        specs = self._pending.setdefault(group_columns, [])
+        if spec not in specs:
+            specs.append(spec)
+
+    def execute(self) -> None:
+        """Compute every pending grouping, one pass per set of group columns"""
+        pending, self._pending = self._pending, {}
+        # Finer time buckets first, so coarser ones roll up from them
+        for group_columns, specs in sorted(pending.items(), key=lambda item: _fineness(item[0])):
+            self._execute_grouping(group_columns, specs)
+        for plan in self._filtered.values():
+            plan.execute()
+
+    def grouped(self, group_columns: GroupColumns, aggregate_type: Optional[str],
+                aggregate_column: Optional[str], approximate: Optional[bool] = False) -> Tuple[GroupedResult, Accumulator]:
+        """
+        Groups and accumulator for one aggregate. When they were not computed
+        yet, the grouping is computed now with every aggregate pending for
+        it (other groupings stay pending, so charts can be produced one by one)
+        """
+        spec = normalize_aggregate(aggregate_type, aggregate_column, approximate)
+        result = self._results.get(group_columns)
+        if result is None or spec not in result.accumulators:
+            self.add(group_columns, aggregate_type, aggregate_column, approximate)
+            # Pending finer buckets of the column are computed first, to roll up from
+            for finer in self._finer(group_columns, self._pending):
+                self._execute_grouping(finer, self._pending.pop(finer))
+            self._execute_grouping(group_columns, self._pending.pop(group_columns))
+            result = self._results[group_columns]
+        return result, result.accumulators[spec]
+
+    def _execute_grouping(self, group_columns: GroupColumns, specs: List[AggregateSpec]) -> None:
+        result = self._results.get(group_columns)
+        finer = [self._results[key] for key in self._finer(group_columns, self._results)]
+        if result is None:
+            if finer:
+                result = self._roll_up_groups(group_columns, finer[-1])
+            else:
+                result = self._group(group_columns)
+            self._results[group_columns] = result
+        # Aggregates a finer bucket has are merged from its groups
+        specs = [spec for spec in specs if not self._roll_up(result, spec, finer)]
+        if not specs:
+            return
+        if result.group_index is None:
+            self._aggregate_chunks(result, specs)
+            return
+
+        # The group number per row is shared by every aggregate of the grouping
+        for spec in specs:
+            accumulator, values, value_mask = self._value_source(spec)
+            selected = result.group_index >= 0
+            if value_mask is not None:
+                selected &= value_mask
+            accumulator.resize(len(result.keys))
+            accumulator.update(result.group_index[selected], values[selected])
+            result.accumulators[spec] = accumulator
+
+    def _finer(self, group_columns: GroupColumns, groupings: Dict[GroupColumns, object]) -> List[GroupColumns]:
+        """
+        Keys of groupings on the same date column as group_columns, in time
+        buckets that nest in its bucket, finest first
+        """
+        target = _time_bucket(group_columns)
+        if target is None:
+            return []
+        finer = [key for key in groupings
+                 if key != group_columns and _time_bucket(key) is not None and key[0].column == target.column
+                 and bucket_nests(key[0].bucket, target.bucket)]
+        return sorted(finer, key=_fineness)
+
+    def _bucket_mapping(self, result: GroupedResult, fine: GroupedResult) -> np.ndarray:
+        """Group of result (a coarser time bucket) holding each group of fine"""
+        target = result.group_columns[0]
+        codes = rebucket(group_column(self.dataset, fine.group_columns[0]), group_column(self.dataset, target),
+                         target.bucket)
+        return np.searchsorted(result.keys, codes[fine.keys])
+
+    def _roll_up_groups(self, group_columns: GroupColumns, fine: GroupedResult) -> GroupedResult:
+        """Groups of a time bucket from a grouping on a finer bucket of the same column (no aggregates yet)"""
+        column = group_column(self.dataset, group_columns[0])
+        codes = rebucket(group_column(self.dataset, fine.group_columns[0]), column, group_columns[0].bucket)
+        # Rows without a date are outside every bucket, so both have the same rows
+        keys, mapping = np.unique(codes[fine.keys], return_inverse=True)
+        group_index = None
+        if fine.group_index is not None:
+            mapping = np.append(mapping.reshape(-1), -1)
+            group_index = mapping[fine.group_index]
+        return GroupedResult(self.dataset, group_columns, [max(len(column.categories), 1)], keys, group_index)
+
+    def _roll_up(self, result: GroupedResult, spec: AggregateSpec, finer: List[GroupedResult]) -> bool:
+        """Merge an aggregate from the coarsest finer grouping that has it; False when none has"""
+        for fine in reversed(finer):
+            if spec in fine.accumulators:
+                accumulator = self._accumulator(spec)
+                accumulator.resize(len(result.keys))
+                accumulator.merge(fine.accumulators[spec], self._bucket_mapping(result, fine))
+                result.accumulators[spec] = accumulator
+                return True
+        return False
+
+    def _group(self, group_columns: GroupColumns) -> GroupedResult:
+        dataset = self.dataset
+        columns = [group_column(dataset, name) for name in group_columns]
+        if in_chunks(dataset):
+            return self._group_chunks(group_columns, columns)
+
+        # Rows take part when every group value is non-empty; the group key
+        # is the mixed-radix combination of the per-column codes
+        mask = np.ones(dataset.num_rows, dtype=bool)
+        keys = np.zeros(dataset.num_rows, dtype=np.int64)
+        radices = []
+        for column in columns:
+            radix = max(len(column.categories), 1)
+            mask &= column.keyed
+            keys = keys * radix + column.codes
+            radices.append(radix)
+
+        unique_keys, inverse = np.unique(keys[mask], return_inverse=True)
+        group_index = np.full(dataset.num_rows, -1, dtype=np.int64)
+        group_index[mask] = inverse.reshape(-1)
+        return GroupedResult(dataset, group_columns, radices, unique_keys, group_index)
+
+    @staticmethod
+    def _chunk_keys(columns: List[Column], radices: List[int], start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Group keys of rows start..end, and the mask of the rows that take part"""
+        mask = np.ones(end - start, dtype=bool)
+        keys = np.zeros(end - start, dtype=np.int64)
+        for column, radix in zip(columns, radices):
+            codes = column.codes[start:end]
+            if column.empty_code >= 0:
+                mask &= codes != column.empty_code
+            keys = keys * radix + codes
+        return keys, mask
+
+    def _group_chunks(self, group_columns: GroupColumns, columns: List[Column]) -> GroupedResult:
+        """Groups of a large dataset from the distinct keys of every chunk (no group number per row)"""
+        radices = [max(len(column.categories), 1) for column in columns]
+        keys = np.zeros(0, dtype=np.int64)
+        pending: List[np.ndarray] = []
+        pending_size = 0
+        for start, end in chunk_bounds(self.dataset.num_rows):
+            chunk_keys, mask = self._chunk_keys(columns, radices, start, end)
+            pending.append(np.unique(chunk_keys[mask]))
+            pending_size += len(pending[-1])
+            # Merged once the chunks' keys outgrow the keys so far, so memory
+            # stays proportional to the number of groups
+            if pending_size > max(len(keys), end - start):
+                keys = np.unique(np.concatenate([keys] + pending))
+                pending, pending_size = [], 0
+        if pending:
+            keys = np.unique(np.concatenate([keys] + pending))
+        return GroupedResult(self.dataset, group_columns, radices, keys, None)
+
+    def _chunk_groups(self, result: GroupedResult, start: int, end: int,
+                      lookup: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Group numbers of rows start..end (meaningful where the mask is set) and the mask"""
+        columns = [group_column(self.dataset, name) for name in result.group_columns]
+        keys, mask = self._chunk_keys(columns, result._radices, start, end)
+        if lookup is not None:
+            return lookup[keys], mask
+        return np.searchsorted(result.keys, keys), mask
+
+    @staticmethod
+    def _group_lookup(result: GroupedResult) -> Optional[np.ndarray]:
+        """Group number by key when the key space is small enough for a table, else None (binary search)"""
+        key_space = int(np.prod(result._radices, dtype=np.float64))
+        if key_space > max(CHUNK_ROWS, 4 * len(result.keys)):
+            return None
+        lookup = np.zeros(key_space, dtype=np.int64)
+        lookup[result.keys] = np.arange(len(result.keys))
+        return lookup
+
+    def _aggregate_chunks(self, result: GroupedResult, specs: List[AggregateSpec]) -> None:
+        """
+        Aggregates of a grouping computed chunk by chunk. Per-value state is
+        spilled to disk for MEDIAN and MODE, and for DISTINCT_COUNT over more
+        than MAX_GROUPS groups; those take a second pass that writes every
+        value to its group's place in the spill file.
+        """
+        num_rows = self.dataset.num_rows
+        accumulators = {spec: self._accumulator(spec) for spec in specs}
+        # Spilled aggregates only count their values in the first pass
+        counters = {spec: CountAccumulator() for spec, accumulator in accumulators.items()
+                    if _spills(accumulator, len(result.keys))}
+        for accumulator in list(accumulators.values()) + list(counters.values()):
+            accumulator.resize(len(result.keys))
+
+        lookup = self._group_lookup(result)
+        for start, end in chunk_bounds(num_rows):
+            groups, mask = self._chunk_groups(result, start, end, lookup)
+            for spec, accumulator in accumulators.items():
+                values, value_mask = self._values(spec, start, end)
+                selected = mask if value_mask is None else mask & value_mask
+                counters.get(spec, accumulator).update_chunk(groups[selected], values[selected])
+
+        spills = {spec: ValueSpill(counter.counts, self._values(spec, 0, 0)[0].dtype) for spec, counter in counters.items()}
+        if spills:
+            for start, end in chunk_bounds(num_rows):
+                groups, mask = self._chunk_groups(result, start, end, lookup)
+                for spec, spill in spills.items():
+                    values, value_mask = self._values(spec, start, end)
+                    selected = mask if value_mask is None else mask & value_mask
+                    spill.add(groups[selected], values[selected])
+
+        for spec, accumulator in accumulators.items():
+            if spec in spills:
+                accumulator.counts = counters[spec].counts
+                accumulator.attach_values(spills[spec])
+            else:
+                accumulator.finish()
+            result.accumulators[spec] = accumulator
+
+    def _extend_grouping(self, previous: GroupedResult, old_rows: int) -> GroupedResult:
+        """
+        Grouping of this plan's dataset from the grouping of its first
+        old_rows rows: group keys are re-encoded, and only the rows after
+        old_rows are folded into copies of the previous accumulators
+        """
+        dataset = self.dataset
+        columns = [group_column(dataset, name) for name in previous.group_columns]
+        radices = [max(len(column.categories), 1) for column in columns]
+
+        # Codes of existing categories don't change on append, so decoding the
+        # previous keys and encoding them with the new radices keeps their order
+        previous_keys = np.zeros(len(previous.keys), dtype=np.int64)
+        for name, code, column, radix in zip(previous.group_columns, previous.key_codes(), columns, radices):
+            if isinstance(name, TimeBucket):
+                # Buckets are numbered in date order, so new dates may renumber them
+                lookup = {label: new_code for new_code, label in enumerate(column.categories)}
+                previous_categories = group_column(previous.dataset, name).categories
+                code = np.array([lookup[previous_categories[old]] for old in code.tolist()], dtype=np.int64)
+            previous_keys = previous_keys * radix + code
+
+        new_rows = dataset.num_rows - old_rows
+        mask = np.ones(new_rows, dtype=bool)
+        new_keys = np.zeros(new_rows, dtype=np.int64)
+        for column, radix in zip(columns, radices):
+            mask &= column.keyed[old_rows:]
+            new_keys = new_keys * radix + column.codes[old_rows:]
+
+        keys = np.union1d(previous_keys, new_keys[mask])
+        mapping = np.searchsorted(keys, previous_keys)
+        group_index = np.full(dataset.num_rows, -1, dtype=np.int64)
+        old_grouped = previous.group_index >= 0
+        group_index[:old_rows][old_grouped] = mapping[previous.group_index[old_grouped]]
+        new_index = group_index[old_rows:]
+        new_index[mask] = np.searchsorted(keys, new_keys[mask])
+
+        result = GroupedResult(dataset, previous.group_columns, radices, keys, group_index)
+        for spec, previous_accumulator in list(previous.accumulators.items()):
+            accumulator, values, value_mask = self._value_source(spec)
+            selected = new_index >= 0
+            if value_mask is not None:
+                selected &= value_mask[old_rows:]
+            accumulator.resize(len(keys))
+            # Merging into a fresh accumulator leaves the previous one untouched
+            accumulator.merge(previous_accumulator, mapping)
+            accumulator.update(new_index[selected], values[old_rows:][selected])
+            result.accumulators[spec] = accumulator
+        return result
+
+    def _value_source(self, spec: AggregateSpec):
+        """Accumulator for an aggregate, the values it reads and the mask of rows providing one"""
+        return (self._accumulator(spec), *self._values(spec))
+
+    def _accumulator(self, spec: AggregateSpec) -> Accumulator:
+        aggregate_type, agg_col, approximate = spec
+        if agg_col is None:
+            # Distinct rows - every row is unique, so this is a row count
+            if aggregate_type == "DISTINCT_COUNT":
+                return CountAccumulator()
+            return make_accumulator(aggregate_type, integral=True, approximate=approximate)
+        if aggregate_type == "DISTINCT_COUNT" and not approximate:
+            return DistinctCountAccumulator()
+        return make_accumulator(aggregate_type, self.dataset.column(agg_col).integral, approximate)
+
+    def _values(self, spec: AggregateSpec, start: int = 0,
+                end: Optional[int] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Values an aggregate reads from rows start..end, and the mask of rows providing one"""
+        aggregate_type, agg_col, approximate = spec
+        end = self.dataset.num_rows if end is None else end
+        if agg_col is None:
+            # Every row contributes a 1
+            return np.ones(end - start, dtype=np.int64), None
+        column = self.dataset.column(agg_col)
+        if aggregate_type == "DISTINCT_COUNT":
+            # Distinct values of a specific column, compared as strings
+            # (sketched by hash, the same in every dataset and process)
+            codes = column.codes[start:end]
+            values = category_hashes(column)[codes] if approximate else codes
+            return values, column.present[start:end]
+        numbers = column.numbers[start:end]
+        values = numbers.astype(np.int64) if column.integral else numbers
+        return values, column.numeric[start:end]
+
+
+def _fineness(group_columns: GroupColumns) -> int:
+    """Sort key putting groupings on finer time buckets first (others keep their order)"""
+    target = _time_bucket(group_columns)
+    return TIME_BUCKETS.index(target.bucket) if target is not None else -1
+
+
+def _spills(accumulator: Accumulator, groups: int) -> bool:
+    """
+    Whether an aggregate computed in chunks keeps its per-value state on disk:
+    MEDIAN holds every value; MODE every distinct value of every group, and
+    counting them from the spilled values once beats updating Counters chunk
+    by chunk; DISTINCT_COUNT a set per group, spilled when there are many
+    """
+    if isinstance(accumulator, (MedianAccumulator, ModeAccumulator)):
+        return True
+    return isinstance(accumulator, DistinctCountAccumulator) and groups > MAX_GROUPS
+
+
+def extend_views(views: MaterializedViews, dataset: ColumnarDataset, old_rows: int) -> MaterializedViews:
+    """
+    Groupings of dataset, whose first old_rows rows are the dataset views
+    were computed for; the cost scales with the number of appended rows
+    (and groups) rather than the size of the dataset
+    """
+    plan = QueryPlan(dataset)
+    extended = MaterializedViews(views.max_groupings)
+    for group_columns, grouped in list(views.items()):
+        # Groupings computed in chunks have no group number per row to extend;
+        # they are computed again (in chunks) when next asked for
+        if grouped.group_index is not None:
+            extended[group_columns] = plan._extend_grouping(grouped, old_rows)
+    return extended
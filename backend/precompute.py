@@ -0,0 +1,142 @@
+"""
+Background precomputation of the default charts of new datasets.
+
+After an upload the frontend shows the configure page, and the first
+/api/analyze call then computed its charts cold. Now, when a dataset is
+stored, a job computing its profile's suggested charts (the default chart
+set the frontend uses when none are configured) is queued, and the charts
+go to the result cache, so that first request is a cache hit.
+
+Precomputation never competes with requests:
+
+- jobs wait in a priority queue, the most recently stored dataset first
+  (the one about to be viewed), and run one at a time, only while admission
+  control has no request running or queued,
+- a job computes its charts one at a time and stops after the current chart
+  as soon as a request is admitted; it resumes (skipping charts cached
+  meanwhile) once requests are done.
+
+Configuration (environment variables):
+
+- ``PRECOMPUTE_CHARTS``: ``1`` (default) to precompute the default charts of
+  stored datasets, ``0`` to not
+- ``PRECOMPUTE_MAX_QUEUE``: datasets waiting at most; beyond it the oldest
+  job is dropped (default 16)
+"""
+import asyncio
+import heapq
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from admission import AdmissionController, admission_controller
+
+# A job: awaited with the precomputer, returns the number of charts it computed
+Job = Callable[["Precomputer"], Awaitable[int]]
+
+
+class Precomputer:
+    """Priority queue of background jobs, run one at a time while no request is being served"""
+
+    def __init__(self, admission: AdmissionController, enabled: bool = True, max_queue: int = 16):
+        self.admission = admission
+        self.enabled = enabled
+        self.max_queue = max(1, max_queue)
+        # (priority, key): lowest first; the newest job has the lowest priority value
+        self._heap: List[Tuple[int, str]] = []
+        self._jobs: Dict[str, Job] = {}
+        self._sequence = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.running: Optional[str] = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.preempted = 0
+        self.charts = 0
+
+    def submit(self, key: str, job: Job) -> bool:
+        """
+        Queue a job under key, ahead of the jobs queued before it (a queued
+        job with the same key moves up); needs a running event loop
+        """
+        if not self.enabled:
+            return False
+        self._sequence += 1
+        self.discard(key)
+        self._jobs[key] = job
+        heapq.heappush(self._heap, (-self._sequence, key))
+        self.submitted += 1
+        if len(self._heap) > self.max_queue:
+            # The oldest job has the highest priority value
+            self.discard(max(self._heap)[1])
+            self.dropped += 1
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+        return True
+
+    def discard(self, key: str) -> None:
+        """Drop a queued job (e.g. of a deleted dataset)"""
+        if self._jobs.pop(key, None) is not None:
+            self._heap = [item for item in self._heap if item[1] != key]
+            heapq.heapify(self._heap)
+
+    async def wait_turn(self) -> None:
+        """Wait until no request is running or queued; jobs call this before each step"""
+        await self.admission.wait_idle()
+
+    def should_yield(self) -> bool:
+        """True once a request is waiting or running: the job should stop after its current step"""
+        return self.admission.busy
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.wait_turn()
+            if not self._heap:
+                continue
+            _, key = heapq.heappop(self._heap)
+            job = self._jobs.pop(key)
+            self.running = key
+            try:
+                self.charts += await job(self)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Nothing waits on the result; the charts are computed on request instead
+                self.failed += 1
+            finally:
+                self.running = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "queued": len(self._heap),
+            "running": self.running,
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "preempted": self.preempted,
+            "charts": self.charts,
+        }
+
+    def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._heap, self._jobs = [], {}
+
+
+precomputer = Precomputer(
+    admission_controller,
+    enabled=os.getenv("PRECOMPUTE_CHARTS", "1") != "0",
+    max_queue=int(os.getenv("PRECOMPUTE_MAX_QUEUE", "16")),
+)
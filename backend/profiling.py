@@ -0,0 +1,175 @@
+"""
+Dataset profiles: column types and statistics, and suggested charts.
+
+The frontend used to guess column types by scanning report rows in PHP, and
+the chart branches then sniffed them again. A profile is one vectorised pass
+over the dataset's columns:
+
+- ``type``: ``numeric`` when most non-null values are numbers, ``date`` when
+  most are strings in one of the chart date formats, else ``categorical``,
+- null count and rate, exact cardinality (columns are dictionary encoded),
+  numeric min/max and the inferred date format.
+
+Date format inference is cached on the column, so charts computed later over
+the same dataset reuse it (and vice versa). The profile itself is cached on
+the dataset, so stored datasets are profiled once.
+
+Datasets that were sent as rows and not materialised are profiled from a
+sample of ``PROFILE_SAMPLE_ROWS`` evenly spaced rows when they are larger
+than that (types, null rates and min/max then describe the sample); their
+cardinalities are estimated over all rows with a HyperLogLog sketch.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from columnar import Column, ColumnarDataset
+from dates import column_date_format, date_sample_share
+from sketches import HyperLogLog
+
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "100000"))
+
+# Suggested charts
+MAX_SUGGESTED_CHARTS = 8
+MAX_CATEGORY_CHARTS = 4
+MAX_TREND_CHARTS = 4
+# Categorical columns with up to this many values get a count chart, more a top-N bar chart
+MAX_COUNT_CHART_CARDINALITY = 30
+SUGGESTED_TOP_N = 10
+# Columns where almost every value is distinct (ids, free text) are not charted by category
+MAX_DISTINCT_SHARE = 0.5
+# Points per suggested line chart (downsampled)
+SUGGESTED_MAX_POINTS = 1000
+
+
+def profile_column(column: Column, num_rows: int) -> Dict[str, Any]:
+    """Type and statistics of one column"""
+    present = column.present
+    present_count = int(np.count_nonzero(present))
+    numeric = column.numeric & present
+    numeric_count = int(np.count_nonzero(numeric))
+    string_count = int(np.count_nonzero(column.strings))
+
+    kind = "categorical"
+    date_format = None
+    if present_count and numeric_count / present_count > 0.5:
+        kind = "numeric"
+    elif present_count and string_count / present_count > 0.5 and date_sample_share(column) > 0.5:
+        kind = "date"
+        date_format = column_date_format(column)
+
+    counts = np.bincount(column.codes[present], minlength=len(column.categories))
+    minimum = maximum = None
+    if numeric_count:
+        values = column.numbers[numeric]
+        minimum, maximum = values.min().item(), values.max().item()
+        if column.integral:
+            minimum, maximum = int(minimum), int(maximum)
+
+    sample = None
+    if present_count:
+        first = int(np.argmax(present))
+        if numeric[first] and not column.strings[first]:
+            number = column.numbers[first].item()
+            sample = int(number) if column.integral else number
+        else:
+            sample = column.categories[column.codes[first]]
+
+    return {
+        "name": column.name,
+        "type": kind,
+        "null_count": num_rows - present_count,
+        "null_rate": round((num_rows - present_count) / num_rows, 6) if num_rows else 0.0,
+        "cardinality": int(np.count_nonzero(counts)),
+        "cardinality_exact": True,
+        "min": minimum,
+        "max": maximum,
+        "date_format": date_format,
+        "sample": sample,
+    }
+
+
+def profile_dataset(dataset: ColumnarDataset) -> Dict[str, Any]:
+    """Profile of every column plus suggested chart configs (cached on the dataset)"""
+    if dataset.profile is not None:
+        return dataset.profile
+
+    sampled = not dataset.materialized and dataset.num_rows > PROFILE_SAMPLE_ROWS
+    source = dataset.sample_rows(PROFILE_SAMPLE_ROWS) if sampled else dataset
+    columns = []
+    for name in dataset.column_names:
+        column = profile_column(source.column(name), source.num_rows)
+        if sampled:
+            sketch = HyperLogLog().add(dataset.raw_keys(name))
+            column.update(cardinality=sketch.estimate(), cardinality_exact=False,
+                          cardinality_error=round(sketch.relative_error, 4))
+        columns.append(column)
+
+    profile = {
+        "row_count": dataset.num_rows,
+        "sampled": sampled,
+        "sample_rows": source.num_rows,
+        "columns": columns,
+        "suggested_charts": suggest_charts(columns, dataset.num_rows),
+    }
+    dataset.profile = profile
+    return profile
+
+
+def _label(name: str) -> str:
+    """Column name as a title: separators to spaces, words capitalised"""
+    words = name.replace("_", " ").replace("-", " ").split(" ")
+    return " ".join(word[:1].upper() + word[1:] for word in words)
+
+
+def suggest_charts(columns: List[Dict[str, Any]], num_rows: int) -> List[Dict[str, Any]]:
+    """
+    Default chart configs for a profile: counts per categorical column, and
+    numeric columns over the first date column (or summed per category when
+    there is no date column)
+    """
+    def chartable(column):
+        return column["cardinality"] > 1 and column["null_rate"] < 1
+
+    def identifier(column):
+        # Integers that are (almost) all distinct
+        return isinstance(column["min"], int) and column["cardinality"] >= 0.95 * num_rows * (1 - column["null_rate"])
+
+    categorical = [
+        column for column in columns
+        if column["type"] == "categorical" and chartable(column)
+        and (column["cardinality"] <= MAX_COUNT_CHART_CARDINALITY or column["cardinality"] <= num_rows * MAX_DISTINCT_SHARE)
+    ]
+    numeric = [column for column in columns if column["type"] == "numeric" and chartable(column) and not identifier(column)]
+    dates = sorted((column for column in columns if column["type"] == "date" and chartable(column)),
+                   key=lambda column: column["null_rate"])
+
+    configs: List[Dict[str, Any]] = []
+    for column in categorical[:MAX_CATEGORY_CHARTS]:
+        label = _label(column["name"])
+        if column["cardinality"] <= MAX_COUNT_CHART_CARDINALITY:
+            configs.append({"chart_type": "count_chart", "column": column["name"], "title": f"Count by {label}"})
+        else:
+            configs.append({
+                "chart_type": "bar_chart", "column": column["name"], "aggregate": "COUNT", "aggregate_column": "all",
+                "top_n": SUGGESTED_TOP_N, "sort_by": "value", "other_bucket": True,
+                "title": f"Top {SUGGESTED_TOP_N} {label}",
+            })
+
+    date_column: Optional[Dict[str, Any]] = dates[0] if dates else None
+    group = next((column for column in categorical if column["cardinality"] <= MAX_COUNT_CHART_CARDINALITY), None)
+    for column in numeric[:MAX_TREND_CHARTS]:
+        label = _label(column["name"])
+        if date_column is not None:
+            configs.append({
+                "chart_type": "line_chart", "x_column": date_column["name"], "y_column": column["name"],
+                "title": f"{label} Over Time", "x_label": "Date", "y_label": label,
+                "max_points": SUGGESTED_MAX_POINTS,
+            })
+        elif group is not None:
+            configs.append({
+                "chart_type": "bar_chart", "column": group["name"], "aggregate": "SUM",
+                "aggregate_column": column["name"], "title": f"{label} by {_label(group['name'])}",
+            })
+    return configs[:MAX_SUGGESTED_CHARTS]
@@ -0,0 +1,350 @@
+"""
+Cache shared by the worker processes of a multi-process deployment.
+
+Each uvicorn worker has its own dataset store and result cache, so a dataset
+uploaded through one worker is unknown to the others, and a chart computed by
+one is recomputed by the next. With ``SHARED_CACHE_DIR`` set, every worker on
+the host publishes to (and looks up in) one directory:
+
+- ``datasets/<id>/``: a stored dataset in the ``ColumnarDataset.save``
+  layout. Workers open it memory-mapped, so all of them serve the same pages
+  zero-copy once one has ingested it.
+- ``results/<dataset id>/<config hash>.json``: chart results.
+
+Entries are published by writing them under ``tmp/`` and renaming them into
+place, so readers never see a partial entry. Writers take an exclusive
+``flock`` on ``lock``, which guards ``index.json`` (the size of every entry)
+and eviction. A worker holding a dataset keeps a shared lock on its
+``dataset.json``; when the entries exceed ``SHARED_CACHE_MAX_BYTES`` the
+least recently used ones are removed, datasets a worker holds last (its
+mapping stays valid, and it lets go of the dataset on its next lookup).
+
+Configuration (environment variables):
+
+- ``SHARED_CACHE_DIR``: the shared directory; unset (the default) keeps
+  every cache local to its process
+- ``SHARED_CACHE_MAX_BYTES``: budget for datasets and chart results together
+  (default 1 GB)
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import jsonio
+from columnar import ColumnarDataset
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the shared cache is disabled
+    fcntl = None
+
+# Eviction frees space down to this fraction of the budget, so a full cache
+# isn't swept again on every put
+EVICT_TO = 0.9
+
+
+def _directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def _config_hash(config_key: str) -> str:
+    return hashlib.sha256(config_key.encode("utf-8")).hexdigest()
+
+
+class SharedCache:
+    """Datasets and chart results shared by the processes using one directory"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        if fcntl is None:
+            raise RuntimeError("The shared cache needs fcntl file locks, which this platform does not have")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        for name in ("datasets", "results", "tmp"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self._lock_path = os.path.join(directory, "lock")
+        self._index_path = os.path.join(directory, "index.json")
+        # flock doesn't exclude the threads of one process from each other
+        self._thread_lock = threading.Lock()
+        # Counters of this process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def temporary_directory(self) -> str:
+        """A new directory on the cache's file system, for entries being written"""
+        path = os.path.join(self.directory, "tmp", uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    # Datasets
+
+    def dataset_path(self, dataset_id: str) -> str:
+        return os.path.join(self.directory, "datasets", dataset_id)
+
+    def touch_dataset(self, dataset_id: str) -> bool:
+        """Mark a dataset this process holds as used; False when it was evicted or deleted meanwhile"""
+        try:
+            os.utime(self.dataset_path(dataset_id))
+        except OSError:
+            return False
+        return True
+
+    def get_dataset(self, dataset_id: str) -> Optional[Tuple[ColumnarDataset, Optional[str]]]:
+        """The dataset published under dataset_id, memory-mapped, and the id it was appended to"""
+        path = self.dataset_path(dataset_id)
+        held = self._hold(path)
+        if held is None:
+            self.misses += 1
+            return None
+        published = self._open(path, held)
+        if published is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return published
+
+    def put_dataset(self, dataset_id: str, dataset: ColumnarDataset,
+                    previous_id: Optional[str] = None) -> ColumnarDataset:
+        """
+        Publish a dataset (unless dataset_id is published already) and return
+        the published copy, memory-mapped. A dataset already mapped from a
+        directory under tmp/ is moved into place rather than written again.
+        """
+        tmp = os.path.join(self.directory, "tmp") + os.sep
+        if dataset.directory is not None and dataset.directory.startswith(tmp):
+            path = dataset.directory
+        else:
+            path = self.temporary_directory()
+            dataset.save(path)
+        with open(os.path.join(path, "entry.json"), "w", encoding="utf-8") as f:
+            json.dump({"previous_id": previous_id}, f)
+
+        target = self.dataset_path(dataset_id)
+        key = os.path.join("datasets", dataset_id)
+        with self._locked():
+            if os.path.exists(target):
+                # Published by another worker meanwhile (ids are content addresses)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.rename(path, target)
+            # Held before the lock is released, so no other process evicts it first
+            held = self._hold(target)
+            if held is not None:
+                self._add_entry(key, _directory_size(target))
+        published = self._open(target, held) if held is not None else None
+        if published is None:
+            raise RuntimeError(f"Dataset '{dataset_id}' could not be published to the shared cache")
+        shared, _ = published
+        shared.views = dataset.views
+        return shared
+
+    def delete_dataset(self, dataset_id: str) -> bool:
+        """Remove a dataset and its chart results for every process (processes using it keep their mapping)"""
+        with self._locked():
+            index = self._read_index()
+            found = index.pop(os.path.join("datasets", dataset_id), None) is not None
+            for key in [key for key in index if key.startswith(os.path.join("results", dataset_id) + os.sep)]:
+                del index[key]
+            self._write_index(index)
+            self._remove(self.dataset_path(dataset_id))
+            self._remove(os.path.join(self.directory, "results", dataset_id))
+        return found
+
+    # Chart results
+
+    def result_path(self, dataset_hash: str, config_key: str) -> str:
+        return os.path.join(self.directory, "results", dataset_hash, _config_hash(config_key) + ".json")
+
+    def get_result(self, dataset_hash: str, config_key: str) -> Optional[Dict[str, Any]]:
+        path = self.result_path(dataset_hash, config_key)
+        try:
+            with open(path, "rb") as f:
+                result = jsonio.loads(f.read())
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put_result(self, dataset_hash: str, config_key: str, content: bytes) -> None:
+        """Publish a chart result serialised as JSON"""
+        if len(content) > self.max_bytes:
+            return
+        path = self.result_path(dataset_hash, config_key)
+        temporary = os.path.join(self.directory, "tmp", uuid.uuid4().hex + ".json")
+        with open(temporary, "wb") as f:
+            f.write(content)
+        with self._locked():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temporary, path)
+            self._add_entry(os.path.relpath(path, self.directory), len(content))
+
+    def invalidate(self, dataset_hash: Optional[str] = None) -> int:
+        """Drop the chart results of one dataset, or all of them; returns the number removed"""
+        prefix = os.path.join("results", dataset_hash) if dataset_hash else "results"
+        with self._locked():
+            index = self._read_index()
+            keys = [key for key in index if key.startswith(prefix + os.sep)]
+            for key in keys:
+                del index[key]
+            self._write_index(index)
+            self._remove(os.path.join(self.directory, prefix))
+            os.makedirs(os.path.join(self.directory, "results"), exist_ok=True)
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._locked():
+            index = self._read_index()
+        datasets = sum(1 for key in index if key.startswith("datasets" + os.sep))
+        return {
+            "directory": self.directory,
+            "datasets": datasets,
+            "results": len(index) - datasets,
+            "size_bytes": sum(index.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    # Locking, index and eviction
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Exclusive access to the index and to publishing/removing entries, across processes"""
+        with self._thread_lock, open(self._lock_path, "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _hold(self, path: str) -> Optional[int]:
+        """A descriptor holding a shared lock on a dataset's dataset.json, or None if it isn't published"""
+        meta = os.path.join(path, "dataset.json")
+        try:
+            descriptor = os.open(meta, os.O_RDONLY)
+        except OSError:
+            return None
+        fcntl.flock(descriptor, fcntl.LOCK_SH)
+        try:
+            # It may have been removed while we waited for the lock
+            if os.stat(meta).st_ino == os.fstat(descriptor).st_ino:
+                return descriptor
+        except OSError:
+            pass
+        os.close(descriptor)
+        return None
+
+    def _open(self, path: str, held: int) -> Optional[Tuple[ColumnarDataset, Optional[str]]]:
+        """Open a held dataset; the hold is released when the dataset is garbage collected"""
+        try:
+            dataset = ColumnarDataset.open(path)
+            with open(os.path.join(path, "entry.json"), encoding="utf-8") as f:
+                previous_id = json.load(f).get("previous_id")
+        except (OSError, ValueError):
+            os.close(held)
+            return None
+        weakref.finalize(dataset, os.close, held)
+        # Last use, for eviction
+        os.utime(path)
+        return dataset, previous_id
+
+    def _read_index(self) -> Dict[str, int]:
+        try:
+            with open(self._index_path, "rb") as f:
+                return jsonio.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: Dict[str, int]) -> None:
+        temporary = self._index_path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(jsonio.dumps(index))
+        os.replace(temporary, self._index_path)
+
+    def _add_entry(self, key: str, size: int) -> None:
+        """Record an entry's size and evict others while over budget (lock held)"""
+        index = self._read_index()
+        index[key] = size
+        total = sum(index.values())
+        if total > self.max_bytes:
+            total -= self._evict(index, key, total - int(self.max_bytes * EVICT_TO))
+        self._write_index(index)
+
+    def _evict(self, index: Dict[str, int], keep: str, excess: int) -> int:
+        """
+        Remove least recently used entries (not keep) worth excess bytes;
+        returns the bytes freed. Datasets a process holds go last: that
+        process keeps its mapping and drops the dataset on its next lookup.
+        """
+        last_used = {}
+        for key in index:
+            if key != keep:
+                try:
+                    last_used[key] = os.stat(os.path.join(self.directory, key)).st_mtime
+                except OSError:
+                    # Gone already
+                    last_used[key] = 0
+        freed = 0
+        held = []
+        for key in sorted(last_used, key=last_used.get):
+            if freed >= excess:
+                return freed
+            path = os.path.join(self.directory, key)
+            if key.startswith("datasets" + os.sep) and self._is_held(path):
+                held.append(key)
+                continue
+            freed += self._drop(index, key)
+        for key in held:
+            if freed >= excess:
+                break
+            freed += self._drop(index, key)
+        return freed
+
+    def _drop(self, index: Dict[str, int], key: str) -> int:
+        self._remove(os.path.join(self.directory, key))
+        self.evictions += 1
+        return index.pop(key)
+
+    def _is_held(self, path: str) -> bool:
+        """True when a process holds the dataset"""
+        try:
+            descriptor = os.open(os.path.join(path, "dataset.json"), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(descriptor)
+        return False
+
+    def _remove(self, path: str) -> None:
+        """Move an entry out of sight, then delete it"""
+        if not os.path.exists(path):
+            return
+        trash = os.path.join(self.directory, "tmp", uuid.uuid4().hex)
+        os.rename(path, trash)
+        if os.path.isdir(trash):
+            shutil.rmtree(trash, ignore_errors=True)
+        else:
+            os.remove(trash)
+
+
+def _shared_cache() -> Optional[SharedCache]:
+    directory = os.getenv("SHARED_CACHE_DIR")
+    if not directory:
+        return None
+    return SharedCache(directory, max_bytes=int(os.getenv("SHARED_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))))
+
+
+shared_cache = _shared_cache()
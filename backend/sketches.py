@@ -0,0 +1,303 @@
+"""
+Mergeable approximate summaries for inputs too large to scan exactly.
+
+- ``HyperLogLog`` estimates the number of distinct values in a fixed
+  ``2 ** precision`` bytes, with a relative standard error of
+  ``1.04 / sqrt(2 ** precision)``. A sparse sketch keeps the hashes
+  themselves (an exact count) until they would outgrow the registers.
+- ``TDigest`` estimates quantiles from centroids that are small near the
+  tails and larger around the median (a merging t-digest with the k1 scale
+  function), so extreme quantiles stay accurate.
+- ``SpaceSaving`` keeps the most frequent values and an overestimate of
+  their counts in a fixed number of counters (heavy hitters).
+
+Values are hashed with an unkeyed 64-bit BLAKE2b digest of ``str(value)``
+(the same key the columns group by), so sketches built in different
+processes can be merged. All sketches are exact while their input is small.
+"""
+import hashlib
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_PRECISION = 14
+DEFAULT_COMPRESSION = 200
+DEFAULT_COUNTERS = 64
+# A t-digest buffers this many times its compression in values before
+# merging them into centroids (and answers exactly until it first does)
+BUFFER_FACTOR = 5
+
+_NO_VALUES = np.zeros(0, dtype=np.float64)
+
+
+def stable_hashes(values: Iterable[str]) -> np.ndarray:
+    """64-bit hashes of strings that are the same in every process (each distinct value hashed once)"""
+    cache: Dict[str, int] = {}
+
+    def digest(value: str) -> int:
+        hashed = cache.get(value)
+        if hashed is None:
+            hashed = int.from_bytes(hashlib.blake2b(value.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+            cache[value] = hashed
+        return hashed
+
+    return np.fromiter((digest(value) for value in values), dtype=np.uint64)
+
+
+class HyperLogLog:
+    """Distinct value counter (HyperLogLog with linear counting for small cardinalities)"""
+
+    def __init__(self, precision: int = DEFAULT_PRECISION, sparse: bool = False):
+        if not 11 <= precision <= 18:
+            # Ranks are computed in float64, exact for up to 53 remaining hash bits
+            raise ValueError("precision must be between 11 and 18")
+        self.precision = precision
+        # A sparse sketch holds the distinct hashes instead of registers
+        self.hashes: Optional[np.ndarray] = np.zeros(0, dtype=np.uint64) if sparse else None
+        self.registers = None if sparse else np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def exact(self) -> bool:
+        """True while the sketch is sparse (the count is exact, barring 64-bit hash collisions)"""
+        return self.registers is None
+
+    @property
+    def relative_error(self) -> float:
+        """Relative standard error of estimate()"""
+        return 1.04 / np.sqrt(1 << self.precision)
+
+    def copy(self) -> "HyperLogLog":
+        sketch = HyperLogLog.__new__(HyperLogLog)
+        sketch.precision = self.precision
+        sketch.hashes = None if self.hashes is None else self.hashes.copy()
+        sketch.registers = None if self.registers is None else self.registers.copy()
+        return sketch
+
+    def add_hashes(self, hashes: np.ndarray) -> "HyperLogLog":
+        """Count values by their stable_hashes"""
+        if not len(hashes):
+            return self
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.registers is None:
+            self.hashes = np.union1d(self.hashes, hashes)
+            # Sparse while the hashes take no more room than the registers
+            if len(self.hashes) * 8 > (1 << self.precision):
+                self._densify()
+            return self
+        width = 64 - self.precision
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rest = (hashes & np.uint64((1 << width) - 1)).astype(np.float64)
+        # Position of the leftmost 1 bit of the remaining bits (width + 1 when they are all 0)
+        rank = np.full(len(hashes), width + 1, dtype=np.uint8)
+        nonzero = rest > 0
+        rank[nonzero] = (width - np.floor(np.log2(rest[nonzero]))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def add(self, values: Iterable[str]) -> "HyperLogLog":
+        return self.add_hashes(stable_hashes(values))
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """Fold in another sketch of the same precision (the union of both inputs)"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches of different precision")
+        if other.registers is None:
+            return self.add_hashes(other.hashes)
+        if self.registers is None:
+            self._densify()
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def _densify(self) -> None:
+        hashes, self.hashes = self.hashes, None
+        self.registers = np.zeros(1 << self.precision, dtype=np.uint8)
+        self.add_hashes(hashes)
+
+    def estimate(self) -> int:
+        if self.registers is None:
+            return len(self.hashes)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.exp2(-self.registers.astype(np.float64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+
+class TDigest:
+    """
+    Quantile sketch: weighted centroids, sorted by mean, each spanning at
+    most one unit of k(q) = compression / (2 pi) * asin(2q - 1). Values are
+    buffered and merged into the centroids in bulk.
+    """
+
+    def __init__(self, compression: float = DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = _NO_VALUES
+        self.weights = _NO_VALUES
+        # (values, weights) not merged into the centroids yet; None weighs every value 1
+        self._buffer: List[Tuple[np.ndarray, Optional[np.ndarray]]] = []
+        self._buffered = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        # True while every centroid is a single value (quantiles are then exact)
+        self.exact = True
+
+    def rank_error(self, quantile: float) -> float:
+        """
+        Bound on the rank error of quantile(q), as a fraction of the count:
+        the width in q of one unit of k at q (0 when exact)
+        """
+        if self.exact:
+            return 0.0
+        return min(1.0, 2 * math.pi * math.sqrt(quantile * (1 - quantile)) / self.compression)
+
+    def copy(self) -> "TDigest":
+        digest = TDigest(self.compression)
+        # Arrays are replaced, never changed in place, so they can be shared
+        digest.means, digest.weights, digest._buffer = self.means, self.weights, list(self._buffer)
+        digest._buffered, digest.count, digest.min, digest.max = self._buffered, self.count, self.min, self.max
+        digest.exact = self.exact
+        return digest
+
+    def add(self, values: np.ndarray) -> "TDigest":
+        return self._add(np.asarray(values, dtype=np.float64), None)
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        """Fold in another digest (of the union of both inputs)"""
+        self._add(other.means, other.weights if not other.exact else None)
+        for values, weights in other._buffer:
+            self._add(values, weights)
+        return self
+
+    def _add(self, values: np.ndarray, weights: Optional[np.ndarray]) -> "TDigest":
+        if not len(values):
+            return self
+        self._buffer.append((values, weights))
+        self._buffered += len(values)
+        self.count += len(values) if weights is None else int(weights.sum())
+        self.exact = self.exact and weights is None
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        if self._buffered > BUFFER_FACTOR * self.compression:
+            self._compress()
+        return self
+
+    def _compress(self) -> None:
+        means = np.concatenate([self.means] + [values for values, _ in self._buffer])
+        if self.exact:
+            weights = np.ones(len(means))
+            means = np.sort(means)
+        else:
+            weights = np.concatenate([self.weights] + [np.ones(len(values)) if weights is None else weights
+                                                       for values, weights in self._buffer])
+            order = np.argsort(means, kind="stable")
+            means, weights = means[order], weights[order]
+        self._buffer, self._buffered = [], 0
+        # Points whose middle falls into the same unit of k form one centroid:
+        # a centroid starts at the first middle past each integer k
+        cumulative = np.cumsum(weights)
+        middles = (cumulative - weights / 2) / cumulative[-1]
+        units = np.arange(math.ceil(-self.compression / 4), math.floor(self.compression / 4) + 1)
+        edges = (np.sin(2 * math.pi * units / self.compression) + 1) / 2
+        starts = np.unique(np.concatenate(([0], np.searchsorted(middles, edges))))
+        starts = starts[starts < len(means)]
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+        self.exact = len(self.means) == len(means)
+
+    def values(self) -> np.ndarray:
+        """Every value, when the digest is exact"""
+        return np.concatenate([self.means] + [values for values, _ in self._buffer])
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Estimated value at rank quantile * (count - 1), interpolated between
+        centroid centres (and the min and max at the ends)
+        """
+        if self._buffer:
+            self._compress()
+        if not self.count:
+            return 0.0
+        # Rank of every centroid's centre; a centroid covers ranks c..c+w-1
+        centres = np.cumsum(self.weights) - (self.weights + 1) / 2
+        ranks = np.concatenate(([0.0], centres, [self.count - 1.0]))
+        means = np.concatenate(([self.min], self.means, [self.max]))
+        return float(np.interp(quantile * (self.count - 1), ranks, means))
+
+
+class SpaceSaving:
+    """
+    The most frequent values in at most capacity counters. Counts are
+    overestimated by at most their error, and a value without a counter
+    occurs at most floor times. Counters stay in order of first appearance,
+    so ties go to the value seen first.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_COUNTERS):
+        self.capacity = capacity
+        # value -> [count, error]
+        self.counters: Dict[Any, List[int]] = {}
+        self.total = 0
+        self.floor = 0
+
+    @property
+    def exact(self) -> bool:
+        """True while no counter was given up (counts are then exact)"""
+        return self.floor == 0
+
+    def copy(self) -> "SpaceSaving":
+        summary = SpaceSaving(self.capacity)
+        summary.counters = {value: list(counter) for value, counter in self.counters.items()}
+        summary.total, summary.floor = self.total, self.floor
+        return summary
+
+    def add_counts(self, values: np.ndarray, counts: np.ndarray) -> "SpaceSaving":
+        """Fold in the exact counts of distinct values, in order of their first appearance"""
+        other = SpaceSaving(self.capacity)
+        other.total = int(counts.sum())
+        if len(values) > self.capacity:
+            # Only the largest counts can make it into the summary
+            ranked = np.argsort(-counts, kind="stable")
+            other.floor = int(counts[ranked[self.capacity]])
+            kept = np.sort(ranked[:self.capacity])
+            values, counts = values[kept], counts[kept]
+        other.counters = {value: [count, 0] for value, count in zip(values.tolist(), counts.tolist())}
+        return self.merge(other)
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """Fold in another summary (of the union of both inputs)"""
+        for value in self.counters.keys() - other.counters.keys():
+            self.counters[value][0] += other.floor
+            self.counters[value][1] += other.floor
+        for value, (count, error) in other.counters.items():
+            counter = self.counters.get(value)
+            if counter is None:
+                self.counters[value] = [self.floor + count, self.floor + error]
+            else:
+                counter[0] += count
+                counter[1] += error
+        self.total += other.total
+        self.floor += other.floor
+        self._truncate()
+        return self
+
+    def _truncate(self) -> None:
+        if len(self.counters) <= self.capacity:
+            return
+        ranked = sorted(self.counters.items(), key=lambda item: -item[1][0])
+        # Values without a counter occurred at most as often as the largest count dropped
+        self.floor = max(self.floor, ranked[self.capacity][1][0])
+        kept = {value for value, _ in ranked[:self.capacity]}
+        self.counters = {value: counter for value, counter in self.counters.items() if value in kept}
+
+    def most_common(self) -> Optional[Tuple[Any, int, int]]:
+        """The value with the highest count, its count and the count's error"""
+        best = None
+        for value, (count, error) in self.counters.items():
+            if best is None or count > best[1]:
+                best = (value, count, error)
+        return best
@@ -0,0 +1,302 @@
+"""
+Server-side store of ingested datasets.
+
+A dataset is uploaded once through ``POST /api/datasets`` and referenced by
+its content-addressed id afterwards, so chart reconfiguration does not re-send
+and re-parse the whole report. Stored datasets are kept in columnar form and
+evicted least-recently-used first when the memory budget is exceeded, or when
+they have not been used for longer than the TTL.
+
+Rows can be appended to a stored dataset (``POST /api/datasets/{id}/append``).
+The grown dataset is stored under a new id chained from the old id and the
+new rows, and the group-by results kept for the old dataset are carried over
+by folding in only the new rows, so a refresh costs time proportional to what
+was added.
+
+Stored datasets are written to disk and opened memory-mapped by default, so
+every request and every analysis worker process reads the same pages
+zero-copy instead of holding (or being sent) a copy of the columns. The
+files are deleted when the dataset leaves the store and is no longer used.
+Datasets too large to build in memory are written to disk chunk by chunk
+(``put_chunks``) and always memory-mapped.
+
+With a shared cache (see shared), stored datasets are published to the
+directory all worker processes share and always memory-mapped from there:
+a dataset stored by one worker is found by the others, which map the same
+files instead of asking for another upload, and deleting it removes it for
+all of them.
+
+Configuration (environment variables):
+
+- ``DATASET_STORE_MAX_BYTES``: size budget for stored datasets, in memory or
+  on disk (default 512 MB)
+- ``DATASET_TTL_SECONDS``: idle time after which a dataset expires (default 1 hour)
+- ``DATASET_STORAGE``: ``mmap`` (default) or ``memory`` (ignored with a shared cache)
+- ``DATASET_DIR``: where memory-mapped datasets are written (default: the temp
+  directory; with a shared cache, its directory)
+"""
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import jsonio
+from columnar import ColumnarDataset
+from outofcore import DatasetWriter
+from planner import MaterializedViews, extend_views
+from shared import SharedCache, shared_cache
+
+STORAGE_MODES = ("mmap", "memory")
+
+
+def dataset_fingerprint(records: List[Dict[str, Any]]) -> str:
+    """Content hash of report rows, used as the dataset id"""
+    return hashlib.sha256(jsonio.dumps(records, sort_keys=True)).hexdigest()
+
+
+def appended_fingerprint(dataset_id: str, rows_fingerprint: str) -> str:
+    """Id of a dataset after appending rows: chained from its previous id and the new rows' fingerprint"""
+    return hashlib.sha256(f"{dataset_id}+{rows_fingerprint}".encode("utf-8")).hexdigest()
+
+
+class StoredDataset:
+    def __init__(self, dataset_id: str, dataset: ColumnarDataset, previous_id: Optional[str] = None):
+        self.dataset_id = dataset_id
+        self.dataset = dataset
+        # Id of the dataset this one was appended to, if any
+        self.previous_id = previous_id
+        dataset.fingerprint = dataset_id
+        if dataset.views is None:
+            dataset.views = MaterializedViews()
+        self.nbytes = dataset.nbytes
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "dataset_id": self.dataset_id,
+            "row_count": self.dataset.num_rows,
+            "columns": self.dataset.column_names,
+            "size_bytes": self.nbytes,
+            "previous_dataset_id": self.previous_id,
+        }
+
+
+class DatasetStore:
+    """LRU store of columnar datasets with TTL and a byte budget"""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, storage: str = "mmap", directory: Optional[str] = None,
+                 shared: Optional[SharedCache] = None):
+        storage = storage.lower()
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown dataset storage '{storage}'. Use one of: {', '.join(STORAGE_MODES)}")
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.storage = storage
+        self._base_directory = directory
+        self.shared = shared
+        self._directory: Optional[str] = None
+        self._entries: "OrderedDict[str, StoredDataset]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Appends are serialised so two of them never grow the same dataset
+        self._append_lock = threading.Lock()
+        self.evictions = 0
+
+    def put(self, records: List[Dict[str, Any]]) -> StoredDataset:
+        """Ingest report rows; uploading the same content again reuses the stored copy"""
+        dataset_id = dataset_fingerprint(records)
+        with self._lock:
+            entry = self._entries.get(dataset_id)
+            if entry is not None:
+                self._touch(entry)
+                return entry
+
+        # Build the columns outside the lock; this is the expensive part
+        dataset = ColumnarDataset.from_records(records).materialize()
+        return self.add(dataset_id, dataset)
+
+    def put_dataset(self, dataset_id: str, build) -> StoredDataset:
+        """Store the dataset build() returns under dataset_id, unless that id is stored already"""
+        existing = self.get(dataset_id)
+        if existing is not None:
+            return existing
+        return self.add(dataset_id, build())
+
+    def put_chunks(self, dataset_id: str, chunks: Callable[[], Iterable[ColumnarDataset]]) -> StoredDataset:
+        """
+        Store the dataset made of the chunks of rows chunks() yields under
+        dataset_id (unless that id is stored already), writing them to disk
+        one at a time whatever the storage mode
+        """
+        existing = self.get(dataset_id)
+        if existing is not None:
+            return existing
+        path = os.path.join(self._storage_directory(), uuid.uuid4().hex)
+        writer = DatasetWriter(path)
+        try:
+            for chunk in chunks():
+                writer.add(chunk)
+            dataset = writer.finish()
+        except BaseException:
+            writer.close()
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        weakref.finalize(dataset, shutil.rmtree, path, True)
+        return self.add(dataset_id, dataset)
+
+    def add(self, dataset_id: str, dataset: ColumnarDataset, previous_id: Optional[str] = None) -> StoredDataset:
+        """Store an already built dataset under an id"""
+        dataset = self._persist(dataset)
+        if self.shared is not None:
+            dataset = self.shared.put_dataset(dataset_id, dataset, previous_id)
+        return self._add_entry(StoredDataset(dataset_id, dataset, previous_id))
+
+    def _add_entry(self, entry: StoredDataset) -> StoredDataset:
+        with self._lock:
+            existing = self._entries.get(entry.dataset_id)
+            if existing is not None:
+                self._touch(existing)
+                return existing
+            self._entries[entry.dataset_id] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+        return entry
+
+    def append(self, dataset_id: str, records: List[Dict[str, Any]]) -> Optional[StoredDataset]:
+        """
+        Append report rows to a stored dataset and store the grown dataset
+        under a new id; returns None when dataset_id is unknown or expired.
+        The previous dataset stays available (ids are content addresses and
+        may be shared) until it is evicted.
+        """
+        return self.append_dataset(dataset_id, dataset_fingerprint(records),
+                                   lambda: ColumnarDataset.from_records(records))
+
+    def append_dataset(self, dataset_id: str, rows_fingerprint: str, build) -> Optional[StoredDataset]:
+        """Like append, with the new rows as the dataset build() returns and their fingerprint"""
+        with self._append_lock:
+            entry = self.get(dataset_id)
+            if entry is None:
+                return None
+            new_id = appended_fingerprint(dataset_id, rows_fingerprint)
+            existing = self.get(new_id)
+            if existing is not None:
+                # Same rows appended to the same dataset before
+                return existing
+
+            previous = entry.dataset
+            dataset = self._persist(previous.append(build()))
+            dataset.views = extend_views(previous.views, dataset, previous.num_rows)
+            return self.add(new_id, dataset, previous_id=dataset_id)
+
+    def get(self, dataset_id: str) -> Optional[StoredDataset]:
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(dataset_id)
+            if entry is not None:
+                if self.shared is not None and not self.shared.touch_dataset(dataset_id):
+                    # Evicted or deleted by another worker
+                    self._entries.pop(dataset_id)
+                    self._bytes -= entry.nbytes
+                    return None
+                self._touch(entry)
+                return entry
+        if self.shared is None:
+            return None
+        # Stored by another worker
+        published = self.shared.get_dataset(dataset_id)
+        if published is None:
+            return None
+        dataset, previous_id = published
+        return self._add_entry(StoredDataset(dataset_id, dataset, previous_id))
+
+    def delete(self, dataset_id: str) -> bool:
+        deleted = self.shared is not None and self.shared.delete_dataset(dataset_id)
+        with self._lock:
+            entry = self._entries.pop(dataset_id, None)
+            if entry is None:
+                return deleted
+            self._bytes -= entry.nbytes
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "datasets": len(self._entries),
+                "size_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "evictions": self.evictions,
+                "storage": self.storage,
+            }
+
+    def _persist(self, dataset: ColumnarDataset) -> ColumnarDataset:
+        """
+        With mmap storage, the dataset written to disk and reopened memory-mapped
+        (a dataset that is mapped already is returned as is); the files are
+        removed once the returned dataset is garbage collected
+        """
+        if (self.storage != "mmap" and self.shared is None) or dataset.directory is not None:
+            return dataset
+        path = os.path.join(self._storage_directory(), uuid.uuid4().hex)
+        try:
+            dataset.save(path)
+            mapped = ColumnarDataset.open(path)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        weakref.finalize(mapped, shutil.rmtree, path, True)
+        return mapped
+
+    def _storage_directory(self) -> str:
+        with self._lock:
+            if self._directory is None:
+                # One directory per process, removed at exit. With a shared
+                # cache it is on the cache's file system, so datasets are
+                # published by moving them
+                base = os.path.join(self.shared.directory, "tmp") if self.shared is not None else self._base_directory
+                if base:
+                    os.makedirs(base, exist_ok=True)
+                self._directory = tempfile.mkdtemp(prefix="report-datasets-", dir=base)
+                atexit.register(shutil.rmtree, self._directory, True)
+            return self._directory
+
+    def _touch(self, entry: StoredDataset) -> None:
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(entry.dataset_id)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.last_used >= cutoff:
+                break
+            self._remove_oldest()
+
+    def _evict(self) -> None:
+        self._expire()
+        # Keep at least the newest dataset even if it alone exceeds the budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove_oldest()
+
+    def _remove_oldest(self) -> None:
+        _, entry = self._entries.popitem(last=False)
+        self._bytes -= entry.nbytes
+        self.evictions += 1
+
+
+dataset_store = DatasetStore(
+    max_bytes=int(os.getenv("DATASET_STORE_MAX_BYTES", str(512 * 1024 * 1024))),
+    ttl_seconds=float(os.getenv("DATASET_TTL_SECONDS", "3600")),
+    storage=os.getenv("DATASET_STORAGE", "mmap"),
+    directory=os.getenv("DATASET_DIR") or None,
+    shared=shared_cache,
+)
@@ -0,0 +1,56 @@
+"""
+Streamed analyze responses.
+
+Instead of one JSON document once every chart is done, ``/api/analyze`` can
+send each chart as soon as it is computed, as newline-delimited JSON or as
+Server-Sent Events:
+
+- NDJSON (``application/x-ndjson``): one ``{"index": i, "chart": {...}}``
+  object per line, in order of completion, then a ``{"done": true, ...}``
+  line (or ``{"error": ...}`` if the analysis failed midway),
+- SSE (``text/event-stream``): the same objects as ``chart``, ``done`` and
+  ``error`` events, for ``EventSource`` and other SSE clients.
+
+``/api/analyze/batch`` streams whole jobs the same way, as ``job`` records.
+The format is picked with the ``stream`` query parameter or the Accept header.
+"""
+from typing import Any, Dict, Optional
+
+import jsonio
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def negotiate_stream_format(accept: Optional[str], explicit: Optional[str] = None) -> Optional[str]:
+    """
+    Stream format from the ``stream`` parameter or the Accept header; None
+    for a regular JSON response. Raises ValueError for an unknown format.
+    """
+    if explicit:
+        explicit = explicit.lower()
+        if explicit in ("none", "false", "json"):
+            return None
+        if explicit not in STREAM_FORMATS:
+            raise ValueError(f"Unknown stream format '{explicit}'. Use one of: {', '.join(STREAM_FORMATS)}")
+        return explicit
+    media_types = [part.split(";")[0].strip().lower() for part in (accept or "").split(",")]
+    for fmt, media_type in STREAM_FORMATS.items():
+        if media_type in media_types:
+            return fmt
+    return None
+
+
+def encode_event(fmt: str, event: str, content: Dict[str, Any]) -> bytes:
+    """One streamed record: an NDJSON line, or an SSE event named event"""
+    data = jsonio.dumps(content)
+    if fmt == "sse":
+        return b"event: " + event.encode("ascii") + b"\ndata: " + data + b"\n\n"
+    return data + b"\n"
+
+
+def stream_headers() -> Dict[str, str]:
+    """Headers that keep proxies from buffering or caching a stream"""
+    return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
@@ -8,9 +8,51 @@ use Illuminate\Support\Facades\Log;
 
 class ReportController extends Controller
 {
+    private function getApiBaseUrl()
+    {
+        return env('PYTHON_API_URL', 'http://localhost:8001');
+    }
+
     private function getApiUrl()
     {
-        return env('PYTHON_API_URL', 'http://localhost:8001') . '/api/analyze';
+        return $this->getApiBaseUrl() . '/api/analyze';
+    }
+
+    private function uploadDataset($reportData)
+    {
+        // Store the report on the Python side once so later analyze calls only send its id
+        try {
+            $response = Http::post($this->getApiBaseUrl() . '/api/datasets', [
+                'report_data' => $reportData
+            ]);
+            if ($response->successful()) {
+                return $response->json()['dataset_id'] ?? null;
+            }
+            Log::warning('Dataset upload failed: ' . $response->body());
+        } catch (\Exception $e) {
+            Log::warning('Dataset upload error: ' . $e->getMessage());
+        }
+        return null;
+    }
+
+    private function profileDataset($datasetId, $reportData)
+    {
+        // Column types, statistics and suggested charts, computed by the Python API
+        try {
+            $payload = $datasetId ? ['dataset_id' => $datasetId] : ['report_data' => $reportData];
+            $response = Http::post($this->getApiBaseUrl() . '/api/profile', $payload);
+            if ($response->status() === 404 && $datasetId) {
+                // Dataset expired on the Python side - profile the rows instead
+                $response = Http::post($this->getApiBaseUrl() . '/api/profile', ['report_data' => $reportData]);
+            }
+            if ($response->successful()) {
+                return $response->json();
+            }
+            Log::warning('Dataset profile failed: ' . $response->body());
+        } catch (\Exception $e) {
+            Log::warning('Dataset profile error: ' . $e->getMessage());
+        }
+        return null;
     }
 
     public function index()
@@ -61,105 +103,32 @@ class ReportController extends Controller
         }
 
         $columns = array_keys($firstRow);
+        $datasetId = $this->uploadDataset($reportData);
+
+        // Column types come from the Python API's profile of the dataset
         $columnTypes = [];
-        
-        // Sample multiple rows for better detection (up to 10 rows)
-        $sampleRows = array_slice($reportData, 0, min(10, count($reportData)));
-        
+        $profile = $this->profileDataset($datasetId, $reportData);
+        foreach ($profile['columns'] ?? [] as $column) {
+            $columnTypes[$column['name']] = [
+                'type' => $column['type'],
+                'sample' => $column['sample'],
+                'null_rate' => $column['null_rate'],
+                'cardinality' => $column['cardinality'],
+                'min' => $column['min'],
+                'max' => $column['max'],
+                'date_format' => $column['date_format'],
+            ];
+        }
         foreach ($columns as $col) {
-            $isNumeric = false;
-            $isDate = false;
-            $dateCount = 0;
-            $numericCount = 0;
-            $totalSamples = 0;
-            
-            // Check multiple sample values
-            foreach ($sampleRows as $row) {
-                $sampleValue = $row[$col] ?? null;
-                if ($sampleValue === null || $sampleValue === '') {
-                    continue;
-                }
-                $totalSamples++;
-                
-                // Check if numeric
-                if (is_numeric($sampleValue)) {
-                    $numericCount++;
-                } else if (is_string($sampleValue)) {
-                    // Check if date - try multiple formats
-                    $dateFormats = [
-                        '/^\d{4}-\d{2}-\d{2}/',                    // YYYY-MM-DD
-                        '/^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}/',  // YYYY-MM-DD HH:MM:SS
-                        '/^\d{2}-[A-Za-z]{3}-\d{4}/',              // DD-MMM-YYYY (e.g., 01-Feb-2026)
-                        '/^\d{2}\/[A-Za-z]{3}\/\d{4}/',            // DD/MMM/YYYY
-                        '/^\d{2}\/\d{2}\/\d{4}/',                  // DD/MM/YYYY or MM/DD/YYYY
-                        '/^\d{4}\/\d{2}\/\d{2}/',                  // YYYY/MM/DD
-                        '/^\d{1,2}-\d{1,2}-\d{4}/',                // D-M-YYYY or DD-MM-YYYY
-                        '/^[A-Za-z]{3} \d{1,2}, \d{4}/',           // MMM D, YYYY (e.g., Feb 1, 2026)
-                        '/^\d{1,2} [A-Za-z]{3} \d{4}/',            // D MMM YYYY (e.g., 1 Feb 2026)
-                    ];
-                    
-                    $matchesDate = false;
-                    foreach ($dateFormats as $format) {
-                        if (preg_match($format, $sampleValue)) {
-                            $matchesDate = true;
-                            break;
-                        }
-                    }
-                    
-                    // Additional check: Try to parse as date using PHP's date parsing
-                    if (!$matchesDate) {
-                        // Check if column name suggests it's a date
-                        $dateKeywords = ['date', 'time', 'created', 'updated', 'modified', 'timestamp'];
-                        $colLower = strtolower($col);
-                        foreach ($dateKeywords as $keyword) {
-                            if (strpos($colLower, $keyword) !== false) {
-                                // Try to parse with strtotime
-                                $timestamp = strtotime($sampleValue);
-                                if ($timestamp !== false) {
-                                    $matchesDate = true;
-                                    break;
-                                }
-                            }
-                        }
-                    }
-                    
-                    if ($matchesDate) {
-                        $dateCount++;
-                    }
-                }
-            }
-            
-            // Determine type based on majority of samples
-            if ($totalSamples > 0) {
-                $numericRatio = $numericCount / $totalSamples;
-                $dateRatio = $dateCount / $totalSamples;
-                
-                if ($numericRatio > 0.5) {
-                    $isNumeric = true;
-                } else if ($dateRatio > 0.5) {
-                    $isDate = true;
-                } else if ($dateCount > 0) {
-                    // If at least one date found and column name suggests date, mark as date
-                    $dateKeywords = ['date', 'time', 'created', 'updated', 'modified', 'timestamp'];
-                    $colLower = strtolower($col);
-                    foreach ($dateKeywords as $keyword) {
-                        if (strpos($colLower, $keyword) !== false) {
-                            $isDate = true;
-                            break;
-                        }
-                    }
-                }
+            if (!isset($columnTypes[$col])) {
+                $columnTypes[$col] = ['type' => 'categorical', 'sample' => $firstRow[$col] ?? null];
             }
-            
-            $columnTypes[$col] = [
-                'type' => $isNumeric ? 'numeric' : ($isDate ? 'date' : 'categorical'),
-                'sample' => $firstRow[$col] ?? null
-            ];
         }
 
         // Store report data and column info in session for later use
         session([
             'report_data' => $reportData,
+            'dataset_id' => $datasetId,
             'columns' => $columns,
             'column_types' => $columnTypes
         ]);
@@ -199,13 +168,41 @@ class ReportController extends Controller
         }
 
         try {
-            // Call Python API using POST with JSON body
-            $response = Http::withHeaders([
-                'Content-Type' => 'application/json',
-            ])->post($this->getApiUrl(), [
-                'report_data' => $reportData,
-                'chart_configs' => $chartConfigs
-            ]);
+            // Call Python API using POST with JSON body, referencing the uploaded dataset if there is one
+            $datasetId = session('dataset_id');
+            $response = null;
+            if ($datasetId) {
+                $response = Http::withHeaders([
+                    'Content-Type' => 'application/json',
+                ])->post($this->getApiUrl(), [
+                    'dataset_id' => $datasetId,
+                    'chart_configs' => $chartConfigs
+                ]);
+
+                if ($response->status() === 404) {
+                    // Dataset expired on the Python side - upload it again
+                    $datasetId = $this->uploadDataset($reportData);
+                    session(['dataset_id' => $datasetId]);
+                    $response = null;
+                    if ($datasetId) {
+                        $response = Http::withHeaders([
+                            'Content-Type' => 'application/json',
+                        ])->post($this->getApiUrl(), [
+                            'dataset_id' => $datasetId,
+                            'chart_configs' => $chartConfigs
+                        ]);
+                    }
+                }
+            }
+
+            if (!$response) {
+                $response = Http::withHeaders([
+                    'Content-Type' => 'application/json',
+                ])->post($this->getApiUrl(), [
+                    'report_data' => $reportData,
+                    'chart_configs' => $chartConfigs
+                ]);
+            }
 
             if ($response->successful()) {
                 $data = $response->json();
@@ -275,9 +272,11 @@ class ReportController extends Controller
                 ->with('error', 'Invalid report data format. Expected a JSON array.');
         }
 
-        // If chart_configs not provided, create default configs based on common columns
+        // If chart_configs not provided, use the charts suggested by the dataset profile
+        $datasetId = null;
         if (!$chartConfigs) {
-            $chartConfigs = $this->generateDefaultChartConfigs($reportData);
+            $datasetId = $this->uploadDataset($reportData);
+            $chartConfigs = $this->generateDefaultChartConfigs($reportData, $datasetId);
         } elseif (is_string($chartConfigs)) {
             // Parse chart configs if it's a string
             $decoded = json_decode($chartConfigs, true);
@@ -286,26 +285,34 @@ class ReportController extends Controller
             }
         }
 
-        // Ensure report_data is JSON string for API call
-        if (is_array($reportData)) {
-            $reportDataJson = json_encode($reportData);
-        } else {
-            $reportDataJson = $reportData;
-        }
-
-        // Ensure chart_configs is JSON string for API call
-        if (is_array($chartConfigs)) {
-            $chartConfigsJson = json_encode($chartConfigs);
-        } else {
-            $chartConfigsJson = $chartConfigs;
+        // Ensure chart_configs is an array for the API call
+        if (is_string($chartConfigs)) {
+            $chartConfigs = json_decode($chartConfigs, true) ?? [];
         }
 
         try {
-            // Call Python API
-            $response = Http::get($this->getApiUrl(), [
-                'report_data' => $reportDataJson,
-                'chart_configs' => $chartConfigsJson
-            ]);
+            // Call Python API using POST with JSON body (query strings are too small for reports)
+            $response = null;
+            if ($datasetId) {
+                $response = Http::withHeaders([
+                    'Content-Type' => 'application/json',
+                ])->post($this->getApiUrl(), [
+                    'dataset_id' => $datasetId,
+                    'chart_configs' => $chartConfigs
+                ]);
+                if ($response->status() === 404) {
+                    $response = null;
+                }
+            }
+
+            if (!$response) {
+                $response = Http::withHeaders([
+                    'Content-Type' => 'application/json',
+                ])->post($this->getApiUrl(), [
+                    'report_data' => $reportData,
+                    'chart_configs' => $chartConfigs
+                ]);
+            }
 
             if ($response->successful()) {
                 $data = $response->json();
@@ -327,7 +334,7 @@ class ReportController extends Controller
         }
     }
 
-    private function generateDefaultChartConfigs($reportData)
+    private function generateDefaultChartConfigs($reportData, $datasetId = null)
     {
         // Parse report data to detect columns
         $data = is_string($reportData) ? json_decode($reportData, true) : $reportData;
@@ -336,46 +343,9 @@ class ReportController extends Controller
             return [];
         }
 
-        $firstRow = $data[0];
-        if (!is_array($firstRow)) {
-            return [];
-        }
-        $columns = array_keys($firstRow);
-        
-        $configs = [];
-
-        // Common categorical columns for count/bar/pie charts
-        $categoricalColumns = ['partyType', 'orderStatus', 'partyName', 'itemName', 'fromPartyState', 'toPartyState'];
-        
-        foreach ($categoricalColumns as $col) {
-            if (isset($firstRow[$col])) {
-                $configs[] = [
-                    'chart_type' => 'count_chart',
-                    'column' => $col,
-                    'title' => 'Orders by ' . ucwords(str_replace(['_', '-'], ' ', $col))
-                ];
-            }
-        }
-
-        // Numeric columns for line/xy charts
-        $numericColumns = ['itemTotalAmt', 'soTotalAmt', 'itemQty', 'itemRate'];
-        foreach ($numericColumns as $col) {
-            if (isset($firstRow[$col])) {
-                // Try to find a date column for x-axis
-                if (isset($firstRow['orderDate'])) {
-                    $configs[] = [
-                        'chart_type' => 'line_chart',
-                        'x_column' => 'orderDate',
-                        'y_column' => $col,
-                        'title' => ucwords(str_replace(['_', '-'], ' ', $col)) . ' Over Time',
-                        'x_label' => 'Date',
-                        'y_label' => ucwords(str_replace(['_', '-'], ' ', $col))
-                    ];
-                }
-            }
-        }
-
-        return $configs;
+        // Default charts are picked by the Python API from the column profile
+        $profile = $this->profileDataset($datasetId, $data);
+        return $profile['suggested_charts'] ?? [];
     }
 }
 